@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from logzero import logger
+
+
+# Account configuration file path
+ACCOUNT_CONFIG_PATH = str(Path().resolve()) + "/account_configuration/"
+# File that caches account information discovered from Graph API. It has
+# no .json suffix so that it is not read as an account configuration.
+DISCOVERY_CACHE_FILE = ".discovery_cache"
+# Seconds that discovered account information is used before refreshing.
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+
+
+def write_json_atomic(path, data):
+    """ Writes data as JSON so that readers never see a partial file. """
+
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump(data, temp_file, indent=4)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class AccountRegistry:
+    """ In-memory registry of account configuration files.
+
+    Configurations are loaded once and reloaded only when the
+    modification time of the directory or a file changes.
+    """
+
+    def __init__(self, config_path=ACCOUNT_CONFIG_PATH, discovery_ttl=DISCOVERY_TTL):
+        self.config_path = config_path
+        self.discovery_ttl = discovery_ttl
+        self.lock = threading.RLock()
+        # Loaded configurations as (mtime, data) tuples keyed by path.
+        self.configurations = dict()
+        self.directory_mtime = None
+        self.discovery = None
+
+    def get_accounts(self):
+        """ Returns configurations of every account in file name order. """
+
+        with self.lock:
+            self.refresh()
+            return [data for _, (_, data) in sorted(self.configurations.items())]
+
+    def refresh(self):
+        """ Reloads configuration files that were added or changed. """
+
+        try:
+            directory_mtime = os.stat(self.config_path).st_mtime_ns
+        except FileNotFoundError:
+            self.configurations = dict()
+            return
+        # Files are listed again only when some were added or removed.
+        if directory_mtime != self.directory_mtime:
+            self.directory_mtime = directory_mtime
+            paths = {str(p) for p in Path(self.config_path).glob('*.json')}
+            for path in set(self.configurations) - paths:
+                del self.configurations[path]
+            for path in paths - set(self.configurations):
+                self.configurations[path] = (None, None)
+        for path, (mtime, _) in list(self.configurations.items()):
+            try:
+                current_mtime = os.stat(path).st_mtime_ns
+                if current_mtime != mtime:
+                    logger.info("Loading account configuration " + path + ".")
+                    self.configurations[path] = (
+                        current_mtime, json.loads(Path(path).read_text()))
+            except (FileNotFoundError, ValueError) as ex:
+                logger.warning("Could not load account configuration " + path + ".")
+                logger.error(ex)
+                del self.configurations[path]
+
+    def get_account(self, user_id):
+        """ Returns configuration of the account or None. """
+
+        for data in self.get_accounts():
+            if data.get('user_id') == user_id:
+                return data
+        return None
+
+    def save_account(self, data):
+        """ Atomically writes configuration of the account and caches it. """
+
+        path = os.path.join(self.config_path, data['user_id'] + ".json")
+        with self.lock:
+            write_json_atomic(path, data)
+            self.configurations[path] = (os.stat(path).st_mtime_ns, data)
+
+    def get_discovery(self):
+        """ Returns cached account discovery information if it is fresh. """
+
+        with self.lock:
+            if self.discovery is None:
+                try:
+                    self.discovery = json.loads(Path(
+                        self.config_path, DISCOVERY_CACHE_FILE).read_text())
+                except (FileNotFoundError, ValueError):
+                    return None
+            if time.time() - self.discovery['timestamp'] > self.discovery_ttl:
+                logger.info("Cached account information has expired.")
+                return None
+            return self.discovery['info']
+
+    def set_discovery(self, info):
+        """ Caches account discovery information. """
+
+        with self.lock:
+            self.discovery = {'timestamp': time.time(), 'info': info}
+            write_json_atomic(os.path.join(
+                self.config_path, DISCOVERY_CACHE_FILE), self.discovery)
+
+
+# Registries shared by the process by configuration path.
+_registries = dict()
+_registries_lock = threading.Lock()
+
+
+def get_registry(config_path=ACCOUNT_CONFIG_PATH, discovery_ttl=DISCOVERY_TTL):
+    """ Returns the account registry of the configuration path. """
+
+    with _registries_lock:
+        if config_path not in _registries:
+            _registries[config_path] = AccountRegistry(config_path, discovery_ttl)
+        registry = _registries[config_path]
+        registry.discovery_ttl = discovery_ttl
+        return registry
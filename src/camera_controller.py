@@ -1,98 +1,148 @@
 from pathlib import Path
 from datetime import datetime
 import time
-from subprocess import call
+import io
 import os
 from logzero import logger
-import picamera
+from mp4_container import Mp4Muxer
+from metrics import metrics
 
 
 # Video file path
 VIDEO_PATH = str(Path().resolve()) + "/videos/"
 IMAGE_PATH = str(Path().resolve()) + "/images/"
+# Resolution of recorded videos and images.
+CAMERA_RESOLUTION = (1296, 730)
+# Seconds between intra frames of recorded videos, so that trimmed
+# videos can be cut close to the watering without encoding them again.
+INTRA_PERIOD_SECONDS = 1
 
 
 class CameraController:
+    """ Records videos and captures images of the plant.
 
-    def __init__(self) -> None:
-        self.camera = picamera.PiCamera()
-        self.camera.resolution = (1296, 730)
-        self.video_file_path = VIDEO_PATH + str(datetime.now().date())
-        self.image_file_path = IMAGE_PATH + str(time.time())
+    Camera is opened on first use, so processes that never record do
+    not import picamera or reserve the camera.
+    """
 
+    def __init__(self, camera=None) -> None:
+        self._camera = None
+        if camera is not None:
+            self.set_camera(camera)
+        self.resolution = CAMERA_RESOLUTION
+        self.muxer = None
+        self.set_date(datetime.now().date())
+
+    @property
+    def camera(self):
+        """ Camera that is opened when it is first needed. """
+
+        if self._camera is None:
+            import picamera
+            logger.info("Opening camera.")
+            self.set_camera(picamera.PiCamera())
+        return self._camera
+
+    def set_camera(self, camera):
+        camera.resolution = CAMERA_RESOLUTION
+        self._camera = camera
+
+    def set_date(self, date):
+        """ Sets the date whose video is recorded and deleted. """
+
+        # Path without suffix.
+        self.video_file_path = VIDEO_PATH + str(date)
+
+    @property
+    def motion_file_path(self):
+        return self.video_file_path + ".motion"
+
+    @metrics.timed('camera', operation='start_record')
     def start_record(self):
-        """ Starts to record video. """
+        """ Starts to record video straight into an MP4 file. """
 
         try:
             # Delete possible video that was taken earlier.
             logger.info("Deleting previous video if exists.")
             self.delete_previous_video()
             logger.info("Starting to record video.")
-            # Start recording video.
-            self.camera.start_recording(self.video_file_path + ".h264")
+            framerate = self.camera.framerate
+            # Frames are muxed into MP4 container as they arrive.
+            self.muxer = Mp4Muxer(self.video_file_path + ".mp4",
+                                  framerate=framerate)
+            # Start recording video. Motion vectors of the encoder are
+            # stored for finding the part of the video with water flowing.
+            self.camera.start_recording(
+                self.muxer, format='h264', motion_output=self.motion_file_path,
+                intra_period=int(round(framerate * INTRA_PERIOD_SECONDS)))
         except Exception as ex:
             logger.warning("Error happened while recording video.")
             logger.error(ex)
 
+    @metrics.timed('camera', operation='stop_record')
     def stop_record(self):
-        """ Stops video recording and calls converter function. """
+        """ Stops video recording and finalizes the MP4 file. """
 
         try:
             logger.info("Stopping video recording.")
             # Stop recording.
             self.camera.stop_recording()
-            # Take a picture of the plant.
-            self.capture_image()
-            # Convert video to mp4 and return result.
+            # Finalize the video muxed during recording and return result.
             return self.convert_recording_to_mp4()
         except Exception as ex:
             logger.warning("Error happened ending video recording.")
             logger.error(ex)
+            return False
 
-    def capture_image(self):
-        """ Captures single image for later use. """
+    @metrics.timed('camera', operation='capture_image')
+    def capture_image(self, image_format='jpeg', quality=85):
+        """ Captures single image and returns it encoded in memory.
+
+        Camera encodes JPEG in hardware, so other formats are captured as
+        high quality JPEG and converted when the image is archived. PNG
+        is captured losslessly.
+        """
 
         logger.info("Capturing image.")
         self.camera.start_preview()
         # Camera warm-up time
         time.sleep(2)
         # Capture image.
-        self.camera.capture(self.image_file_path + ".png")
+        stream = io.BytesIO()
+        if image_format == 'png':
+            self.camera.capture(stream, format='png')
+        else:
+            self.camera.capture(stream, format='jpeg',
+                                quality=quality if image_format == 'jpeg' else 95)
+        self.camera.stop_preview()
         logger.info("Image captured.")
+        return stream.getvalue()
 
     def convert_recording_to_mp4(self):
-        """ Converts .h264 to mp4 file. """
+        """ Writes the MP4 index of the recording muxed during recording. """
 
-        # Define file names of original and converted versions.
-        orig_file = self.video_file_path + ".h264"
-        converted_file = self.video_file_path + ".mp4"
-        # Try to convert video with shell command.
+        if self.muxer is None:
+            logger.error("No recording to finalize.")
+            return False
         try:
-            command = "MP4Box -add " + orig_file + " " + converted_file
-            logger.info("Converting video to mp4.")
-            # Execute command to convert h246 to mp4.
-            call([command], shell=True)
-            logger.info("Video successfully converted.")
-            self.delete_original_format()
+            logger.info("Finalizing mp4 video.")
+            self.muxer.close()
+            logger.info("Video successfully finalized.")
             return True
-        except:
-            logger.error("Error when converting video to mp4.")
+        except Exception as ex:
+            logger.error("Error when finalizing mp4 video.")
+            logger.error(ex)
             return False
-
-    def delete_original_format(self):
-        """ Deletes the H246 format file after conversion to mp4. """
-
-        orig_file = Path(self.video_file_path + '.h264')
-        # Check if file exists.
-        if orig_file.is_file():
-            # Remove file.
-            os.remove(self.video_file_path + ".h264")
+        finally:
+            self.muxer = None
 
     def delete_previous_video(self):
-        """ Deletes possibly existing mp4 video with the same date. """
-
-        converted_file = Path(self.video_file_path + '.mp4')
-        # Check if file exists.
-        if converted_file.is_file():
-            # Remove file.
-            os.remove(self.video_file_path + ".mp4")
+        """ Deletes possibly existing video files with the same date. """
+
+        for path in (self.video_file_path + ".mp4",
+                     self.video_file_path + "_trimmed.mp4",
+                     self.motion_file_path):
+            # Check if file exists.
+            if Path(path).is_file():
+                # Remove file.
+                os.remove(path)
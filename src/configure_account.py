@@ -2,6 +2,8 @@
 
 from parse_config import get_configuration
 from graph_handler import GraphHandler
+from http_client import HttpError
+from logzero import logger
 
 
 def main():
@@ -10,8 +12,12 @@ def main():
     args = get_configuration()
     # Create Instagram Graph API handler object
     gh = GraphHandler(args)
-    # Create configuration files.
-    gh.create_configuration_files()
+    # Create configuration files. Accounts are discovered again when
+    # configuration is requested explicitly, so names are not stale.
+    try:
+        gh.create_configuration_files(refresh=args.configure_account)
+    except HttpError as ex:
+        logger.error("Could not create configuration files: " + str(ex))
 
 
 if __name__ == "__main__":
@@ -1,37 +1,178 @@
 #!/usr/bin/env python3
 
 
+import json
 import sqlite3
+import threading
 from logzero import logger
+from metrics import metrics
+
+
+# Seconds to wait for a lock held by another process before failing.
+BUSY_TIMEOUT = 30
+# Amount of prepared statements cached by the connection.
+STATEMENT_CACHE_SIZE = 128
+
+
+def migrate_unique_post_dates(con):
+    """ Rebuilds posts table with date as a unique key.
+
+    Only the latest row of every date is kept, since earlier versions
+    appended a new row on every comment check.
+    """
+
+    con.execute(''' CREATE TABLE posts_new
+                    (id integer, date text NOT NULL UNIQUE,
+                     water_amount integer, vote_count integer) ''')
+    con.execute(''' INSERT INTO posts_new (id, date, water_amount, vote_count)
+                    SELECT id, date, water_amount, vote_count FROM posts
+                    WHERE rowid IN (SELECT max(rowid) FROM posts GROUP BY date) ''')
+    con.execute("DROP TABLE posts")
+    con.execute("ALTER TABLE posts_new RENAME TO posts")
+
+
+def statement_kind(sql):
+    """ Returns the lowercase leading keyword of a statement for metrics. """
+
+    return sql.split(None, 1)[0].lower() if sql.strip() else "empty"
+
+
+# Schema migrations in order. Index of a migration plus one is the schema
+# version it upgrades the database to.
+MIGRATIONS = [
+    ''' CREATE TABLE IF NOT EXISTS posts
+        (id integer, date text, water_amount integer, vote_count integer);
+        CREATE TABLE IF NOT EXISTS comment_cursors
+        (media_id text PRIMARY KEY, last_timestamp text,
+         boundary_ids text, votes text); ''',
+    migrate_unique_post_dates,
+    ''' CREATE INDEX IF NOT EXISTS posts_media_id ON posts (id); ''',
+    ''' CREATE TABLE IF NOT EXISTS images
+        (date text PRIMARY KEY REFERENCES posts (date), path text,
+         thumbnail_path text, format text, size integer,
+         width integer, height integer, captured_at real); ''',
+    # Votes are counted per user from now on, so tallies of the cursors
+    # are dropped and comments are counted again into the ledger.
+    ''' CREATE TABLE IF NOT EXISTS votes
+        (media_id text NOT NULL, user_id text NOT NULL,
+         water_amount integer NOT NULL, comment_id text,
+         timestamp text NOT NULL, PRIMARY KEY (media_id, user_id))
+        WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS votes_media_amount
+        ON votes (media_id, water_amount);
+        DELETE FROM comment_cursors; ''',
+    ''' CREATE TABLE IF NOT EXISTS daily_runs
+        (date text PRIMARY KEY, watered_at real, delivered_ml real,
+         video_path text, video_hash text, video_url text,
+         url_expires_at real, container_ids text, media_ids text); ''',
+    ''' CREATE TABLE IF NOT EXISTS outbox
+        (date text PRIMARY KEY, video_path text NOT NULL,
+         status text NOT NULL DEFAULT 'pending',
+         attempts integer NOT NULL DEFAULT 0, next_attempt_at real NOT NULL,
+         last_error text, created_at real NOT NULL, published_at real);
+        CREATE INDEX IF NOT EXISTS outbox_due
+        ON outbox (status, next_attempt_at); ''',
+    # Publishing limit applies to every account separately, so published
+    # media of every account are counted. Earlier outbox posts are counted
+    # from the media ids of their daily runs.
+    ''' ALTER TABLE outbox ADD COLUMN caption text;
+        CREATE TABLE IF NOT EXISTS publications
+        (user_id text NOT NULL, media_id text NOT NULL,
+         published_at real NOT NULL);
+        CREATE INDEX IF NOT EXISTS publications_time
+        ON publications (published_at, user_id);
+        INSERT INTO publications (user_id, media_id, published_at)
+        SELECT accounts.key, accounts.value, outbox.published_at
+        FROM outbox JOIN daily_runs USING (date),
+        json_each(daily_runs.media_ids) AS accounts
+        WHERE outbox.status = 'published'; ''',
+    # Tallies of the cursors were replaced by the votes ledger. Table is
+    # copied, since older SQLite versions cannot drop columns.
+    ''' CREATE TABLE comment_cursors_new
+        (media_id text PRIMARY KEY, last_timestamp text, boundary_ids text);
+        INSERT INTO comment_cursors_new (media_id, last_timestamp, boundary_ids)
+        SELECT media_id, last_timestamp, boundary_ids FROM comment_cursors;
+        DROP TABLE comment_cursors;
+        ALTER TABLE comment_cursors_new RENAME TO comment_cursors; ''',
+]
+# Columns of daily_runs that hold JSON dictionaries keyed by user id.
+DAILY_RUN_JSON_FIELDS = ('container_ids', 'media_ids')
+DAILY_RUN_FIELDS = ('date', 'watered_at', 'delivered_ml', 'video_path',
+                    'video_hash', 'video_url', 'url_expires_at') + \
+    DAILY_RUN_JSON_FIELDS
 
 
 class DatabaseHandler:
 
     def __init__(self, args) -> None:
-        with sqlite3.connect(args.database_name) as con:
-            self.con = con
-            self.cur = self.con.cursor()
+        # Connection is shared by the worker threads of the daily stages.
+        self.con = sqlite3.connect(args.database_name, timeout=BUSY_TIMEOUT,
+                                   check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+        self.lock = threading.RLock()
+        # Write-ahead log lets readers and a writer from different
+        # processes access the database at the same time.
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("PRAGMA busy_timeout = " + str(BUSY_TIMEOUT * 1000))
+        self.setup_table()
 
     def cleanup(self):
         """ Closes connection to database. """
 
         self.con.close()
 
+    def execute(self, sql, parameters=()):
+        """ Executes a statement in its own transaction and returns cursor. """
+
+        with metrics.span('db_query', statement=statement_kind(sql)):
+            with self.lock, self.con:
+                return self.con.execute(sql, parameters)
+
+    def query(self, sql, parameters=()):
+        """ Executes a query and returns all rows. """
+
+        with metrics.span('db_query', statement=statement_kind(sql)):
+            with self.lock:
+                return self.con.execute(sql, parameters).fetchall()
+
     def setup_table(self):
-        """ Creates new table if it doesn't exist. """
+        """ Creates tables or migrates them to the latest schema version. """
 
-        self.cur.execute(''' CREATE TABLE IF NOT EXISTS posts
-                             (id integer, date text, water_amount integer, vote_count integer) ''')
-        # Commiting changes.
-        self.con.commit()
+        with self.lock:
+            while True:
+                # Every migration is applied in a write transaction of its
+                # own, so concurrent processes never apply it twice.
+                self.con.execute("BEGIN IMMEDIATE")
+                try:
+                    version = self.con.execute(
+                        "PRAGMA user_version").fetchone()[0]
+                    if version >= len(MIGRATIONS):
+                        self.con.execute("COMMIT")
+                        return
+                    logger.info("Migrating database to schema version " +
+                                str(version + 1) + ".")
+                    migration = MIGRATIONS[version]
+                    if callable(migration):
+                        migration(self.con)
+                    else:
+                        for statement in migration.split(';'):
+                            if statement.strip():
+                                self.con.execute(statement)
+                    self.con.execute(
+                        "PRAGMA user_version = " + str(version + 1))
+                    self.con.execute("COMMIT")
+                except Exception:
+                    self.con.execute("ROLLBACK")
+                    raise
 
     def check_if_exists(self):
         """ Checks if posts table exists. """
 
-        self.cur.execute(
+        rows = self.query(
             "SELECT count(name) FROM sqlite_master WHERE type='table' AND name='posts'")
         # Check if the table exists.
-        if self.cur.fetchone()[0] == 1:
+        if rows[0][0] == 1:
             return True
         else:
             logger.info("Table does not exist in the database.")
@@ -41,49 +182,262 @@ class DatabaseHandler:
         """ Inserts payload into posts database before post is published. """
 
         # Check that table exists.
-        if self.check_if_exists:
+        if self.check_if_exists():
             required_keys = set(['date', 'water_amount', 'vote_count'])
             # Make sure that required values are present.
             if required_keys.issubset(payload.keys()):
                 # Create SQL expression
-                sql = (
-                    "INSERT INTO posts (date, water_amount, vote_count) VALUES (?, ?, ?)")
+                sql = ("INSERT INTO posts (date, water_amount, vote_count) "
+                       "VALUES (?, ?, ?) ON CONFLICT (date) DO NOTHING")
                 # Execute insertion to database.
-                self.cur.execute(
-                    sql, (payload['date'], payload['water_amount'], payload['vote_count']))
-                # Commit changes.
-                self.con.commit()
+                cur = self.execute(
+                    sql, (str(payload['date']), payload['water_amount'], payload['vote_count']))
+                if cur.rowcount == 0:
+                    logger.warning("Post entry for the date already exists.")
             else:
                 logger.error(
                     "Missing keys from payload when inserting into database.")
 
+    def upsert_to_table(self, payload):
+        """ Updates the post entry of the payload date or inserts it if missing. """
+
+        required_keys = set(['date', 'water_amount', 'vote_count'])
+        if not required_keys.issubset(payload.keys()):
+            logger.error(
+                "Missing keys from payload when upserting into database.")
+            return
+        sql = ("INSERT INTO posts (date, water_amount, vote_count) VALUES (?, ?, ?) "
+               "ON CONFLICT (date) DO UPDATE SET "
+               "water_amount = excluded.water_amount, vote_count = excluded.vote_count")
+        self.execute(
+            sql, (str(payload['date']), payload['water_amount'], payload['vote_count']))
+
+    def get_comment_cursor(self, media_id):
+        """ Returns the stored comment check progress of a post.
+
+        Progress contains the timestamp of the newest counted comment and
+        ids of the counted comments sharing that timestamp.
+        """
+
+        sql = ("SELECT last_timestamp, boundary_ids FROM comment_cursors "
+               "WHERE media_id = ?")
+        rows = self.query(sql, (str(media_id),))
+        if not rows:
+            return {'last_timestamp': '', 'boundary_ids': []}
+        return {'last_timestamp': rows[0][0],
+                'boundary_ids': json.loads(rows[0][1])}
+
+    def set_comment_cursor(self, media_id, cursor):
+        """ Stores the comment check progress of a post. """
+
+        sql = ("INSERT OR REPLACE INTO comment_cursors "
+               "(media_id, last_timestamp, boundary_ids) VALUES (?, ?, ?)")
+        self.execute(sql, (str(media_id), cursor['last_timestamp'],
+                           json.dumps(cursor['boundary_ids'])))
+
+    def record_votes(self, media_id, votes):
+        """ Stores votes of users for a post in a single transaction.
+
+        Votes are (user id, water amount, comment id, timestamp) tuples.
+        Only the latest vote of every user is kept, so recording the same
+        votes again does not change the tally.
+        """
+
+        sql = ("INSERT INTO votes (media_id, user_id, water_amount, comment_id, "
+               "timestamp) VALUES (?, ?, ?, ?, ?) "
+               "ON CONFLICT (media_id, user_id) DO UPDATE SET "
+               "water_amount = excluded.water_amount, "
+               "comment_id = excluded.comment_id, timestamp = excluded.timestamp "
+               "WHERE excluded.timestamp >= votes.timestamp")
+        media_id = str(media_id)
+        with metrics.span('db_query', statement='insert'):
+            with self.lock, self.con:
+                self.con.executemany(sql, ((media_id,) + tuple(vote)
+                                           for vote in votes))
+
+    def get_vote_tally(self, media_id):
+        """ Returns winning water amount of a post and its vote count.
+
+        Ties are won by the smaller amount. Returns None if the post has
+        no votes.
+        """
+
+        sql = ("SELECT water_amount, count(*) AS vote_count FROM votes "
+               "WHERE media_id = ? GROUP BY water_amount "
+               "ORDER BY vote_count DESC, water_amount LIMIT 1")
+        rows = self.query(sql, (str(media_id),))
+        if not rows:
+            return None
+        return {'water_amount': rows[0][0], 'vote_count': rows[0][1]}
+
+    def set_image(self, image):
+        """ Stores the archived image of a date, replacing an earlier one. """
+
+        sql = ("INSERT OR REPLACE INTO images (date, path, thumbnail_path, format, "
+               "size, width, height, captured_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        self.execute(sql, (str(image['date']), image['path'],
+                           image['thumbnail_path'], image['format'],
+                           image['size'], image['width'], image['height'],
+                           image['captured_at']))
+
+    def get_image(self, date):
+        """ Returns the archived image of a date or None. """
+
+        rows = self.query("SELECT * FROM images WHERE date = ?", (str(date),))
+        return self.image_to_dict(rows[0]) if rows else None
+
+    def get_images_before(self, date):
+        """ Returns archived images older than the date, oldest first. """
+
+        rows = self.query("SELECT * FROM images WHERE date < ? ORDER BY date",
+                          (str(date),))
+        return [self.image_to_dict(row) for row in rows]
+
+    def remove_image_files(self, date, path=False, thumbnail_path=False):
+        """ Marks full image or thumbnail of a date as deleted. """
+
+        if path:
+            self.execute("UPDATE images SET path = NULL, size = NULL "
+                         "WHERE date = ?", (str(date),))
+        if thumbnail_path:
+            self.execute("UPDATE images SET thumbnail_path = NULL WHERE date = ?",
+                         (str(date),))
+
+    @staticmethod
+    def image_to_dict(row):
+        """ Converts an images row into a dictionary. """
+
+        keys = ('date', 'path', 'thumbnail_path', 'format', 'size',
+                'width', 'height', 'captured_at')
+        return dict(zip(keys, row))
+
+    def get_daily_run(self, date):
+        """ Returns stored progress of the daily run of a date.
+
+        Missing runs are returned with every field set to None, and
+        container and media ids as empty dictionaries.
+        """
+
+        rows = self.query("SELECT " + ", ".join(DAILY_RUN_FIELDS) +
+                          " FROM daily_runs WHERE date = ?", (str(date),))
+        run = dict(zip(DAILY_RUN_FIELDS, rows[0] if rows else
+                       (str(date),) + (None,) * (len(DAILY_RUN_FIELDS) - 1)))
+        for key in DAILY_RUN_JSON_FIELDS:
+            run[key] = json.loads(run[key]) if run[key] else dict()
+        return run
+
+    def update_daily_run(self, date, **fields):
+        """ Stores progress of the daily run of a date.
+
+        Only the given fields are changed, so stages running at the same
+        time can store their own results.
+        """
+
+        unknown = set(fields) - set(DAILY_RUN_FIELDS[1:])
+        if unknown:
+            raise ValueError("Unknown daily run fields " + ", ".join(sorted(unknown)) + ".")
+        values = [json.dumps(value) if key in DAILY_RUN_JSON_FIELDS else value
+                  for key, value in fields.items()]
+        sql = ("INSERT INTO daily_runs (date, " + ", ".join(fields) + ") "
+               "VALUES (?" + ", ?" * len(fields) + ") ON CONFLICT (date) DO UPDATE SET " +
+               ", ".join(key + " = excluded." + key for key in fields))
+        self.execute(sql, [str(date)] + values)
+
+    def enqueue_post(self, date, video_path, now, caption=None):
+        """ Adds the video of a date into the outbox to be posted now.
+
+        Video of an already published date is not posted again.
+        """
+
+        sql = ("INSERT INTO outbox (date, video_path, caption, next_attempt_at, "
+               "created_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT (date) DO UPDATE SET "
+               "video_path = excluded.video_path, caption = excluded.caption, "
+               "status = 'pending', next_attempt_at = excluded.next_attempt_at "
+               "WHERE outbox.status != 'published'")
+        self.execute(sql, (str(date), video_path, caption, now, now))
+
+    def get_due_posts(self, now, limit):
+        """ Returns at most limit pending posts that are due, oldest first. """
+
+        sql = ("SELECT date, video_path, caption, attempts FROM outbox "
+               "WHERE status = 'pending' AND next_attempt_at <= ? "
+               "ORDER BY date LIMIT ?")
+        rows = self.query(sql, (now, limit))
+        return [{'date': row[0], 'video_path': row[1], 'caption': row[2],
+                 'attempts': row[3]} for row in rows]
+
+    def get_next_post_time(self):
+        """ Returns the time of the next attempt of a pending post or None. """
+
+        rows = self.query("SELECT min(next_attempt_at) FROM outbox "
+                          "WHERE status = 'pending'")
+        return rows[0][0]
+
+    def count_published_posts(self, since):
+        """ Returns the most posts that any account has published since a time. """
+
+        rows = self.query("SELECT max(posts) FROM (SELECT count(*) AS posts "
+                          "FROM publications WHERE published_at >= ? "
+                          "GROUP BY user_id)", (since,))
+        return rows[0][0] or 0
+
+    def record_publications(self, media_ids, now):
+        """ Stores media published at the given timestamp.
+
+        Media ids are given as a dictionary keyed by user id.
+        """
+
+        sql = ("INSERT INTO publications (user_id, media_id, published_at) "
+               "VALUES (?, ?, ?)")
+        with metrics.span('db_query', statement='insert'):
+            with self.lock, self.con:
+                self.con.executemany(sql, ((str(user_id), str(media_id), now)
+                                           for user_id, media_id in media_ids.items()))
+
+    def defer_post(self, date, attempts, next_attempt_at, error):
+        """ Schedules another attempt of a failed post. """
+
+        self.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ?, "
+                     "last_error = ? WHERE date = ?",
+                     (attempts, next_attempt_at, error, str(date)))
+
+    def mark_post_published(self, date, now):
+        """ Marks a post as published at the given timestamp. """
+
+        self.execute("UPDATE outbox SET status = 'published', published_at = ?, "
+                     "last_error = NULL WHERE date = ?", (now, str(date)))
+
+    def fail_post(self, date, error):
+        """ Marks a post that can never be published as failed. """
+
+        self.execute("UPDATE outbox SET status = 'failed', last_error = ? "
+                     "WHERE date = ?", (error, str(date)))
+
     def update_media_id(self, media_id, date):
         """ Updates IG Media id to post entry after it is published. """
 
         # Update media id where date matches.
         sql = ("UPDATE posts SET id = ? WHERE date = ?")
-        self.cur.execute(sql, (media_id, date))
-        # Commit changes.
-        self.con.commit()
+        self.execute(sql, (media_id, str(date)))
 
     def get_all(self):
-        """ Prints the whole posts table. """
+        """ Returns the whole posts table. """
 
-        sql = ("SELECT * FROM posts")
-        # Print every row
-        for row in self.cur.execute(sql):
-            logger.info(row)
+        rows = self.query("SELECT * FROM posts ORDER BY date")
+        logger.info("Posts table has " + str(len(rows)) + " entries.")
+        for row in rows:
+            logger.debug(row)
+        return rows
 
     def is_first_post(self):
         """ Returns boolean value telling if there are post entries in the table."""
 
         if self.check_if_exists():
-            # Select count of dates from the posts table.
-            sql = ("SELECT count(date) FROM posts")
-            self.cur.execute(sql)
-            # If count is zero, table has no entries.
-            if self.cur.fetchone()[0] == 0:
-                logger.info("Table has entries.")
+            # Check if there is any row in the posts table.
+            rows = self.query("SELECT EXISTS (SELECT 1 FROM posts)")
+            # If there is none, table has no entries.
+            if rows[0][0] == 0:
+                logger.info("Table has no entries.")
                 return True
             else:
                 return False
@@ -93,14 +447,46 @@ class DatabaseHandler:
     def get_post_by_date(self, date):
         """ Returns the media id of post by date. """
 
-        sql = ("SELECT id FROM posts WHERE date = ?")
-        # Execute query.
-        self.cur.execute(sql, (date,))
-        try:
-            # Get first result.
-            media_id = self.cur.fetchone()[0]
-            # Return result.
-            return media_id
-        except TypeError as ex:
-            logger.error("Post not found by given date.")
-            return None
+        rows = self.query("SELECT id FROM posts WHERE date = ?", (str(date),))
+        if rows:
+            return rows[0][0]
+        logger.error("Post not found by given date.")
+        return None
+
+    def get_water_amount(self, date):
+        """ Returns the voted water amount of post by date. """
+
+        rows = self.query("SELECT water_amount FROM posts WHERE date = ?",
+                          (str(date),))
+        if rows and rows[0][0] is not None:
+            return rows[0][0]
+        logger.error("Water amount not found by given date.")
+        return None
+
+    def get_posts_between(self, start_date, end_date):
+        """ Returns posts from start date to end date, both inclusive. """
+
+        sql = ("SELECT id, date, water_amount, vote_count FROM posts "
+               "WHERE date BETWEEN ? AND ? ORDER BY date")
+        rows = self.query(sql, (str(start_date), str(end_date)))
+        return [self.post_to_dict(row) for row in rows]
+
+    def get_history(self, limit=30, before=None):
+        """ Returns at most limit latest posts, optionally before a date. """
+
+        if before is None:
+            sql = ("SELECT id, date, water_amount, vote_count FROM posts "
+                   "ORDER BY date DESC LIMIT ?")
+            rows = self.query(sql, (limit,))
+        else:
+            sql = ("SELECT id, date, water_amount, vote_count FROM posts "
+                   "WHERE date < ? ORDER BY date DESC LIMIT ?")
+            rows = self.query(sql, (str(before), limit))
+        return [self.post_to_dict(row) for row in rows]
+
+    @staticmethod
+    def post_to_dict(row):
+        """ Converts a posts row into a dictionary. """
+
+        return {'id': row[0], 'date': row[1],
+                'water_amount': row[2], 'vote_count': row[3]}
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+import threading
+import time
+import zlib
+import struct
+from logzero import logger
+from mp4_container import Mp4Reader
+
+
+# Fixture video that is replayed by default.
+FIXTURE_PATH = str(Path(__file__).resolve().parent.parent) + "/videos/test.mp4"
+
+
+def read_fixture_frames(path):
+    """ Returns the fixture as a list of H.264 Annex B frames.
+
+    MP4 fixtures are split into samples. Raw .h264 fixtures are
+    returned as a single piece.
+    """
+
+    if path.endswith(".h264"):
+        return [Path(path).read_bytes()]
+    return list(Mp4Reader(path).iterate_annexb())
+
+
+def create_png(width, height):
+    """ Returns a grey PNG image of the given size. """
+
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    row = b'\x00' + b'\x80' * width * 3
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+
+class FakeCamera:
+    """ Stand-in for picamera.PiCamera that replays a recorded video.
+
+    Frames of the fixture are written into the recording output at the
+    fixture framerate, or as fast as possible when realtime is False.
+    """
+
+    def __init__(self, fixture_path=FIXTURE_PATH, realtime=True):
+        self.fixture_path = fixture_path
+        self.realtime = realtime
+        self.resolution = (1296, 730)
+        self.framerate = 30
+        self.frames = None
+        self.recording = None
+        self.stop_event = threading.Event()
+
+    def start_recording(self, output, format=None, motion_output=None,
+                        intra_period=None):
+        """ Starts writing fixture frames into the output in a thread.
+
+        Motion vectors are not simulated and fixture frames are replayed
+        as they are, so motion output and intra period are ignored.
+        """
+
+        if self.frames is None:
+            self.frames = read_fixture_frames(self.fixture_path)
+        self.stop_event.clear()
+        self.recording = threading.Thread(target=self.replay, args=(output,),
+                                          daemon=True)
+        self.recording.start()
+
+    def replay(self, output):
+        """ Writes fixture frames into output until recording is stopped. """
+
+        file = open(output, 'wb') if isinstance(output, str) else output
+        try:
+            interval = 1 / float(self.framerate)
+            next_frame = time.monotonic()
+            # Fixture is looped if recording lasts longer than it.
+            while not self.stop_event.is_set():
+                for frame in self.frames:
+                    if self.stop_event.is_set():
+                        break
+                    file.write(frame)
+                    if self.realtime:
+                        next_frame += interval
+                        self.stop_event.wait(max(0, next_frame - time.monotonic()))
+                if not self.realtime:
+                    break
+        finally:
+            if file is not output:
+                file.close()
+
+    def wait_recording(self, timeout=0):
+        """ Waits for the given time while recording. """
+
+        self.stop_event.wait(timeout)
+
+    def stop_recording(self):
+        """ Stops recording and waits until all frames are written. """
+
+        self.stop_event.set()
+        if self.recording:
+            self.recording.join()
+            self.recording = None
+        logger.info("Fake camera stopped recording.")
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def capture(self, output, format=None, **options):
+        """ Writes a grey image of the camera resolution. """
+
+        data = create_png(*self.resolution)
+        if isinstance(output, str):
+            Path(output).write_bytes(data)
+        else:
+            output.write(data)
+
+    def close(self):
+        self.stop_recording()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import hashlib
+import itertools
+import re
+from fake_server import FakeServer
+
+
+# Matches the boundary parameter of a multipart content type.
+BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?')
+
+
+class FakeFileHost(FakeServer):
+    """ Local stand-in for File.io.
+
+    Uploaded files are kept in memory and can be downloaded from the
+    returned link.
+    """
+
+    name = "Fake file host"
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.files = dict()
+        self.keys = itertools.count(1)
+
+    def handle(self, method, parts, params, request):
+        """ Stores uploaded files and serves them back. """
+
+        if method == "POST" and not parts:
+            match = BOUNDARY_PATTERN.search(request.headers.get('Content-Type', ''))
+            if not match:
+                return 400, {'success': False, 'message': "Expected multipart body"}
+            data = self.extract_file(request.read_body(), match.group(1).encode())
+            if data is None:
+                return 400, {'success': False, 'message': "File not found in body"}
+            with self.lock:
+                key = "file" + str(next(self.keys))
+                self.files[key] = data
+            return 200, {'success': True, 'status': 200, 'key': key,
+                         'size': len(data),
+                         'sha1': hashlib.sha1(data).hexdigest(),
+                         'link': self.base_path + key}
+        if method == "GET" and len(parts) == 1 and parts[0] in self.files:
+            return 200, self.files[parts[0]], "video/mp4"
+        return 404, {'success': False, 'message': "Not found"}
+
+    @staticmethod
+    def extract_file(body, boundary):
+        """ Returns contents of the first file part of a multipart body. """
+
+        delimiter = b"--" + boundary
+        for part in body.split(delimiter)[1:]:
+            headers, separator, content = part.partition(b"\r\n\r\n")
+            if separator and b"filename=" in headers:
+                # Part ends with a line break before the next delimiter.
+                return content[:-2] if content.endswith(b"\r\n") else content
+        return None
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from logzero import logger
+
+
+class FakePWM:
+    """ Stand-in for RPi.GPIO.PWM that records duty cycle changes. """
+
+    def __init__(self, gpio, channel, frequency):
+        self.gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.gpio.record('pwm', self.channel, duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self, *args):
+        self.ChangeDutyCycle(0)
+
+
+class FakeGPIO:
+    """ Stand-in for the RPi.GPIO module.
+
+    Pin and PWM changes are recorded with monotonic timestamps, so the
+    behaviour of the pump can be inspected without a Raspberry Pi.
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = True
+    LOW = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.pins = dict()
+        # Recorded changes as (timestamp, kind, channel, value) tuples.
+        self.events = []
+
+    def record(self, kind, channel, value):
+        with self.lock:
+            self.events.append((time.monotonic(), kind, channel, value))
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, initial=False):
+        self.pins[channel] = initial
+
+    def output(self, channel, value):
+        self.pins[channel] = bool(value)
+        self.record('output', channel, bool(value))
+
+    def input(self, channel):
+        return self.pins.get(channel, False)
+
+    def PWM(self, channel, frequency):
+        return FakePWM(self, channel, frequency)
+
+    def cleanup(self, *args):
+        logger.debug("Fake GPIO cleaned up.")
+        self.pins = dict()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+from urllib.parse import urlsplit, parse_qs, urlencode
+from collections import deque
+import itertools
+import json
+import re
+import time
+from fake_server import FakeServer
+
+
+# Matches the Graph API version segment of a request path.
+VERSION_PATTERN = re.compile(r"^v[0-9]+\.[0-9]+$")
+# Matches references to results of named batch sub-requests.
+RESULT_PATTERN = re.compile(r"\{result=([^:]+):(\$[^}]*)\}")
+# Graph API counts calls over a sliding window of one hour.
+USAGE_WINDOW = 60 * 60
+
+
+class FakeGraphApi(FakeServer):
+    """ Local stand-in for the parts of Instagram Graph API used by the app.
+
+    Media containers report IN_PROGRESS until container_delay seconds have
+    passed since their creation, so publishing with different processing
+    times can be simulated. If call_limit is given, calls of the last
+    hour are reported in X-App-Usage headers and calls over the limit
+    are rejected with a throttling error. Comments can be a list shared
+    by every post or a dictionary of lists keyed by media id.
+    """
+
+    name = "Fake Graph API"
+
+    def __init__(self, container_delay=0.0, comments=None, call_limit=None,
+                 **options):
+        super().__init__(**options)
+        self.container_delay = container_delay
+        self.call_limit = call_limit
+        # Monotonic times of the calls of the last hour.
+        self.calls = deque()
+        self.comments = comments if comments is not None else []
+        self.page_id = "1000"
+        self.page_name = "plant"
+        self.user_id = "2000"
+        self.containers = dict()
+        self.published = dict()
+        self.requests = []
+        self.ids = itertools.count(3000)
+
+    def next_id(self):
+        """ Returns a new object id. """
+
+        with self.lock:
+            return str(next(self.ids))
+
+    def handle(self, method, parts, params, request=None):
+        """ Routes request to a response. Returns status code and data. """
+
+        if request is not None:
+            params.update({key: values[-1] for key, values
+                           in parse_qs(request.read_body().decode()).items()})
+        # Version segment is optional.
+        if parts and VERSION_PATTERN.match(parts[0]):
+            parts = parts[1:]
+        with self.lock:
+            self.requests.append((method, "/".join(parts), params))
+        if request is not None and not self.count_call():
+            return 403, self.error(4, "Application request limit reached")
+        if method == "POST" and not parts and 'batch' in params:
+            return 200, self.handle_batch(json.loads(params['batch']))
+        if method == "GET" and parts == ["me", "accounts"]:
+            return 200, {'data': [{'id': self.page_id, 'name': self.page_name}]}
+        if method == "GET" and parts == [self.page_id]:
+            return 200, {'id': self.page_id,
+                         'instagram_business_account': {'id': self.user_id}}
+        if method == "POST" and len(parts) == 2 and parts[1] == "media":
+            creation_id = self.next_id()
+            with self.lock:
+                self.containers[creation_id] = time.monotonic()
+            return 200, {'id': creation_id}
+        if method == "POST" and len(parts) == 2 and parts[1] == "media_publish":
+            creation_id = params.get('creation_id', '')
+            status = self.container_status(creation_id)
+            if status is None:
+                return 400, self.error(100, "Invalid creation id")
+            if status != 'FINISHED':
+                return 400, self.error(9007, "Media is not ready for publishing")
+            with self.lock:
+                if creation_id not in self.published:
+                    self.published[creation_id] = str(next(self.ids))
+                return 200, {'id': self.published[creation_id]}
+        if method == "GET" and len(parts) == 2 and parts[1] == "comments":
+            return 200, self.comment_page(parts[0], params)
+        if method == "GET" and len(parts) == 1:
+            status = self.container_status(parts[0])
+            if status is not None:
+                return 200, {'id': parts[0], 'status_code': status}
+        return 404, self.error(803, "Unknown path")
+
+    def count_call(self):
+        """ Records a call and returns False if it is over the call limit. """
+
+        if self.call_limit is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            while self.calls and self.calls[0] < now - USAGE_WINDOW:
+                self.calls.popleft()
+            if len(self.calls) >= self.call_limit:
+                return False
+            self.calls.append(now)
+            return True
+
+    def usage_percent(self):
+        with self.lock:
+            return min(100, len(self.calls) * 100 // self.call_limit)
+
+    def response_headers(self):
+        if self.call_limit is None:
+            return dict()
+        percent = self.usage_percent()
+        return {'X-App-Usage': json.dumps({'call_count': percent, 'total_time': 0,
+                                           'total_cputime': 0})}
+
+    def handle_batch(self, batch):
+        """ Runs sub-requests of a batch request in order. """
+
+        named = dict()
+        responses = []
+        for item in batch:
+            # Replace references to results of earlier sub-requests.
+            try:
+                url = RESULT_PATTERN.sub(
+                    lambda match: str(self.resolve(named[match.group(1)],
+                                                   match.group(2))),
+                    item['relative_url'])
+            except (KeyError, IndexError, TypeError):
+                responses.append(None)
+                continue
+            url = urlsplit(url)
+            params = {key: values[-1]
+                      for key, values in parse_qs(url.query).items()}
+            params.update({key: values[-1] for key, values
+                           in parse_qs(item.get('body', '')).items()})
+            parts = [part for part in url.path.split("/") if part]
+            status, data = self.handle(item.get('method', 'GET'), parts, params)
+            if 'name' in item:
+                named[item['name']] = data
+            responses.append({'code': status, 'body': json.dumps(data)})
+        return responses
+
+    @staticmethod
+    def resolve(data, path):
+        """ Returns the value at a simple JSONPath like $.data.0.id. """
+
+        for key in path.split(".")[1:]:
+            data = data[int(key)] if isinstance(data, list) else data[key]
+        return data
+
+    def container_status(self, creation_id):
+        """ Returns the simulated status of a media container. """
+
+        with self.lock:
+            created = self.containers.get(creation_id)
+        if created is None:
+            return None
+        if time.monotonic() - created < self.container_delay:
+            return 'IN_PROGRESS'
+        return 'FINISHED'
+
+    def comment_page(self, media_id, params):
+        """ Returns a page of comments with a cursor to the next page. """
+
+        comments = self.comments
+        if isinstance(comments, dict):
+            comments = comments.get(media_id, [])
+        limit = int(params.get('limit', 25))
+        offset = int(params.get('after', 0))
+        data = comments[offset:offset + limit]
+        page = {'data': data}
+        if offset + limit < len(comments):
+            query = dict(params, after=str(offset + limit))
+            page['paging'] = {'next': self.base_path + media_id +
+                              "/comments?" + urlencode(query)}
+        return page
+
+    @staticmethod
+    def error(code, message):
+        """ Returns a Graph API error body. """
+
+        return {'error': {'message': message, 'type': 'OAuthException',
+                          'code': code}}
+
+    def error_response(self):
+        return self.error(2, "Service temporarily unavailable")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import json
+import random
+import threading
+import time
+from logzero import logger
+
+
+class FakeServer:
+    """ Base class for local stand-ins of the web services used by the app.
+
+    Every response is delayed by latency seconds and a share of requests
+    given by error_rate is answered with error_status, so slow and flaky
+    services can be simulated. Subclasses override handle().
+    """
+
+    name = "Fake server"
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=500,
+                 host="127.0.0.1", port=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Amount of errors that are injected to the next requests.
+        self.failures_left = 0
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_path(self):
+        """ Base url of the server with a trailing slash. """
+
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/"
+
+    def start(self):
+        """ Starts serving requests in a background thread. """
+
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        logger.info(self.name + " listening at " + self.base_path)
+        return self
+
+    def stop(self):
+        """ Stops the server. """
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail_next(self, count=1):
+        """ Makes the next count requests fail with error status. """
+
+        with self.lock:
+            self.failures_left += count
+
+    def should_fail(self):
+        """ Decides if the current request gets an injected error. """
+
+        with self.lock:
+            if self.failures_left > 0:
+                self.failures_left -= 1
+                return True
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def handle(self, method, parts, params, request):
+        """ Returns status code and JSON data or (status, bytes, type).
+
+        Subclasses route requests to their responses. Base server knows
+        no paths, so it only injects errors and otherwise responds 404.
+        """
+
+        return 404, {'error': {'message': "Unknown path", 'code': 404}}
+
+    def response_headers(self):
+        """ Returns extra headers of every response. """
+
+        return dict()
+
+    def error_response(self):
+        """ Returns body of an injected error response. """
+
+        return {'error': {'message': "Injected error", 'code': 1}}
+
+    def create_handler(self):
+        """ Creates request handler class bound to this server. """
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections like real services.
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, so small responses
+            # would otherwise wait for the delayed ACK of the client.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def respond(self, method):
+                url = urlsplit(self.path)
+                params = {key: values[-1]
+                          for key, values in parse_qs(url.query).items()}
+                parts = [part for part in url.path.split("/") if part]
+                self.body_left = int(self.headers.get('Content-Length') or 0)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.should_fail():
+                    self.discard_body()
+                    result = (fake.error_status, fake.error_response())
+                else:
+                    result = fake.handle(method, parts, params, self)
+                self.discard_body()
+                if len(result) == 3:
+                    status, body, content_type = result
+                else:
+                    status, data = result
+                    body, content_type = json.dumps(data).encode(), "application/json"
+                self.send_response(status)
+                for name, value in fake.response_headers().items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_body(self, size=None):
+                """ Returns at most size bytes of unread request body. """
+
+                size = self.body_left if size is None else min(size, self.body_left)
+                data = self.rfile.read(size) if size else b''
+                self.body_left -= len(data)
+                return data
+
+            def discard_body(self):
+                """ Reads unread request body so the connection can be reused. """
+
+                while self.body_left > 0:
+                    if not self.read_body(65536):
+                        break
+
+            def log_message(self, format, *args):
+                logger.debug(fake.name + ": " + format % args)
+
+        return Handler
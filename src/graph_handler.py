@@ -1,15 +1,37 @@
 #!/usr/bin/env python3
 
 import time
-import requests
+import random
 from logzero import logger
 import json
-from pathlib import Path
-import sys
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from http_client import get_client, HttpStatusError
+from graph_throttler import (get_throttler, PRIORITY_DEFAULT, PRIORITY_POLL,
+                             PRIORITY_PUBLISH)
+from account_registry import ACCOUNT_CONFIG_PATH, get_registry
+from metrics import metrics
+from urllib.parse import urlencode
 
 
-# Account configuration file path
-ACCOUNT_CONFIG_PATH = str(Path().resolve()) + "/account_configuration/"
+# Amount of comments requested per page. Graph API caps this at 100.
+COMMENT_PAGE_SIZE = 100
+# Only the comment fields that are needed for vote counting.
+COMMENT_FIELDS = "id,text,timestamp,username,from"
+# Maximum amount of sub-requests in a Graph API batch request.
+BATCH_MAX_SIZE = 50
+# Delays in seconds between media container status polls.
+CONTAINER_POLL_INITIAL_DELAY = 1.0
+CONTAINER_POLL_MAX_DELAY = 15.0
+CONTAINER_POLL_BACKOFF = 1.5
+
+
+def relative_url(path, params=None):
+    """ Returns a relative url for a batch sub-request. """
+
+    if not params:
+        return path
+    return path + "?" + urlencode(params, safe=',{}=:$')
+
 
 """ Class to handle calls to Instagram Graph API """
 
@@ -20,122 +42,228 @@ class GraphHandler:
         self.args = args
         self.info = dict()
         self.base_url = args.graph_api_base_path + args.graph_api_version
-
-    def get_account_info(self):
-        """ Fetches account information for the account. """
-
-        logger.info("Fetching account information from Graph API.")
-        # Setting extra fields for info dict
-        self.info['account'] = []
-        # Creating payload
-        payload = {'access_token': self.args.graph_api_access_token}
-        # Setting url to fetch information about current Graph API user
-        url = self.base_url + 'me/accounts'
-        # Sending request
-        resp = requests.get(url, params=payload)
-
-        # Checking that status is OK
-        if resp.status_code == 200:
-            resp_data = resp.json()
-            # Making sure response data contains data key
-            if "data" in resp_data:
-                # Processing every account
-                for account in resp_data['data']:
-                    # Combining name and page ID into dict
-                    account_dict = {'page_id': account['id']}
-                    # Pushing dict into account info
-                    self.info['account'].append(account_dict)
-        else:
-            logger.error(resp.json())
-            sys.exit(0)
-
-    def get_business_user_id(self):
-        """ Gets Instagram Business User identifier"""
-
-        logger.info("Querying business account user identifier.")
-        if self.info['account']:
-            # Setting payload to fetch Instagram business account id
-            payload = {'access_token': self.args.graph_api_access_token,
-                       'fields': 'instagram_business_account'}
-
-            account = self.info['account'][0]
-            url = self.base_url + account['page_id']
-            logger.info('Sending GET request to url: ' + url)
-            # Sending request
-            resp = requests.get(url, params=payload)
-
-            if resp.status_code == 200:
-                resp_data = resp.json()
-                if 'instagram_business_account' in resp_data:
-                    logger.info(
-                        "Received user id " + resp_data['instagram_business_account']['id'])
-                    # Setting the received IG user id to the account's dict
-                    account['user_id'] = resp_data['instagram_business_account']['id']
-
-    def create_configuration_files(self):
-        """ Creates/updates configuration files for the Instagram account. """
+        # Shared client keeps connections to Graph API alive between requests.
+        self.client = get_client()
+        # Shared throttler paces requests by the quota usage of the app.
+        self.throttler = get_throttler()
+        # Shared registry keeps account configurations in memory.
+        self.registry = get_registry(ACCOUNT_CONFIG_PATH, args.discovery_cache_ttl)
+
+    def graph_request(self, method, url, bucket, account=None,
+                      priority=PRIORITY_DEFAULT, **kwargs):
+        """ Sends a Graph API request when the throttler allows it.
+
+        Requests are paced per account and bucket, which names the kind
+        of request, and quota usage is read from the response.
+        """
+
+        raise_for_status = kwargs.pop('raise_for_status', False)
+        self.throttler.acquire(account, bucket, priority)
+        resp = self.client.request(method, url, **kwargs)
+        # Throttling errors are recorded before they are raised.
+        self.throttler.update(account, resp)
+        if raise_for_status and not resp.ok:
+            raise HttpStatusError.from_response(resp)
+        return resp
+
+    def create_configuration_files(self, refresh=False):
+        """ Creates/updates configuration files for the Instagram account.
+
+        Cached account information is used unless refresh is True.
+        """
 
         logger.info("Creating configuration file.")
         # Calling function that creates dictionary of user info
-        self.set_up_info()
+        self.set_up_info(refresh)
 
-        if self.info and 'account' in self.info:
+        if self.info and self.info.get('account'):
             account = self.info['account'][0]
-            # Constructing file name
-            file_name = ACCOUNT_CONFIG_PATH + account['user_id'] + ".json"
-            # If configuration file for the specific account already exists,
-            # open in r+ mode to avoid overwriting.
-            if Path(file_name).is_file():
-                conf_file = open(file_name, 'r+')
-                conf_data = json.load(conf_file)
-                # Updating name, since only it can be changed.
-                conf_data['name'] = account['name']
-                # Moving pointer back to the beginning of the file.
-                conf_file.seek(0)
-                # Writing updated values
-                json.dump(conf_data, conf_file, indent=4)
+            conf_data = self.registry.get_account(account['user_id'])
+            # If configuration for the specific account already exists,
+            # only the name is updated, since only it can be changed.
+            if conf_data is not None:
+                conf_data = dict(conf_data, name=account['name'])
             else:
-                conf_file = open(file_name, 'w')
-                account['hashtags'] = []
-                account['caption'] = []
-                json.dump(account, conf_file, indent=4)
-            # Closing file
-            conf_file.close()
-
-    def set_up_info(self):
-        """ Fetches information needed for API calls and post publishing """
-
-        self.get_account_info()
-        self.get_business_user_id()
-
-    def start_posting_process(self, video_url):
-        """ Starts the process of posting the watering video."""
-
-        # Read configuration file into memory
-        for p in Path(ACCOUNT_CONFIG_PATH).glob('*.json'):
-            # Loading account configuration data into dictionary
-            acc_data = json.loads(p.read_text())
-            # Setting flag to ensure that required information exists.
-            post_valid = True
-            # Creating temporary dict to store individual post related information
-            post_data = dict()
-            post_data['user_id'] = acc_data['user_id']
-            logger.info("Starting posting process.")
-            post_data['video_url'] = video_url
-            post_data['media_type'] = "VIDEO"
-            # Constructing caption for the post.
-            post_data['caption'] = self.construct_caption(acc_data)
-
-            # If post is valid, creating media container.
-            if post_valid:
-                return self.create_media_container(post_data)
+                conf_data = dict(account, hashtags=[], caption=[])
+            self.registry.save_account(conf_data)
+
+    def set_up_info(self, refresh=False):
+        """ Fetches information needed for API calls and post publishing.
+
+        Page and business user identifiers are discovered in a single
+        batch request, unless they are found in the discovery cache.
+        """
+
+        cached = None if refresh else self.registry.get_discovery()
+        if cached is not None:
+            logger.info("Using cached account information.")
+            self.info = cached
+            return
+
+        logger.info("Discovering account information with a batch request.")
+        (code, accounts), (_, business) = self.send_batch([
+            {'relative_url': relative_url('me/accounts', {'fields': 'id,name'}),
+             'name': 'accounts'},
+            {'relative_url': relative_url('{result=accounts:$.data.0.id}',
+                                          {'fields': 'instagram_business_account'})}])
+        if code != 200:
+            logger.error(accounts)
+            raise HttpStatusError("Account discovery failed.",
+                                  self.base_url + 'me/accounts', code, accounts)
+        self.info['account'] = [{'page_id': account['id'], 'name': account.get('name')}
+                                for account in accounts.get('data', [])]
+        if self.info['account'] and business and 'instagram_business_account' in business:
+            logger.info(
+                "Received user id " + business['instagram_business_account']['id'])
+            self.info['account'][0]['user_id'] = business['instagram_business_account']['id']
+            self.registry.set_discovery(self.info)
+
+    def send_batch(self, batch_requests, priority=PRIORITY_DEFAULT, accounts=None):
+        """ Sends several sub-requests to Graph API in a single request.
+
+        Sub-requests are dictionaries with relative_url and optional
+        method, name and body. Later sub-requests can refer to results of
+        named ones with JSONPath, e.g. "{result=accounts:$.data.0.id}".
+        Returns (status code, data) tuples in sub-request order. Tuple is
+        (None, None) for sub-requests that were not run. Batch counts
+        against the quota of the given user ids, or only of the app.
+        """
+
+        if len(batch_requests) > BATCH_MAX_SIZE:
+            raise ValueError("Batch can contain at most " +
+                             str(BATCH_MAX_SIZE) + " requests.")
+        batch = []
+        for sub_request in batch_requests:
+            item = {'method': sub_request.get('method', 'GET'),
+                    'relative_url': sub_request['relative_url']}
+            if 'name' in sub_request:
+                item['name'] = sub_request['name']
+                # Results of named requests are returned too.
+                item['omit_response_on_success'] = False
+            if 'body' in sub_request:
+                item['body'] = urlencode(sub_request['body'])
+            batch.append(item)
+        payload = {'access_token': self.args.graph_api_access_token,
+                   'batch': json.dumps(batch),
+                   'include_headers': 'false'}
+        logger.info("Sending batch of " + str(len(batch)) + " requests.")
+        resp = self.graph_request("POST", self.base_url, 'batch', accounts,
+                                  priority, endpoint='graph', data=payload,
+                                  raise_for_status=True)
+
+        results = []
+        for item in resp.json():
+            if item is None:
+                results.append((None, None))
+                continue
+            try:
+                data = json.loads(item.get('body') or 'null')
+            except ValueError:
+                data = item.get('body')
+            results.append((item.get('code'), data))
+        return results
+
+    def start_posting_process(self, video_url, caption=None, creation_ids=None,
+                              on_created=None, published=()):
+        """ Starts the process of posting the watering video to every account.
+
+        Media containers of all accounts are created with one batch
+        request and published concurrently. Caption replaces the captions
+        of account configurations if given. Returns a dictionary of
+        publishing results keyed by user id in account configuration order.
+
+        Interrupted posting can be resumed: accounts in published are
+        skipped and containers in creation_ids, keyed by user id, are
+        published without creating them again. New creation ids are given
+        to on_created before publishing starts.
+        """
+
+        logger.info("Starting posting process.")
+        accounts = [acc_data for acc_data in self.load_account_configurations()
+                    if acc_data['user_id'] not in published]
+        results = dict.fromkeys(acc_data['user_id'] for acc_data in accounts)
+        if not accounts:
+            if published:
+                logger.info("Video is already posted to every account.")
             else:
-                logger.warning("Skipping publishing video.")
+                logger.warning("No account configurations found.")
+            return results
+
+        creation_ids = {user_id: creation_id for user_id, creation_id in
+                        (creation_ids or dict()).items()
+                        if user_id in results and creation_id}
+        posts = [self.build_post_data(acc_data, video_url, caption)
+                 for acc_data in accounts if acc_data['user_id'] not in creation_ids]
+        if posts and video_url:
+            created = self.create_media_containers(posts)
+            if on_created:
+                on_created(created)
+            creation_ids.update(created)
+        elif posts:
+            logger.warning("Video url is needed to create media containers.")
+        workers = max(1, min(len(accounts), self.args.posting_workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.publish_video, creation_id, user_id): user_id
+                       for user_id, creation_id in creation_ids.items() if creation_id}
+            for future in as_completed(futures):
+                user_id = futures[future]
+                try:
+                    results[user_id] = future.result()
+                except Exception as ex:
+                    logger.warning("Posting failed for account " + user_id + ".")
+                    logger.exception(ex)
+        return results
+
+    def load_account_configurations(self):
+        """ Returns configurations of every account. """
+
+        return self.registry.get_accounts()
+
+    def build_post_data(self, acc_data, video_url, caption=None):
+        """ Creates dictionary of information needed to post to one account. """
+
+        post_data = dict()
+        post_data['user_id'] = acc_data['user_id']
+        post_data['video_url'] = video_url
+        post_data['media_type'] = "VIDEO"
+        # Constructing caption for the post.
+        post_data['caption'] = self.construct_caption(acc_data, caption)
+        return post_data
+
+    def create_media_containers(self, posts):
+        """ Creates media containers for several posts in batch requests.
+
+        Returns a dictionary of creation ids keyed by user id. Creation id
+        is None for failed containers.
+        """
+
+        logger.info("Creating " + str(len(posts)) + " Instagram media containers.")
+        creation_ids = dict()
+        for start in range(0, len(posts), BATCH_MAX_SIZE):
+            chunk = posts[start:start + BATCH_MAX_SIZE]
+            results = self.send_batch([
+                {'method': 'POST', 'relative_url': post_data['user_id'] + '/media',
+                 'body': {'media_type': post_data['media_type'],
+                          'video_url': post_data['video_url'],
+                          'caption': post_data['caption']}}
+                for post_data in chunk], PRIORITY_PUBLISH,
+                [post_data['user_id'] for post_data in chunk])
+            for post_data, (code, data) in zip(chunk, results):
+                if code == 200 and data and 'id' in data:
+                    creation_ids[post_data['user_id']] = data['id']
+                else:
+                    logger.warning("Creation of media container failed for account " +
+                                   post_data['user_id'] + ".")
+                    logger.info(data)
+                    creation_ids[post_data['user_id']] = None
+        return creation_ids
 
-    def construct_caption(self, acc_data):
+    def construct_caption(self, acc_data, caption=None):
         """ Constructs post caption from multiple strings. """
 
         logger.info("Constructing post caption.")
+        if caption:
+            acc_data = dict(acc_data, caption=[caption])
         caption = ""
         if 'caption' in acc_data and acc_data['caption']:
             caption = ('\n'*2).join(acc_data['caption'])
@@ -149,77 +277,163 @@ class GraphHandler:
 
         return caption
 
-    def create_media_container(self, post_data):
-        """ Creates Instagram media container """
-
-        logger.info("Creating Instagram media container.")
-        # Setting image url and caption to payload
-        payload = {'access_token': self.args.graph_api_access_token,
-                   'media_type': post_data['media_type'],
-                   'video_url': post_data['video_url'],
-                   'caption': post_data['caption']}
-        url = self.base_url + post_data['user_id'] + "/media"
-        logger.info("Sending POST request to url: " + url + "/media")
-        resp = requests.post(url, params=payload)
-
-        if resp.status_code == 200:
-            logger.info("Media container successfully created.")
-            # Getting creation id as the response
-            creation_id = resp.json()['id']
-            # Calling publishing function
-            return self.publish_video(creation_id, post_data['user_id'])
-        else:
-            logger.warning("Creation of media container failed.")
-            logger.info(resp.json())
-
     def publish_video(self, creation_id, user_id):
-        """ Publishes given video to Instagram account. """
+        """ Publishes given video to Instagram account.
 
-        success = False
-        tries_left = 5
-        while not success and tries_left > 0:
+        Media container status is polled and the video is published as
+        soon as Instagram has finished processing it.
+        """
+
+        deadline = time.monotonic() + self.args.publish_deadline
+        delay = CONTAINER_POLL_INITIAL_DELAY
+        while self.wait_for_container(creation_id, deadline, user_id):
             logger.info("Starting publishing process.")
             payload = {'access_token': self.args.graph_api_access_token,
                        'creation_id': creation_id}
             url = self.base_url + user_id + "/media_publish"
-            logger.info("Waiting for 15 seconds before publishing.")
-            time.sleep(15)
             logger.info("Sending POST request to url: " + url)
-            resp = requests.post(url, params=payload)
+            resp = self.graph_request("POST", url, 'publish', user_id,
+                                      PRIORITY_PUBLISH, endpoint='graph_publish',
+                                      params=payload)
             resp_data = resp.json()
 
             if resp.status_code == 200:
                 logger.info("Post successfully published!")
                 return resp_data
-            else:
-                # If error code is 9007, it means that media is still loading.
-                if resp_data['code'] == 9007:
-                    logger.warning(resp_data)
-                    logger.info("Sleeping for 40 seconds and trying again.")
-                    tries_left -= 1
-                    time.sleep(40)
-                else:
-                    logger.warning(
-                        "Response from video publishing query is not OK.")
-                    logger.error(resp_data)
+            # If error code is 9007, it means that media is still loading.
+            elif resp_data.get('error', resp_data).get('code') == 9007:
+                logger.warning(resp_data)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error("Media was not published before deadline.")
                     break
+                logger.info("Media is not ready yet, polling status again.")
+                # Status may already be FINISHED, so publishing is backed
+                # off like polling.
+                time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+                delay = min(delay * CONTAINER_POLL_BACKOFF,
+                            CONTAINER_POLL_MAX_DELAY)
+            else:
+                logger.warning(
+                    "Response from video publishing query is not OK.")
+                logger.error(resp_data)
+                break
+
+    def wait_for_container(self, creation_id, deadline, user_id=None):
+        """ Polls media container status until it is ready to be published.
+
+        Polling interval grows with jitter until the given monotonic
+        deadline. Returns True if the container finished processing.
+        """
+
+        delay = CONTAINER_POLL_INITIAL_DELAY
+        while True:
+            status = self.get_container_status(creation_id, user_id)
+            metrics.increment('container_polls')
+            if status == 'FINISHED':
+                logger.info("Media container is ready.")
+                return True
+            if status in ('ERROR', 'EXPIRED'):
+                logger.error("Media container status is " + status + ".")
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.error("Media container was not ready before deadline.")
+                return False
+            logger.info("Media container status is " + str(status) + ".")
+            time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+            delay = min(delay * CONTAINER_POLL_BACKOFF,
+                        CONTAINER_POLL_MAX_DELAY)
+
+    def get_container_status(self, creation_id, user_id=None):
+        """ Returns the status code of the media container or None. """
 
-    def get_comments_for_post(self, media_id):
-        """ Fetches the comments for the given post. """
+        payload = {'access_token': self.args.graph_api_access_token,
+                   'fields': 'status_code'}
+        url = self.base_url + str(creation_id)
+        resp = self.graph_request("GET", url, 'status', user_id, PRIORITY_PUBLISH,
+                                  endpoint='graph', params=payload)
+        resp_data = resp.json()
+        if resp.ok:
+            return resp_data.get('status_code')
+        else:
+            logger.warning("Could not get media container status.")
+            logger.error(resp_data)
 
-        logger.info("Getting comments for a post.")
-        # Construct url
+    def get_first_comment_pages(self, media_ids):
+        """ Fetches first pages of comments of several posts.
+
+        Pages are fetched with batch requests. Returns a dictionary of
+        (comment data, next page url) tuples keyed by media id. Raises
+        HttpStatusError if a page could not be fetched.
+        """
+
+        logger.info("Getting comments for " + str(len(media_ids)) + " posts.")
+        media_ids = [str(media_id) for media_id in media_ids]
+        pages = dict()
+        query = {'fields': COMMENT_FIELDS, 'limit': COMMENT_PAGE_SIZE}
+        for start in range(0, len(media_ids), BATCH_MAX_SIZE):
+            chunk = media_ids[start:start + BATCH_MAX_SIZE]
+            results = self.send_batch([
+                {'relative_url': relative_url(media_id + '/comments', query)}
+                for media_id in chunk], priority=PRIORITY_POLL)
+            for media_id, (code, data) in zip(chunk, results):
+                if code != 200 or not data or 'data' not in data:
+                    logger.error(data)
+                    raise HttpStatusError("Could not get comments for post " +
+                                          media_id + ".",
+                                          self.base_url + media_id + "/comments",
+                                          code, data)
+                pages[media_id] = (data['data'],
+                                   data.get('paging', {}).get('next'))
+        return pages
+
+    def iterate_comment_pages(self, media_id, first_page=None):
+        """ Yields pages of comments by following the paging cursors.
+
+        The next page is prefetched in a background thread while the
+        caller is still processing the current one. First page can be
+        given as a (comment data, next page url) tuple if it was already
+        fetched with get_first_comment_pages.
+        """
+
+        # Construct url for the first page
         url = self.base_url + str(media_id) + "/comments"
-        payload = {'access_token': self.args.graph_api_access_token}
+        payload = {'access_token': self.args.graph_api_access_token,
+                   'fields': COMMENT_FIELDS,
+                   'limit': COMMENT_PAGE_SIZE}
 
-        resp = requests.get(url, params=payload)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if first_page is None:
+                pending = executor.submit(self.fetch_comment_page, url, payload)
+            else:
+                pending = Future()
+                pending.set_result(first_page)
+            while pending:
+                page, next_url = pending.result()
+                # Next page urls already contain the query parameters.
+                pending = executor.submit(
+                    self.fetch_comment_page, next_url) if next_url else None
+                if page:
+                    yield page
+
+    def fetch_comment_page(self, url, payload=None):
+        """ Fetches a single page of comments.
+
+        Returns a tuple of comment data and url of the next page. Raises
+        HttpStatusError if the page could not be fetched, so that paging
+        does not look finished and the comment cursor is not stored.
+        """
+
+        resp = self.graph_request("GET", url, 'comments', priority=PRIORITY_POLL,
+                                  endpoint='graph', params=payload,
+                                  raise_for_status=True)
 
         resp_data = resp.json()
-        if resp.ok and 'data' in resp_data:
-            logger.info(
-                "API response for comments was ok. Returning comment data.")
-            return resp_data['data']
-        else:
-            logger.warning(
-                "Encountered error when fetching comments for a post.")
+        if 'data' not in resp_data:
             logger.error(resp_data)
+            raise HttpStatusError("Comments page did not contain data.", url,
+                                  resp.status_code, resp_data)
+        logger.info("API response for comments page was ok.")
+        next_url = resp_data.get('paging', {}).get('next')
+        return resp_data['data'], next_url
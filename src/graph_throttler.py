@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+import time
+from logzero import logger
+from http_client import HttpError
+from metrics import metrics
+
+
+# Request priorities, smaller is served first.
+PRIORITY_PUBLISH = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_POLL = 2
+# Usage percentage at which requests of a priority stop. Polling stops
+# first, so that quota is left for publishing.
+USAGE_LIMITS = {PRIORITY_PUBLISH: 95, PRIORITY_DEFAULT: 85, PRIORITY_POLL: 70}
+# Share of the usage limit below which requests are not paced.
+PACING_START = 0.5
+# Requests per second of a bucket when pacing starts and the slowest
+# rate just below the usage limit.
+MAX_RATE = 20.0
+MIN_RATE = 0.2
+# Requests that a bucket can send in a burst.
+BUCKET_CAPACITY = 20
+# Graph API measures usage over a sliding window of one hour.
+USAGE_WINDOW = 60 * 60
+# Error codes of Graph API throttling errors.
+THROTTLING_CODES = frozenset([4, 17, 32, 613, 80001, 80002, 80006])
+# Seconds to stop sending after a throttling error that does not tell
+# when access is regained.
+DEFAULT_BLOCK = 300
+# Longest time in seconds that a request waits for its turn.
+MAX_WAIT = 300
+
+
+class ThrottledError(HttpError):
+    """ Raised when a request would have to wait too long for quota. """
+
+
+class TokenBucket:
+    """ Token bucket whose refill rate can change between requests. """
+
+    def __init__(self, capacity=BUCKET_CAPACITY):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def take(self, rate, now):
+        """ Takes a token and returns 0 or returns seconds until one is left. """
+
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class Usage:
+    """ Latest reported quota usage of the app or an account. """
+
+    def __init__(self):
+        self.percent = 0.0
+        self.reported_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def report(self, percent, regain_seconds=0, now=None):
+        now = time.monotonic() if now is None else now
+        self.percent = float(percent)
+        self.reported_at = now
+        if regain_seconds:
+            self.blocked_until = max(self.blocked_until, now + regain_seconds)
+
+    def current(self, now):
+        """ Returns usage percent decayed linearly since it was reported. """
+
+        elapsed = now - self.reported_at
+        return max(0.0, self.percent * (1 - elapsed / USAGE_WINDOW))
+
+
+def parse_usage_header(value):
+    """ Returns the highest usage percent of an X-App-Usage header. """
+
+    try:
+        usage = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(usage, dict):
+        return None
+    return max([float(usage.get(key) or 0)
+                for key in ('call_count', 'total_time', 'total_cputime')])
+
+
+def parse_business_usage_header(value):
+    """ Returns (percent, seconds until access) of business ids.
+
+    X-Business-Use-Case-Usage header has a list of use cases per
+    business object id. The highest usage of every id is returned.
+    """
+
+    try:
+        usage = json.loads(value)
+    except (TypeError, ValueError):
+        return dict()
+    if not isinstance(usage, dict):
+        return dict()
+    result = dict()
+    for business_id, use_cases in usage.items():
+        percent, regain_seconds = 0.0, 0
+        for use_case in use_cases if isinstance(use_cases, list) else []:
+            percent = max([percent] + [float(use_case.get(key) or 0) for key in
+                                       ('call_count', 'total_time', 'total_cputime')])
+            regain_seconds = max(regain_seconds, 60 * int(
+                use_case.get('estimated_time_to_regain_access') or 0))
+        result[str(business_id)] = (percent, regain_seconds)
+    return result
+
+
+def throttling_error_code(resp):
+    """ Returns the Graph API error code of a throttled response or None. """
+
+    if resp.ok:
+        return None
+    try:
+        code = resp.json().get('error', dict()).get('code')
+    except (ValueError, AttributeError):
+        return None
+    return code if code in THROTTLING_CODES else None
+
+
+def account_keys(account):
+    """ Returns ids of the accounts of a request as strings.
+
+    Batch requests may be sent on behalf of several accounts, and
+    requests without an account only count against the app.
+    """
+
+    if account is None:
+        return []
+    if isinstance(account, (list, tuple, set, frozenset)):
+        return sorted(set(str(account_id) for account_id in account))
+    return [str(account)]
+
+
+class GraphThrottler:
+    """ Paces Graph API requests by the quota usage reported by Graph API.
+
+    Usage is read from X-App-Usage and X-Business-Use-Case-Usage headers
+    of every response. Requests are spread with token buckets per account
+    and endpoint once usage passes half of the limit of the request
+    priority, and their rates drop as usage approaches the limit. Low
+    priority requests such as comment polling stop well before the quota
+    runs out and give way to waiting publishing requests, so that posting
+    never hits a lockout. Throttling errors stop the affected requests
+    until access is regained.
+    """
+
+    def __init__(self, max_wait=MAX_WAIT):
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.buckets = dict()
+        self.app_usage = Usage()
+        self.account_usage = dict()
+        # Amount of waiting requests by priority.
+        self.waiting = dict.fromkeys(USAGE_LIMITS, 0)
+
+    def usage(self, account, now):
+        """ Returns (usage percent, blocked until) of accounts of a request. """
+
+        usages = [self.app_usage] + [self.account_usage.get(key, Usage())
+                                     for key in account_keys(account)]
+        return (max(usage.current(now) for usage in usages),
+                max(usage.blocked_until for usage in usages))
+
+    def delay(self, account, endpoint, priority, now):
+        """ Takes a token and returns 0 or returns seconds to wait.
+
+        Returns None if the request waits for requests of higher priority.
+        """
+
+        percent, blocked_until = self.usage(account, now)
+        if blocked_until > now:
+            return blocked_until - now
+        limit = USAGE_LIMITS[priority]
+        if percent >= limit:
+            # Seconds until the usage has decayed below the limit.
+            return USAGE_WINDOW * (1 - limit / percent) + 1
+        if any(self.waiting[other] for other in self.waiting if other < priority):
+            # Waiting requests notify when they have been sent.
+            return None
+        bucket = self.buckets.setdefault((tuple(account_keys(account)), endpoint),
+                                         TokenBucket())
+        pacing_start = limit * PACING_START
+        if percent < pacing_start:
+            # Spent tokens are still refilled for when pacing starts.
+            bucket.take(MAX_RATE, now)
+            return 0.0
+        rate = MAX_RATE - (MAX_RATE - MIN_RATE) * \
+            (percent - pacing_start) / (limit - pacing_start)
+        return bucket.take(rate, now)
+
+    def acquire(self, account, endpoint, priority=PRIORITY_DEFAULT):
+        """ Waits until a request may be sent.
+
+        Raises ThrottledError if the request would wait longer than
+        max_wait seconds.
+        """
+
+        start = time.monotonic()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self.delay(account, endpoint, priority, now)
+                    if delay is not None and delay <= 0:
+                        break
+                    remaining = start + self.max_wait - now
+                    if delay is None and remaining > 0:
+                        # Waits for a notification for the rest of max_wait.
+                        self.condition.wait(remaining)
+                        continue
+                    if delay is None or delay > remaining:
+                        metrics.increment('graph_throttled', endpoint=endpoint)
+                        raise ThrottledError(
+                            "Graph API quota of " + endpoint + " is used up " +
+                            ("by requests of higher priority." if delay is None
+                             else "for " + str(round(delay)) + " seconds."))
+                    self.condition.wait(delay)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            metrics.observe('graph_throttle_wait', waited, endpoint=endpoint)
+
+    def update(self, account, resp):
+        """ Updates usage from the headers and status of a response. """
+
+        now = time.monotonic()
+        with self.condition:
+            percent = parse_usage_header(resp.headers.get('X-App-Usage'))
+            if percent is not None:
+                self.app_usage.report(percent, now=now)
+            business_usage = parse_business_usage_header(
+                resp.headers.get('X-Business-Use-Case-Usage'))
+            for business_id, (percent, regain_seconds) in business_usage.items():
+                self.account_usage.setdefault(business_id, Usage()).report(
+                    percent, regain_seconds, now)
+            code = throttling_error_code(resp)
+            if code is not None:
+                regain_seconds = max([DEFAULT_BLOCK] + [
+                    regain for _, regain in business_usage.values()])
+                # Code 4 means that the whole app is throttled.
+                usages = [self.app_usage] if code == 4 or account is None else \
+                    [self.account_usage.setdefault(key, Usage())
+                     for key in account_keys(account)]
+                for usage in usages:
+                    usage.blocked_until = max(usage.blocked_until,
+                                              now + regain_seconds)
+                logger.warning("Graph API throttled requests with error code " +
+                               str(code) + ", pausing for " +
+                               str(regain_seconds) + " seconds.")
+                metrics.increment('graph_throttling_errors', code=str(code))
+            # Waiting requests check their delay again.
+            self.condition.notify_all()
+
+
+# Throttler shared by the whole process.
+_throttler = None
+_throttler_lock = threading.Lock()
+
+
+def get_throttler():
+    """ Returns the Graph API throttler shared by the process. """
+
+    global _throttler
+    with _throttler_lock:
+        if _throttler is None:
+            _throttler = GraphThrottler()
+        return _throttler
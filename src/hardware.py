@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+from camera_controller import CameraController
+from pump_controller import PumpController
+from logzero import logger
+
+
+def create_pump_controller(args):
+    """ Creates pump controller for the configured hardware backend.
+
+    The "pi" backend drives the real camera and GPIO pins. The "fake"
+    backend replays a fixture video and records GPIO changes in memory,
+    so the app can run on any Linux machine.
+    """
+
+    if args.hardware_backend == "fake":
+        from fake_camera import FakeCamera
+        from fake_gpio import FakeGPIO
+        logger.info("Using fake camera and GPIO.")
+        camera = FakeCamera(args.fake_video_fixture) if args.fake_video_fixture \
+            else FakeCamera()
+        return PumpController(FakeGPIO(), CameraController(camera))
+    return PumpController()
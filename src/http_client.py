@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from logzero import logger
+from metrics import metrics
+
+
+# Connect and read timeouts in seconds by endpoint type.
+TIMEOUTS = {
+    'default': (3.05, 30),
+    'graph': (3.05, 30),
+    'graph_publish': (3.05, 60),
+    'upload': (5, 300),
+}
+# Amount of connections kept alive per host.
+POOL_SIZE = 10
+# Times an idempotent request or a failed connection attempt is retried.
+RETRIES = 3
+# Backoff factor in seconds between retries.
+RETRY_BACKOFF = 0.5
+# Status codes that are retried for idempotent requests.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpError(Exception):
+    """ Base class for errors of outbound HTTP calls. """
+
+    def __init__(self, message, url=None):
+        super().__init__(message)
+        self.url = url
+
+
+class HttpConnectionError(HttpError):
+    """ Raised when a host could not be reached. """
+
+
+class HttpTimeoutError(HttpConnectionError):
+    """ Raised when a host did not respond in time. """
+
+
+class HttpStatusError(HttpError):
+    """ Raised when a host responds with an error status. """
+
+    def __init__(self, message, url=None, status_code=None, payload=None):
+        super().__init__(message, url)
+        self.status_code = status_code
+        self.payload = payload
+
+    @classmethod
+    def from_response(cls, resp):
+        """ Creates error from an unsuccessful response. """
+
+        try:
+            payload = resp.json()
+        except ValueError:
+            payload = resp.text
+        return cls("HTTP " + str(resp.status_code) + " from " + resp.url,
+                   resp.url, resp.status_code, payload)
+
+
+class HttpClient:
+    """ HTTP client with pooled keep-alive connections and retries.
+
+    Every outbound call of the app goes through a shared client, so that
+    TCP and TLS handshakes are done once per host. Idempotent requests are
+    retried with backoff on connection errors and retryable statuses.
+    Other requests are only retried when the connection could not be made.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES):
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                      raise_on_status=False, respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, endpoint='default', raise_for_status=False,
+                **kwargs):
+        """ Sends a request and returns the response.
+
+        Timeouts are chosen by endpoint type unless given. Network errors
+        are raised as HttpConnectionError and, if raise_for_status is set,
+        error statuses as HttpStatusError.
+        """
+
+        kwargs.setdefault('timeout', TIMEOUTS.get(endpoint, TIMEOUTS['default']))
+        try:
+            with metrics.span('http_request', endpoint=endpoint, method=method):
+                resp = self.session.request(method, url, **kwargs)
+        except requests.exceptions.Timeout as ex:
+            metrics.increment('http_errors', endpoint=endpoint, kind='timeout')
+            raise HttpTimeoutError(str(ex), url) from ex
+        except requests.exceptions.ConnectionError as ex:
+            metrics.increment('http_errors', endpoint=endpoint, kind='connection')
+            raise HttpConnectionError(str(ex), url) from ex
+        # Retries done by urllib3 are recorded in the raw response.
+        retries = getattr(resp.raw, 'retries', None)
+        if retries is not None and retries.history:
+            metrics.increment('http_retries', len(retries.history),
+                              endpoint=endpoint)
+        if not resp.ok:
+            metrics.increment('http_errors', endpoint=endpoint,
+                              kind=str(resp.status_code))
+        if raise_for_status and not resp.ok:
+            raise HttpStatusError.from_response(resp)
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# Client shared by the whole process.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Returns the HTTP client shared by the process. """
+
+    global _client
+    with _client_lock:
+        if _client is None:
+            logger.debug("Creating shared HTTP client.")
+            _client = HttpClient()
+        return _client
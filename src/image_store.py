@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+from datetime import date as date_type, datetime, timedelta
+from fractions import Fraction
+import io
+import os
+import tempfile
+import time
+from logzero import logger
+from metrics import metrics
+
+
+# Encoder settings of supported image formats: file suffix, codec, pixel
+# format and demuxer that reads the format from memory.
+IMAGE_FORMATS = {
+    'jpeg': ('.jpg', 'mjpeg', 'yuvj420p', 'jpeg_pipe'),
+    'webp': ('.webp', 'libwebp', 'yuv420p', 'webp_pipe'),
+    'png': ('.png', 'png', 'rgb24', 'png_pipe'),
+}
+# Width of thumbnails in pixels. Height keeps the aspect ratio.
+THUMBNAIL_WIDTH = 320
+# Suffix added to the date in thumbnail file names.
+THUMBNAIL_SUFFIX = "_thumb"
+
+
+def detect_format(data):
+    """ Returns format of an encoded image by its signature or None. """
+
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data.startswith(b'\x89PNG'):
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def write_file_atomic(path, data):
+    """ Writes data into a file so that readers never see a partial file. """
+
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class ImageStore:
+    """ Archive of daily plant images.
+
+    Images are stored once per date under year and month directories,
+    e.g. images/2022/01/2022-01-11.jpg, next to a thumbnail. Paths are
+    derived from the date, so lookups do not list directories, and an
+    images table in the database links every image to its post. Full
+    size images older than the retention period are deleted while their
+    thumbnails are kept, so disk usage stays bounded.
+    """
+
+    def __init__(self, dbh, root, image_format='jpeg', quality=85,
+                 retention_days=30, thumbnail_retention_days=0):
+        import av
+        self.av = av
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError("Unsupported image format " + image_format + ".")
+        self.dbh = dbh
+        self.root = root
+        self.image_format = image_format
+        self.quality = quality
+        self.retention_days = retention_days
+        self.thumbnail_retention_days = thumbnail_retention_days
+
+    def relative_path(self, date, thumbnail=False, image_format=None):
+        """ Returns path of the image of a date relative to archive root. """
+
+        date = str(date)
+        suffix = IMAGE_FORMATS[image_format or self.image_format][0]
+        name = date + (THUMBNAIL_SUFFIX if thumbnail else "") + suffix
+        return os.path.join(date[:4], date[5:7], name)
+
+    def full_path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    def save(self, date, data, captured_at=None):
+        """ Archives an encoded image of the date and returns its record.
+
+        Image is converted into the archive format if the camera encoded
+        it differently.
+        """
+
+        with metrics.span('image_archive'):
+            source_format = detect_format(data)
+            if source_format is None:
+                raise ValueError("Unknown image format.")
+            frame = self.decode(data, source_format)
+            if source_format != self.image_format:
+                data = self.encode(frame, self.image_format)
+            thumbnail_width = min(THUMBNAIL_WIDTH, frame.width)
+            # Encoders need even dimensions.
+            thumbnail_height = max(2, int(round(
+                frame.height * thumbnail_width / frame.width / 2)) * 2)
+            thumbnail = self.encode(frame, self.image_format,
+                                    thumbnail_width, thumbnail_height)
+            previous = self.dbh.get_image(date)
+            image = {'date': str(date),
+                     'path': self.relative_path(date),
+                     'thumbnail_path': self.relative_path(date, thumbnail=True),
+                     'format': self.image_format, 'size': len(data),
+                     'width': frame.width, 'height': frame.height,
+                     'captured_at': captured_at or time.time()}
+            os.makedirs(os.path.dirname(self.full_path(image['path'])),
+                        exist_ok=True)
+            write_file_atomic(self.full_path(image['path']), data)
+            write_file_atomic(self.full_path(image['thumbnail_path']), thumbnail)
+            self.dbh.set_image(image)
+            # Files of a replaced image in another format are removed.
+            if previous:
+                for key in ('path', 'thumbnail_path'):
+                    if previous[key] and previous[key] != image[key]:
+                        self.remove_file(previous[key])
+        metrics.increment('image_bytes_archived', len(data) + len(thumbnail))
+        logger.info("Archived image of " + str(date) + " as " + image['path'] +
+                    " (" + str(len(data)) + " bytes).")
+        return image
+
+    def get(self, date):
+        """ Returns record of the image of a date or None. """
+
+        return self.dbh.get_image(date)
+
+    def decode(self, data, image_format):
+        """ Returns the first video frame of an encoded image. """
+
+        demuxer = IMAGE_FORMATS[image_format][3]
+        with self.av.open(io.BytesIO(data), format=demuxer) as container:
+            return next(container.decode(video=0))
+
+    def encode(self, frame, image_format, width=None, height=None):
+        """ Returns frame encoded into the format, scaled if size is given. """
+
+        _, codec_name, pixel_format, _ = IMAGE_FORMATS[image_format]
+        frame = frame.reformat(width=width or frame.width,
+                               height=height or frame.height, format=pixel_format)
+        codec = self.av.CodecContext.create(codec_name, 'w')
+        codec.width = frame.width
+        codec.height = frame.height
+        codec.pix_fmt = pixel_format
+        codec.time_base = Fraction(1, 1)
+        if image_format == 'jpeg':
+            # JPEG quantizer scale goes from 2 (best) to 31 (worst).
+            scale = str(int(round(2 + (100 - self.quality) * 29 / 99)))
+            codec.options = {'qmin': scale, 'qmax': scale}
+        elif image_format == 'webp':
+            codec.options = {'quality': str(self.quality)}
+        packets = list(codec.encode(frame)) + list(codec.encode(None))
+        return b''.join(bytes(packet) for packet in packets)
+
+    def apply_retention(self, today=None):
+        """ Deletes images that are older than their retention period.
+
+        Full size images are kept for retention_days and thumbnails for
+        thumbnail_retention_days. Zero keeps files forever.
+        """
+
+        today = today or datetime.now().date()
+        removed = 0
+        for days, key in ((self.retention_days, 'path'),
+                          (self.thumbnail_retention_days, 'thumbnail_path')):
+            if not days:
+                continue
+            for image in self.dbh.get_images_before(today - timedelta(days=days)):
+                if image[key]:
+                    self.remove_file(image[key])
+                    self.dbh.remove_image_files(image['date'], **{key: True})
+                    removed += 1
+        if removed:
+            logger.info("Removed " + str(removed) + " expired image files.")
+        return removed
+
+    def remove_file(self, relative_path):
+        """ Removes a file of the archive if it exists. """
+
+        try:
+            os.remove(self.full_path(relative_path))
+        except FileNotFoundError:
+            pass
+
+    def import_legacy_images(self):
+        """ Moves images named by capture timestamp into the dated layout.
+
+        Earlier versions stored PNG images with a timestamp name directly
+        in the archive root. The latest image of every date is archived
+        and the rest are removed. Returns the amount of archived images.
+        """
+
+        legacy = dict()
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                stem, suffix = os.path.splitext(entry.name)
+                if not entry.is_file() or suffix != '.png':
+                    continue
+                try:
+                    timestamp = float(stem)
+                except ValueError:
+                    continue
+                date = date_type.fromtimestamp(timestamp)
+                legacy.setdefault(date, []).append((timestamp, entry.path))
+        for date, images in sorted(legacy.items()):
+            images.sort()
+            timestamp, path = images[-1]
+            if self.get(date) is None:
+                with open(path, 'rb') as image_file:
+                    self.save(date, image_file.read(), timestamp)
+            for _, path in images:
+                os.remove(path)
+        if legacy:
+            logger.info("Imported legacy images of " + str(len(legacy)) + " dates.")
+        return len(legacy)
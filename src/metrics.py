@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from logzero import logger
+
+
+# Amount of latest durations kept per timer for percentiles.
+TIMER_SAMPLES = 1000
+# Quantiles reported for timers.
+QUANTILES = (0.5, 0.95)
+
+
+def quantile(ordered, q):
+    """ Returns the q quantile of an ordered list. """
+
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def format_labels(labels, **extra):
+    """ Returns labels in Prometheus text format. """
+
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(key + "=\"" + str(value).replace("\"", "\\\"") + "\""
+                          for key, value in items) + "}"
+
+
+class Metrics:
+    """ Collects counters and timers of the running process.
+
+    Counters are monotonically increasing values. Timers keep the count
+    and sum of all durations and the latest durations for percentiles.
+    Metrics are labelled with keyword arguments.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.timers = dict()
+
+    def increment(self, name, value=1, **labels):
+        """ Increases a counter. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """ Records a duration of a timer. """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {'count': 0, 'sum': 0.0,
+                                            'samples': deque(maxlen=TIMER_SAMPLES)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['samples'].append(seconds)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """ Times the enclosed block into a timer. """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """ Decorator that times every call of a function. """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """ Returns current values of every metric as a dictionary. """
+
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = []
+            for (name, labels), timer in sorted(self.timers.items()):
+                ordered = sorted(timer['samples'])
+                entry = {'name': name, 'labels': dict(labels),
+                         'count': timer['count'], 'sum': timer['sum']}
+                for q in QUANTILES:
+                    entry['p' + str(int(q * 100))] = quantile(ordered, q)
+                timers.append(entry)
+        return {'timestamp': time.time(), 'counters': counters, 'timers': timers}
+
+    def to_prometheus(self):
+        """ Returns metrics in Prometheus text exposition format. """
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = [(key, timer['count'], timer['sum'], sorted(timer['samples']))
+                      for key, timer in sorted(self.timers.items())]
+        declared = set()
+        for (name, labels), value in counters:
+            metric = "plant_" + name + "_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append("# TYPE " + metric + " counter")
+            lines.append(metric + format_labels(labels) + " " + repr(float(value)))
+        for (name, labels), count, total, ordered in timers:
+            metric = "plant_" + name + "_seconds"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append("# TYPE " + metric + " summary")
+            for q in QUANTILES:
+                lines.append(metric + format_labels(labels, quantile=q) + " " +
+                             repr(quantile(ordered, q)))
+            lines.append(metric + "_sum" + format_labels(labels) + " " + repr(total))
+            lines.append(metric + "_count" + format_labels(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, format="prometheus"):
+        """ Writes metrics to a file.
+
+        Prometheus format replaces the file atomically, so it can be read
+        by node exporter's textfile collector. JSON format appends one
+        snapshot per line, so latency can be followed over time.
+        """
+
+        if format == "json":
+            with open(path, 'a') as metrics_file:
+                metrics_file.write(json.dumps(self.snapshot()) + "\n")
+        else:
+            directory = os.path.dirname(os.path.abspath(path))
+            temp_path = os.path.join(directory, "." + os.path.basename(path) + ".tmp")
+            with open(temp_path, 'w') as metrics_file:
+                metrics_file.write(self.to_prometheus())
+            os.replace(temp_path, path)
+        logger.info("Metrics written to " + path + ".")
+
+    def reset(self):
+        """ Removes every collected metric. """
+
+        with self.lock:
+            self.counters = dict()
+            self.timers = dict()
+
+
+# Metrics of the whole process.
+metrics = Metrics()
+
+
+@contextmanager
+def profiled(path=None):
+    """ Profiles the enclosed block with cProfile if path is given. """
+
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logger.info("Profile written to " + path + ".")
+
+
+@contextmanager
+def instrumented(args, name):
+    """ Times a program run and exports metrics and profile as configured.
+
+    Metrics are exported also when the run fails, and every run is
+    counted by its result.
+    """
+
+    result = 'failure'
+    try:
+        with profiled(getattr(args, 'profile_path', None)):
+            with metrics.span('run', program=name):
+                yield
+        result = 'success'
+    finally:
+        metrics.increment('runs', program=name, result=result)
+        if getattr(args, 'metrics_path', None):
+            try:
+                metrics.export(args.metrics_path, args.metrics_format)
+            except OSError as oe:
+                logger.warning("Could not write metrics.")
+                logger.error(oe)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+import struct
+from logzero import logger
+
+
+# Timescale of the video track in ticks per second.
+VIDEO_TIMESCALE = 90000
+# Timescale of the movie header in ticks per second.
+MOVIE_TIMESCALE = 1000
+# NAL unit types.
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+# Unity transformation matrix used in movie and track headers.
+UNITY_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0,
+                           0, 0, 0x40000000)
+# Boxes that only contain other boxes.
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'dinf'}
+
+
+def box(box_type, *payloads):
+    """ Returns an MP4 box with the given payloads. """
+
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, flags, *payloads):
+    """ Returns an MP4 full box with version and flags. """
+
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+class BitReader:
+    """ Reads bits and Exp-Golomb codes from an H.264 RBSP. """
+
+    def __init__(self, data):
+        # Remove emulation prevention bytes.
+        self.data = data.replace(b'\x00\x00\x03', b'\x00\x00')
+        self.position = 0
+
+    def bit(self):
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def parse_sps_resolution(sps):
+    """ Returns the (width, height) of video described by an SPS NAL unit. """
+
+    reader = BitReader(sps[1:])
+    profile_idc = reader.bits(8)
+    reader.bits(16)
+    reader.ue()
+    chroma_format_idc = 1
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            reader.bit()
+        reader.ue()
+        reader.ue()
+        reader.bit()
+        # Skip scaling matrices.
+        if reader.bit():
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.bit():
+                    last_scale = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale:
+                            next_scale = (last_scale + reader.se()) % 256
+                        last_scale = next_scale or last_scale
+    reader.ue()
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()
+    elif pic_order_cnt_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()
+    reader.bit()
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    if not frame_mbs_only:
+        reader.bit()
+    reader.bit()
+    width = width_in_mbs * 16
+    height = height_in_map_units * 16 * (2 - frame_mbs_only)
+    # Apply frame cropping.
+    if reader.bit():
+        left, right, top, bottom = (reader.ue() for _ in range(4))
+        crop_x = 2 if chroma_format_idc in (1, 2) else 1
+        crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= (left + right) * crop_x
+        height -= (top + bottom) * crop_y
+    return width, height
+
+
+class Mp4Muxer:
+    """ Writes an H.264 Annex B byte stream into an MP4 file as it arrives.
+
+    Muxer is a writable file-like object, so camera can record straight
+    into it. Samples are written to the media data box immediately and
+    only their sizes are kept in memory. The movie box is written when
+    the muxer is closed.
+    """
+
+    def __init__(self, path, framerate=30):
+        self.path = path
+        self.sample_duration = int(round(VIDEO_TIMESCALE / float(framerate)))
+        self.file = open(path, 'wb')
+        self.buffer = bytearray()
+        self.sps = None
+        self.pps = None
+        self.sample_sizes = []
+        self.sample_offsets = []
+        self.sync_samples = []
+        self.sample_open = False
+        self.sample_has_slice = False
+        self.closed = False
+        self.file.write(box(b'ftyp', b'isom', struct.pack('>I', 512),
+                            b'isomiso2avc1mp41'))
+        self.mdat_offset = self.file.tell()
+        # Media data box with 64-bit size that is patched on close.
+        self.file.write(struct.pack('>I4sQ', 1, b'mdat', 0))
+
+    def write(self, data):
+        """ Takes a piece of H.264 byte stream and muxes complete NAL units. """
+
+        self.buffer += data
+        start = self.buffer.find(b'\x00\x00\x01')
+        while start != -1:
+            end = self.buffer.find(b'\x00\x00\x01', start + 3)
+            if end == -1:
+                break
+            self.add_nal(bytes(self.buffer[start + 3:end]))
+            start = end
+        if start > 0:
+            del self.buffer[:start]
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def add_nal(self, nal):
+        """ Adds a single NAL unit to the current or a new sample. """
+
+        # Trailing zeros belong to the next start code.
+        nal = nal.rstrip(b'\x00')
+        if not nal:
+            return
+        nal_type = nal[0] & 0x1f
+        if nal_type == NAL_AUD:
+            return
+        is_slice = nal_type in (NAL_SLICE, NAL_IDR_SLICE)
+        # A new access unit begins with a non-VCL unit or a first slice.
+        if self.sample_has_slice and (not is_slice or nal[1] & 0x80):
+            self.end_sample()
+        if nal_type == NAL_SPS and self.sps is None:
+            self.sps = nal
+        elif nal_type == NAL_PPS and self.pps is None:
+            self.pps = nal
+        if not self.sample_open:
+            self.sample_open = True
+            self.sample_offsets.append(self.file.tell())
+            self.sample_sizes.append(0)
+        if nal_type == NAL_IDR_SLICE and not self.sample_has_slice:
+            self.sync_samples.append(len(self.sample_sizes))
+        self.sample_has_slice = self.sample_has_slice or is_slice
+        self.file.write(struct.pack('>I', len(nal)))
+        self.file.write(nal)
+        self.sample_sizes[-1] += 4 + len(nal)
+
+    def end_sample(self):
+        """ Finishes the current sample. """
+
+        self.sample_open = False
+        self.sample_has_slice = False
+
+    def close(self):
+        """ Flushes remaining data and writes the movie box. """
+
+        if self.closed:
+            return
+        self.closed = True
+        start = self.buffer.find(b'\x00\x00\x01')
+        if start != -1:
+            self.add_nal(bytes(self.buffer[start + 3:]))
+        self.buffer = bytearray()
+        # Drop a trailing sample without picture data.
+        if self.sample_open and not self.sample_has_slice:
+            self.file.truncate(self.sample_offsets.pop())
+            self.file.seek(0, 2)
+            self.sample_sizes.pop()
+        self.end_sample()
+        try:
+            if self.sps is None or self.pps is None:
+                raise ValueError("Stream did not contain SPS and PPS.")
+            mdat_end = self.file.tell()
+            self.file.seek(self.mdat_offset + 8)
+            self.file.write(struct.pack('>Q', mdat_end - self.mdat_offset))
+            self.file.seek(mdat_end)
+            self.file.write(self.build_moov())
+            logger.info("Muxed " + str(len(self.sample_sizes)) +
+                        " frames into " + self.path + ".")
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def build_moov(self):
+        """ Returns the movie box describing written samples. """
+
+        width, height = parse_sps_resolution(self.sps)
+        sample_count = len(self.sample_sizes)
+        duration = sample_count * self.sample_duration
+        movie_duration = duration * MOVIE_TIMESCALE // VIDEO_TIMESCALE
+
+        mvhd = full_box(b'mvhd', 0, 0, struct.pack(
+            '>IIII', 0, 0, MOVIE_TIMESCALE, movie_duration),
+            struct.pack('>IH10x', 0x00010000, 0x0100), UNITY_MATRIX,
+            bytes(24), struct.pack('>I', 2))
+        tkhd = full_box(b'tkhd', 0, 3, struct.pack(
+            '>IIIII', 0, 0, 1, 0, movie_duration), bytes(8),
+            struct.pack('>hhhH', 0, 0, 0, 0), UNITY_MATRIX,
+            struct.pack('>II', width << 16, height << 16))
+        mdhd = full_box(b'mdhd', 0, 0, struct.pack(
+            '>IIIIHH', 0, 0, VIDEO_TIMESCALE, duration, 0x55c4, 0))
+        hdlr = full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'vide'),
+                        b'VideoHandler\x00')
+        vmhd = full_box(b'vmhd', 0, 1, bytes(8))
+        dinf = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1),
+                                     full_box(b'url ', 0, 1)))
+        avcc = box(b'avcC', struct.pack('>BBBBBB', 1, self.sps[1], self.sps[2],
+                                        self.sps[3], 0xff, 0xe1),
+                   struct.pack('>H', len(self.sps)), self.sps,
+                   struct.pack('>BH', 1, len(self.pps)), self.pps)
+        avc1 = box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+                   struct.pack('>HHIII', width, height, 0x00480000,
+                               0x00480000, 0),
+                   struct.pack('>H', 1), bytes(32),
+                   struct.pack('>Hh', 0x0018, -1), avcc)
+        stsd = full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1)
+        stts = full_box(b'stts', 0, 0, struct.pack(
+            '>III', 1, sample_count, self.sample_duration))
+        stss = full_box(b'stss', 0, 0, struct.pack(
+            '>I%dI' % len(self.sync_samples), len(self.sync_samples),
+            *self.sync_samples))
+        stsc = full_box(b'stsc', 0, 0, struct.pack('>IIII', 1, 1, 1, 1))
+        stsz = full_box(b'stsz', 0, 0, struct.pack(
+            '>II%dI' % sample_count, 0, sample_count, *self.sample_sizes))
+        # 32-bit chunk offsets are used unless the file is too large.
+        if self.sample_offsets and self.sample_offsets[-1] > 0xffffffff:
+            stco = full_box(b'co64', 0, 0, struct.pack(
+                '>I%dQ' % sample_count, sample_count, *self.sample_offsets))
+        else:
+            stco = full_box(b'stco', 0, 0, struct.pack(
+                '>I%dI' % sample_count, sample_count, *self.sample_offsets))
+        stbl = box(b'stbl', stsd, stts, stss, stsc, stsz, stco)
+        minf = box(b'minf', vmhd, dinf, stbl)
+        mdia = box(b'mdia', mdhd, hdlr, minf)
+        trak = box(b'trak', tkhd, mdia)
+        return box(b'moov', mvhd, trak)
+
+
+def is_finalized(path):
+    """ Returns True if an MP4 file has a readable movie box. """
+
+    try:
+        Mp4Reader(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        return False
+    return True
+
+
+class Mp4Reader:
+    """ Reads H.264 video samples from an MP4 file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.sps = []
+        self.pps = []
+        self.length_size = 4
+        self.timescale = VIDEO_TIMESCALE
+        # Samples as (offset, size, duration, is_sync) tuples.
+        self.samples = []
+        with open(path, 'rb') as file:
+            moov = self.find_moov(file)
+        self.parse_video_track(moov)
+
+    @staticmethod
+    def iterate_boxes(data, start=0, end=None):
+        """ Yields (type, payload start, box end) of boxes in data. """
+
+        end = len(data) if end is None else end
+        position = start
+        while position + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', data, position)
+            header = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', data, position + 8)[0]
+                header = 16
+            elif size == 0:
+                size = end - position
+            yield box_type, position + header, position + size
+            position += size
+
+    def find_moov(self, file):
+        """ Returns the contents of the movie box without reading media data. """
+
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                raise ValueError("Movie box not found in " + self.path + ".")
+            size, box_type = struct.unpack('>I4s', header)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack('>Q', file.read(8))[0]
+                header_size = 16
+            if box_type == b'moov':
+                return file.read(size - header_size)
+            if size < header_size:
+                # Box runs to the end of the file. Muxer leaves the media
+                # data box like this until it is closed.
+                raise ValueError("Movie box not found in " + self.path +
+                                 ", recording was not finished.")
+            file.seek(size - header_size, 1)
+
+    def parse_video_track(self, moov):
+        """ Finds the video track and builds its sample table. """
+
+        for box_type, start, end in self.iterate_boxes(moov):
+            if box_type != b'trak':
+                continue
+            tables = dict()
+            self.collect_boxes(moov, start, end, tables)
+            if tables.get(b'hdlr', b'')[8:12] == b'vide':
+                self.build_samples(tables)
+                return
+        raise ValueError("Video track not found in " + self.path + ".")
+
+    def collect_boxes(self, data, start, end, tables):
+        """ Collects payloads of leaf boxes of interest by type. """
+
+        for box_type, payload_start, box_end in self.iterate_boxes(data, start, end):
+            if box_type in CONTAINER_BOXES:
+                self.collect_boxes(data, payload_start, box_end, tables)
+            else:
+                tables[box_type] = data[payload_start:box_end]
+
+    def build_samples(self, tables):
+        """ Builds sample offsets, sizes, durations and sync flags. """
+
+        self.timescale = struct.unpack_from('>I', tables[b'mdhd'], 12)[0] \
+            if tables[b'mdhd'][0] == 0 else \
+            struct.unpack_from('>I', tables[b'mdhd'], 20)[0]
+        self.parse_avcc(tables[b'stsd'])
+
+        stsz = tables[b'stsz']
+        sample_size, count = struct.unpack_from('>II', stsz, 4)
+        sizes = list(struct.unpack_from('>%dI' % count, stsz, 12)) \
+            if sample_size == 0 else [sample_size] * count
+
+        if b'co64' in tables:
+            chunk_count = struct.unpack_from('>I', tables[b'co64'], 4)[0]
+            chunk_offsets = struct.unpack_from(
+                '>%dQ' % chunk_count, tables[b'co64'], 8)
+        else:
+            chunk_count = struct.unpack_from('>I', tables[b'stco'], 4)[0]
+            chunk_offsets = struct.unpack_from(
+                '>%dI' % chunk_count, tables[b'stco'], 8)
+
+        stsc = tables[b'stsc']
+        entries = [struct.unpack_from('>III', stsc, 8 + i * 12)
+                   for i in range(struct.unpack_from('>I', stsc, 4)[0])]
+        offsets = []
+        for i, (first_chunk, per_chunk, _) in enumerate(entries):
+            last_chunk = entries[i + 1][0] - 1 if i + 1 < len(entries) \
+                else chunk_count
+            for chunk in range(first_chunk, last_chunk + 1):
+                offset = chunk_offsets[chunk - 1]
+                for _ in range(per_chunk):
+                    offsets.append(offset)
+                    offset += sizes[len(offsets) - 1]
+
+        durations = []
+        stts = tables[b'stts']
+        for i in range(struct.unpack_from('>I', stts, 4)[0]):
+            run, delta = struct.unpack_from('>II', stts, 8 + i * 8)
+            durations.extend([delta] * run)
+
+        if b'stss' in tables:
+            stss = tables[b'stss']
+            sync = set(struct.unpack_from(
+                '>%dI' % struct.unpack_from('>I', stss, 4)[0], stss, 8))
+        else:
+            sync = set(range(1, count + 1))
+
+        self.samples = [(offsets[i], sizes[i], durations[i], i + 1 in sync)
+                        for i in range(count)]
+
+    def parse_avcc(self, stsd):
+        """ Reads parameter sets and NAL length size from the sample entry. """
+
+        position = stsd.find(b'avcC')
+        if position == -1:
+            raise ValueError("Video track is not H.264.")
+        avcc = stsd[position + 4:]
+        self.length_size = (avcc[4] & 3) + 1
+        position = 6
+        for _ in range(avcc[5] & 0x1f):
+            length = struct.unpack_from('>H', avcc, position)[0]
+            self.sps.append(avcc[position + 2:position + 2 + length])
+            position += 2 + length
+        for _ in range(avcc[position]):
+            length = struct.unpack_from('>H', avcc, position + 1)[0]
+            self.pps.append(avcc[position + 3:position + 3 + length])
+            position += 2 + length
+
+    @property
+    def framerate(self):
+        """ Average framerate of the video track. """
+
+        total = sum(sample[2] for sample in self.samples)
+        return len(self.samples) * self.timescale / total if total else 30
+
+    def iterate_annexb(self, samples=None):
+        """ Yields samples converted to H.264 Annex B byte stream.
+
+        Parameter sets are repeated before every sync sample so that the
+        stream can be decoded from any of them.
+        """
+
+        start_code = b'\x00\x00\x00\x01'
+        headers = b''.join(start_code + nal for nal in self.sps + self.pps)
+        with open(self.path, 'rb') as file:
+            for offset, size, _, is_sync in (samples or self.samples):
+                file.seek(offset)
+                data = file.read(size)
+                parts = [headers] if is_sync else []
+                position = 0
+                while position < len(data):
+                    length = int.from_bytes(
+                        data[position:position + self.length_size], 'big')
+                    position += self.length_size
+                    parts.append(start_code + data[position:position + length])
+                    position += length
+                yield b''.join(parts)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import threading
+import time
+from logzero import logger
+from metrics import metrics
+
+
+# Seconds that a stored video url must stay valid to be used again, so
+# that Instagram has time to download the video.
+URL_EXPIRY_MARGIN = 120
+# Delays in seconds between attempts to publish a post. The delay
+# doubles on every failed attempt.
+RETRY_INITIAL_DELAY = 30.0
+RETRY_MAX_DELAY = 3600.0
+# Posts that Instagram lets an account publish through the API in 24 hours.
+PUBLISH_LIMIT = 25
+PUBLISH_LIMIT_WINDOW = 24 * 60 * 60
+# Timelapse posts are stored in the outbox under this prefix and their
+# date, so that they do not replace the watering video of the date.
+TIMELAPSE_PREFIX = "timelapse-"
+# Longest time in seconds that the worker sleeps before checking due posts.
+MAX_SLEEP = 60
+
+
+class PermanentFailure(Exception):
+    """ Raised when a post can never be published. """
+
+
+class PostFailed(Exception):
+    """ Raised when a post should be attempted again later. """
+
+
+def retry_delay(attempts):
+    """ Returns seconds to wait after the given amount of failed attempts. """
+
+    delay = min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class Outbox:
+    """ Durable queue of videos waiting to be posted.
+
+    Watering only stores the video of the day into the outbox table, and
+    the outbox is drained either right away or by a worker thread of a
+    resident process. Failed posts are attempted again with exponential
+    backoff, so posts are not lost when the network is down, and a
+    backlog is posted oldest first in parallel batches that stay within
+    the publishing limit of every account. Progress of every post is stored
+    in its daily run, so an attempt continues where the previous one
+    stopped.
+    """
+
+    def __init__(self, dbh, video_uploader, graph_handler, workers=2):
+        self.dbh = dbh
+        self.video_uploader = video_uploader
+        self.graph_handler = graph_handler
+        self.workers = max(1, workers)
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def enqueue(self, date, video_path, caption=None):
+        """ Adds the video of a date into the outbox.
+
+        Caption replaces the captions of account configurations if given.
+        """
+
+        self.dbh.enqueue_post(date, video_path, time.time(), caption)
+        logger.info("Added video of " + str(date) + " into the outbox.")
+        self.wake.set()
+
+    def start(self):
+        """ Starts draining the outbox in a background thread. """
+
+        self.thread = threading.Thread(target=self.run, name="outbox-worker",
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the worker after the running batch. """
+
+        self.stopping.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        """ Drains the outbox whenever posts are due until stopped. """
+
+        while not self.stopping.is_set():
+            self.wake.clear()
+            try:
+                self.drain()
+            except Exception as ex:
+                logger.error("Draining the outbox failed.")
+                logger.exception(ex)
+            next_attempt = self.dbh.get_next_post_time()
+            timeout = MAX_SLEEP if next_attempt is None else \
+                min(MAX_SLEEP, max(0.0, next_attempt - time.time()))
+            self.wake.wait(timeout)
+
+    def drain(self):
+        """ Publishes due posts in batches and returns amount published.
+
+        Returns when no post is due, the publishing limit is reached or
+        the outbox is stopped.
+        """
+
+        published = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping.is_set():
+                now = time.time()
+                quota = PUBLISH_LIMIT - self.dbh.count_published_posts(
+                    now - PUBLISH_LIMIT_WINDOW)
+                if quota <= 0:
+                    logger.warning("Publishing limit reached, posts wait in the outbox.")
+                    break
+                posts = self.dbh.get_due_posts(now, min(quota, self.workers))
+                if not posts:
+                    break
+                logger.info("Publishing " + str(len(posts)) + " posts from the outbox.")
+                results = executor.map(self.attempt, posts)
+                published += sum(1 for result in results if result)
+        metrics.increment('outbox_published', published)
+        return published
+
+    def attempt(self, post):
+        """ Attempts to publish a post and schedules a retry if it fails. """
+
+        date = post['date']
+        try:
+            with metrics.span('outbox_post'):
+                self.publish(date, post['video_path'], post['caption'])
+        except PermanentFailure as pf:
+            logger.error("Video of " + date + " cannot be posted: " + str(pf))
+            self.dbh.fail_post(date, str(pf))
+            return False
+        except Exception as ex:
+            attempts = post['attempts'] + 1
+            delay = retry_delay(attempts)
+            logger.warning("Posting video of " + date + " failed, attempt " +
+                           str(attempts) + ". Trying again in " +
+                           str(round(delay)) + " seconds.")
+            logger.error(ex)
+            metrics.increment('outbox_retries')
+            self.dbh.defer_post(date, attempts, time.time() + delay, str(ex))
+            return False
+        self.dbh.mark_post_published(date, time.time())
+        logger.info("Video of " + date + " is posted.")
+        return True
+
+    def publish(self, date, video_path, caption=None):
+        """ Uploads and publishes the video of a date to every account. """
+
+        run = self.dbh.get_daily_run(date)
+        accounts = [acc_data['user_id'] for acc_data in
+                    self.graph_handler.load_account_configurations()]
+        pending = [user_id for user_id in accounts
+                   if user_id not in run['media_ids']]
+        if not pending:
+            return
+        video_url = None
+        # Video is only needed for accounts without a media container.
+        if not all(run['container_ids'].get(user_id) for user_id in pending):
+            video_url = self.get_video_url(date, run, video_path)
+        posting_results = self.graph_handler.start_posting_process(
+            video_url, caption, creation_ids=run['container_ids'],
+            on_created=lambda created: self.store_containers(date, run, created),
+            published=run['media_ids'])
+        logger.info(posting_results)
+        media_ids = dict(run['media_ids'])
+        media_ids.update((user_id, media_dict['id'])
+                         for user_id, media_dict in posting_results.items()
+                         if media_dict and 'id' in media_dict)
+        published = {user_id: media_id for user_id, media_id in media_ids.items()
+                     if user_id not in run['media_ids']}
+        # Stored before anything else, so that no account is posted twice.
+        self.checkpoint(date, run, media_ids=media_ids)
+        self.dbh.record_publications(published, time.time())
+        if media_ids and not str(date).startswith(TIMELAPSE_PREFIX):
+            # Media id of the first successfully posted account is stored.
+            self.dbh.update_media_id(next(iter(media_ids.values())), date)
+        failed = [user_id for user_id in pending if user_id not in media_ids]
+        if failed:
+            self.drop_failed_containers(date, run, failed)
+            raise PostFailed("Video was not published to accounts " +
+                             ", ".join(failed) + ".")
+
+    def get_video_url(self, date, run, video_path):
+        """ Returns a valid url of the video, uploading it if needed. """
+
+        if run['video_url'] and \
+                run['url_expires_at'] > time.time() + URL_EXPIRY_MARGIN:
+            logger.info("Using stored video url of " + date + ".")
+            return run['video_url']
+        if not os.path.exists(video_path):
+            raise PermanentFailure("Video file " + video_path + " is missing.")
+        upload = self.video_uploader.upload(video_path)
+        if not upload:
+            raise PostFailed("Did not receive video url.")
+        self.checkpoint(date, run, video_url=upload['link'],
+                        url_expires_at=upload['expires_at'])
+        logger.info("Video url is: " + upload['link'])
+        return upload['link']
+
+    def store_containers(self, date, run, creation_ids):
+        """ Stores created media containers before they are published. """
+
+        created = {user_id: creation_id for user_id, creation_id
+                   in creation_ids.items() if creation_id}
+        if not created:
+            return
+        # File.io deletes the video after Instagram has downloaded it, so
+        # the url cannot be used for another container.
+        self.checkpoint(date, run, container_ids=dict(run['container_ids'], **created),
+                        video_url=None, url_expires_at=None)
+
+    def drop_failed_containers(self, date, run, user_ids):
+        """ Forgets media containers that Instagram could not process. """
+
+        containers = dict(run['container_ids'])
+        for user_id in user_ids:
+            creation_id = containers.get(user_id)
+            if not creation_id:
+                continue
+            try:
+                status = self.graph_handler.get_container_status(creation_id,
+                                                                 user_id)
+            except Exception as ex:
+                logger.warning("Could not check media container " +
+                               str(creation_id) + ".")
+                logger.error(ex)
+                continue
+            # Containers that are still processing are published next time.
+            if status in ('ERROR', 'EXPIRED'):
+                del containers[user_id]
+        if containers != run['container_ids']:
+            self.checkpoint(date, run, container_ids=containers)
+
+    def checkpoint(self, date, run, **fields):
+        """ Stores posting progress into the daily run of the date. """
+
+        self.dbh.update_daily_run(date, **fields)
+        run.update(fields)
@@ -1,13 +1,14 @@
 import configargparse
 
 
-def get_configuration():
+def get_configuration(argv=None):
     p = configargparse.ArgParser(
         default_config_files=['/etc/app/conf.d/*.conf', '~/.my_settings'])
     p.add('-c', '--my-config', required=True,
           is_config_file=True, help='config file path')
     p.add('-a', '--configure_account', required=False, action='store_true',
-          help='Argument used for creating account configuration file.')
+          help='Discover accounts again when creating account configuration '
+               'files instead of using cached account information')
     p.add('--graph_api_access_token', required=True, help='Access Token')
     p.add('--graph_api_version', required=True,
           help='Version of the Instagram Graph API')
@@ -25,7 +26,70 @@ def get_configuration():
           help='name of sqlite database')
     p.add('--dry_run', required=True,
           help='Determines if post will be published to instagram.')
+    p.add('--upload_hosts', required=False, default=None,
+          help='Comma separated File.io compatible hosts used after File.io, '
+               'each as "base_path [api_key]"')
+    p.add('--upload_hedge_delay', required=False, type=float, default=10,
+          help='Seconds before the video is uploaded to the next host too')
+    p.add('--posting_workers', required=False, type=int, default=4,
+          help='Maximum amount of accounts that are posted to concurrently')
+    p.add('--publish_deadline', required=False, type=float, default=300,
+          help='Seconds to wait for Instagram to process a video')
+    p.add('--discovery_cache_ttl', required=False, type=float, default=604800,
+          help='Seconds that account information from Graph API is cached')
+    p.add('--hardware_backend', required=False, default='pi',
+          choices=['pi', 'fake'],
+          help='Use real camera and GPIO or simulated ones')
+    p.add('--fake_video_fixture', required=False, default=None,
+          help='Video replayed by the fake camera')
+    p.add('--pump_flow_rate', required=False, type=float, default=5.0,
+          help='Millilitres the pump moves per second at full duty cycle')
+    p.add('--pump_stall_duty', required=False, type=float, default=20,
+          help='Duty cycle percent below which the pump does not move water')
+    p.add('--pump_duty_cycle', required=False, type=float, default=100,
+          help='Duty cycle percent the pump is run at')
+    p.add('--pump_ramp_seconds', required=False, type=float, default=0.3,
+          help='Seconds the pump is ramped up to full speed')
+    p.add('--max_water_amount', required=False, type=float, default=200,
+          help='Largest amount of water in millilitres given at once')
+    p.add('--video_trimming', required=False, default='motion',
+          choices=['motion', 'off'],
+          help='Trim video to the part where water is flowing')
+    p.add('--trim_padding', required=False, type=float, default=0.5,
+          help='Seconds of video kept around the detected watering')
+    p.add('--image_format', required=False, default='jpeg',
+          choices=['jpeg', 'webp', 'png'],
+          help='Format that daily images are archived in')
+    p.add('--image_quality', required=False, type=int, default=85,
+          help='Quality of archived JPEG and WebP images from 1 to 100')
+    p.add('--image_retention_days', required=False, type=int, default=30,
+          help='Days that full size images are kept, 0 keeps them forever')
+    p.add('--thumbnail_retention_days', required=False, type=int, default=0,
+          help='Days that thumbnails are kept, 0 keeps them forever')
+    p.add('--timelapse_speed', required=False, type=float, default=10,
+          help='Archived images shown per second in the timelapse video')
+    p.add('--app_secret', required=False, default=None,
+          help='App secret used to verify signatures of webhook events')
+    p.add('--webhook_verify_token', required=False, default=None,
+          help='Token that Instagram sends when verifying the webhook')
+    p.add('--webhook_host', required=False, default='0.0.0.0',
+          help='Address that the webhook server listens at')
+    p.add('--webhook_port', required=False, type=int, default=8080,
+          help='Port that the webhook server listens at')
+    p.add('--outbox_workers', required=False, type=int, default=2,
+          help='Posts of the outbox that are published at the same time')
+    p.add('--watering_time', required=False, default='12:00',
+          help='Local time of day (HH:MM) that the daemon waters and posts at')
+    p.add('--comment_check_interval', required=False, type=float, default=3600,
+          help='Seconds between comment checks of the daemon')
+    p.add('--metrics_path', required=False, default=None,
+          help='File that timings and counters are written to after a run')
+    p.add('--metrics_format', required=False, default='prometheus',
+          choices=['prometheus', 'json'],
+          help='Prometheus text format or JSON lines appended per run')
+    p.add('--profile_path', required=False, default=None,
+          help='File that a cProfile profile of the run is written to')
 
-    options = p.parse_args()
+    options = p.parse_args(argv)
 
     return options
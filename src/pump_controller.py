@@ -1,26 +1,45 @@
 #!/usr/bin/env python3
 
-import RPi.GPIO as GPIO
-from time import sleep
 from camera_controller import CameraController
 from logzero import logger
 
 
 class PumpController:
-    """ Controls the pump motor """
+    """ Controls the pump motor.
 
-    def __init__(self):
-        self.cam = CameraController()
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setwarnings(False)
+    GPIO pins are set up when the pump is first used and released when
+    it is stopped, so the controller can be kept by a resident process.
+    """
+
+    def __init__(self, gpio=None, camera_controller=None):
+        self._gpio = gpio
+        self.cam = camera_controller or CameraController()
+        self.pwm = None
+
+    @property
+    def gpio(self):
+        """ GPIO module that is imported when it is first needed. """
+
+        if self._gpio is None:
+            import RPi.GPIO as gpio
+            self._gpio = gpio
+        return self._gpio
+
+    def setup(self):
+        """ Sets up GPIO pins unless they are already set up. """
+
+        if self.pwm is not None:
+            return
+        self.gpio.setmode(self.gpio.BOARD)
+        self.gpio.setwarnings(False)
         self.set_gpio_pins()
 
     def set_gpio_pins(self):
         """ Set GPIO pins as output """
-        GPIO.setup(3, GPIO.OUT)
-        GPIO.setup(5, GPIO.OUT)
-        GPIO.setup(7, GPIO.OUT)
-        self.pwm = GPIO.PWM(7, 100)
+        self.gpio.setup(3, self.gpio.OUT)
+        self.gpio.setup(5, self.gpio.OUT)
+        self.gpio.setup(7, self.gpio.OUT)
+        self.pwm = self.gpio.PWM(7, 100)
         self.pwm.start(0)
 
     def run_pump_forward(self):
@@ -29,29 +48,49 @@ class PumpController:
         self.cam.start_record()
         logger.info("Starting pump.")
         self.start_pump()
-        # Set GPIO pins
-        GPIO.output(3, False)
-        GPIO.output(5, True)
-        GPIO.output(7, True)
+        self.set_direction_forward()
 
     def run_pump_backward(self):
         """ Runs pump motor backward """
         self.start_pump()
-        GPIO.output(3, True)
-        GPIO.output(5, False)
+        self.gpio.output(3, True)
+        self.gpio.output(5, False)
+
+    def set_direction_forward(self):
+        """ Sets motor driver pins to run the pump forward. """
+
+        self.setup()
+        self.gpio.output(3, False)
+        self.gpio.output(5, True)
+        self.gpio.output(7, True)
 
     def stop_pump(self):
-        """ Stops pump and cleans up."""
+        """ Stops pump, cleans up and returns the result of the recording."""
 
         logger.info("Stopping pump.")
-        GPIO.output(7, False)
-        self.pwm.ChangeDutyCycle(0)
-        self.pwm.stop(0)
-        GPIO.cleanup()
-        self.cam.stop_record()
+        if self.pwm is not None:
+            self.halt_pump()
+            self.pwm.stop(0)
+            self.gpio.cleanup()
+            self.pwm = None
+        return self.cam.stop_record()
 
-    def start_pump(self):
+    def start_pump(self, duty_cycle=100):
         """ Starts pump. """
 
-        GPIO.output(7, True)
-        self.pwm.ChangeDutyCycle(100)
+        self.setup()
+        self.gpio.output(7, True)
+        self.pwm.ChangeDutyCycle(duty_cycle)
+
+    def set_duty_cycle(self, duty_cycle):
+        """ Changes speed of the running pump. """
+
+        self.setup()
+        self.pwm.ChangeDutyCycle(duty_cycle)
+
+    def halt_pump(self):
+        """ Stops the pump motor without releasing GPIO pins. """
+
+        self.setup()
+        self.gpio.output(7, False)
+        self.pwm.ChangeDutyCycle(0)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from logzero import logger
+from metrics import metrics
+
+
+# Millilitres pumped per second at full duty cycle.
+DEFAULT_FLOW_RATE = 5.0
+# Duty cycle percent below which the pump does not move water.
+DEFAULT_STALL_DUTY = 20
+# Seconds taken to ramp the pump from stall to target duty cycle.
+DEFAULT_RAMP_SECONDS = 0.3
+# Amount of duty cycle steps in the ramp.
+RAMP_STEPS = 5
+# Largest dose in millilitres that is ever pumped.
+DEFAULT_MAX_DOSE = 200
+# Last seconds of a step that are waited by spinning instead of sleeping,
+# since sleeping may overshoot by a scheduler tick.
+SPIN_SECONDS = 0.002
+
+
+class PumpCalibration:
+    """ Converts water volumes into pump duty cycle profiles.
+
+    Flow is assumed to grow linearly from nothing at stall duty cycle to
+    the measured flow rate at full duty cycle.
+    """
+
+    def __init__(self, flow_rate=DEFAULT_FLOW_RATE, stall_duty=DEFAULT_STALL_DUTY,
+                 duty_cycle=100, ramp_seconds=DEFAULT_RAMP_SECONDS):
+        if flow_rate <= 0:
+            raise ValueError("Flow rate must be positive.")
+        if not stall_duty < duty_cycle <= 100:
+            raise ValueError("Duty cycle must be above stall duty and at most 100.")
+        self.flow_rate = flow_rate
+        self.stall_duty = stall_duty
+        self.duty_cycle = duty_cycle
+        self.ramp_seconds = ramp_seconds
+
+    def flow_at(self, duty_cycle):
+        """ Returns millilitres pumped per second at the duty cycle. """
+
+        if duty_cycle <= self.stall_duty:
+            return 0.0
+        return self.flow_rate * (duty_cycle - self.stall_duty) / \
+            (100 - self.stall_duty)
+
+    def profile(self, millilitres):
+        """ Returns list of (duty cycle, seconds) steps that pump the volume.
+
+        Pump is ramped up in steps to soften the start and then held at
+        the target duty cycle for the rest of the volume. Small volumes
+        are pumped at the target duty cycle without a ramp.
+        """
+
+        if millilitres <= 0:
+            return []
+        steps = []
+        if self.ramp_seconds > 0:
+            step_seconds = self.ramp_seconds / RAMP_STEPS
+            for step in range(1, RAMP_STEPS + 1):
+                duty = self.stall_duty + \
+                    (self.duty_cycle - self.stall_duty) * step / (RAMP_STEPS + 1)
+                steps.append((round(duty, 1), step_seconds))
+        ramp_volume = self.volume(steps)
+        if ramp_volume >= millilitres:
+            steps = []
+            ramp_volume = 0.0
+        steps.append((self.duty_cycle,
+                      (millilitres - ramp_volume) / self.flow_at(self.duty_cycle)))
+        return steps
+
+    def volume(self, steps):
+        """ Returns millilitres pumped by (duty cycle, seconds) steps. """
+
+        return sum(self.flow_at(duty) * seconds for duty, seconds in steps)
+
+
+class PumpDoser:
+    """ Pumps volumes of water in the background.
+
+    Doses are run one at a time on a worker thread and dose() returns a
+    concurrent.futures.Future, so callers can keep working while water is
+    pumped and wait for the result later. The future can be awaited in
+    asyncio code with asyncio.wrap_future. Step lengths are measured with
+    a monotonic clock and the delivered volume is estimated from the
+    measured lengths.
+    """
+
+    def __init__(self, pump_controller, calibration=None,
+                 max_dose=DEFAULT_MAX_DOSE):
+        self.pump = pump_controller
+        self.calibration = calibration or PumpCalibration()
+        self.max_dose = max_dose
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="pump-doser")
+        self.cancelled = threading.Event()
+
+    def dose(self, millilitres):
+        """ Starts pumping the volume and returns future of the dose result.
+
+        Result is a dictionary of requested and delivered millilitres and
+        seconds the pump was running.
+        """
+
+        if millilitres > self.max_dose:
+            logger.warning("Dose of " + str(millilitres) + " ml is limited to " +
+                           str(self.max_dose) + " ml.")
+            millilitres = self.max_dose
+        self.cancelled.clear()
+        return self.executor.submit(self.run_dose, max(0, millilitres))
+
+    def cancel(self):
+        """ Stops the running dose as soon as possible. """
+
+        self.cancelled.set()
+
+    def run_dose(self, millilitres):
+        """ Runs duty cycle profile of the volume and returns dose result. """
+
+        steps = self.calibration.profile(millilitres)
+        logger.info("Dosing " + str(millilitres) + " ml in " +
+                    str(len(steps)) + " step(s).")
+        measured = []
+        start = time.perf_counter()
+        try:
+            if steps:
+                self.pump.set_direction_forward()
+                self.pump.start_pump(steps[0][0])
+            for duty_cycle, seconds in steps:
+                self.pump.set_duty_cycle(duty_cycle)
+                step_start = time.perf_counter()
+                self.wait_until(step_start + seconds)
+                measured.append((duty_cycle, time.perf_counter() - step_start))
+                if self.cancelled.is_set():
+                    logger.warning("Dose was cancelled.")
+                    break
+        finally:
+            if steps:
+                self.pump.halt_pump()
+            elapsed = time.perf_counter() - start
+        delivered = self.calibration.volume(measured)
+        logger.info("Delivered " + "{:.1f}".format(delivered) + " ml of " +
+                    str(millilitres) + " ml in " + "{:.3f}".format(elapsed) +
+                    " seconds.")
+        metrics.increment('water_delivered_ml', delivered)
+        metrics.observe('pump_dose', elapsed)
+        return {'requested_ml': millilitres, 'delivered_ml': delivered,
+                'seconds': elapsed}
+
+    def wait_until(self, target):
+        """ Waits until perf_counter reaches target or dose is cancelled. """
+
+        while True:
+            remaining = target - time.perf_counter()
+            if remaining <= 0:
+                return
+            if remaining > SPIN_SECONDS:
+                if self.cancelled.wait(remaining - SPIN_SECONDS):
+                    return
+            elif self.cancelled.is_set():
+                return
+
+    def close(self):
+        """ Waits for the running dose and stops the worker thread. """
+
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from logzero import logger
+import vote_parser
+
+
+# Words that synthetic comments are built from.
+COMMENT_WORDS = ["great", "plant", "love", "this", "water", "more", "please",
+                 "\U0001F331", "(ok)", "25:"]
+# Vote forms that are mixed into synthetic comments.
+VOTE_FORMS = ["25ml", "25 mL", "100 ml", "5ML", "３０ml",
+              "٥٠ ml", "2ml"]
+
+
+def generate_comments(count, seed=0):
+    """ Returns a list of synthetic comment texts. """
+
+    rng = random.Random(seed)
+    comments = []
+    for _ in range(count):
+        words = rng.choices(COMMENT_WORDS, k=rng.randint(1, 12))
+        # Roughly half of the comments contain a vote.
+        if rng.random() < 0.5:
+            words.insert(rng.randrange(len(words) + 1),
+                         rng.choice(VOTE_FORMS))
+        comments.append(" ".join(words))
+    return comments
+
+
+def benchmark_vote_parser(options):
+    """ Measures how many comments per second the vote parser handles. """
+
+    comments = generate_comments(options.comments)
+    best = None
+    for _ in range(options.rounds):
+        start = time.perf_counter()
+        votes = vote_parser.count_votes(comments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    logger.info("Counted " + str(sum(votes.values())) + " votes.")
+    return {'comments': options.comments,
+            'seconds': round(best, 4),
+            'comments_per_second': int(options.comments / best)}
+
+
+def benchmark_video_trim(options):
+    """ Measures motion analysis and trimming of the bundled test video. """
+
+    import numpy as np
+    import video_trimmer
+    from fake_camera import FIXTURE_PATH
+    from mp4_container import Mp4Reader
+    reader = Mp4Reader(FIXTURE_PATH)
+    methods = {
+        'sample_sizes':
+            lambda: video_trimmer.activity_from_sample_sizes(reader),
+        'frame_difference':
+            lambda: video_trimmer.activity_from_frames(FIXTURE_PATH)}
+    result = {'frames': len(reader.samples),
+              'original_bytes': os.path.getsize(FIXTURE_PATH)}
+    for method, measure in methods.items():
+        durations = []
+        for _ in range(options.rounds):
+            start = time.perf_counter()
+            activity = measure()
+            durations.append(time.perf_counter() - start)
+        if activity is None:
+            logger.info("Skipping " + method + ", decoder is not installed.")
+            continue
+        segment = video_trimmer.find_active_segment(np.asarray(activity),
+                                                    reader.framerate)
+        result[method] = {'segment': segment, 'seconds': summarize(durations)}
+    start = time.perf_counter()
+    trimmed = video_trimmer.trim_video(FIXTURE_PATH, "trimmed.mp4")
+    result['trim_seconds'] = round(time.perf_counter() - start, 3)
+    result['trimmed_frames'] = len(Mp4Reader(trimmed).samples)
+    result['trimmed_bytes'] = os.path.getsize(trimmed)
+    result['size_ratio'] = round(result['trimmed_bytes'] /
+                                 result['original_bytes'], 3)
+    return result
+
+
+def prepare_workspace():
+    """ Creates a temporary project directory and moves into it.
+
+    Modules resolve their file paths from the working directory when they
+    are imported, so this is done before importing them.
+    """
+
+    workspace = tempfile.mkdtemp(prefix="plant-benchmark-")
+    for directory in ('videos', 'images', 'account_configuration'):
+        os.makedirs(os.path.join(workspace, directory))
+    os.chdir(workspace)
+    logger.info("Benchmark workspace is " + workspace + ".")
+    return workspace
+
+
+def write_configuration(options, graph_api, file_host, name):
+    """ Writes configuration pointing to fake services and returns args. """
+
+    from parse_config import get_configuration
+    path = os.path.abspath(name + ".ini")
+    with open(path, 'w') as conf_file:
+        conf_file.write("\n".join([
+            "graph_api_access_token = token",
+            "graph_api_version = v12.0/",
+            "graph_api_base_path = " + graph_api.base_path,
+            "file_io_api_key = key",
+            "file_io_base_path = " + file_host.base_path,
+            "image_name_prefix = plant-photo-",
+            "video_name_prefix = plant-video-",
+            "database_name = " + os.path.abspath(name + ".db"),
+            "dry_run = False",
+            "hardware_backend = fake",
+            "publish_deadline = 60"]) + "\n")
+    with open(os.path.join('account_configuration', graph_api.user_id + '.json'), 'w') as acc_file:
+        json.dump({'user_id': graph_api.user_id, 'caption': ['Benchmark'],
+                   'hashtags': ['#plant']}, acc_file)
+    return get_configuration(['-c', path])
+
+
+def summarize(durations):
+    """ Returns latency statistics of durations in seconds. """
+
+    ordered = sorted(durations)
+    return {'rounds': len(ordered),
+            'p50': round(statistics.median(ordered), 3),
+            'p95': round(ordered[min(len(ordered) - 1,
+                                     int(round(0.95 * (len(ordered) - 1))))], 3),
+            'max': round(ordered[-1], 3)}
+
+
+def create_fake_services(options, comments=None):
+    """ Returns fake Graph API and file host configured by options. """
+
+    from fake_graph_api import FakeGraphApi
+    from fake_file_host import FakeFileHost
+    service_options = {'latency': options.latency,
+                       'error_rate': options.error_rate, 'seed': 0}
+    return (FakeGraphApi(container_delay=options.container_delay,
+                         comments=comments, **service_options),
+            FakeFileHost(**service_options))
+
+
+def benchmark_daily_process(options):
+    """ Measures end-to-end latency of the daily run against fake services. """
+
+    import run_daily_process
+    graph_api, file_host = create_fake_services(options)
+    durations = []
+    stage_durations = dict()
+    with graph_api, file_host:
+        args = write_configuration(options, graph_api, file_host, "daily")
+        for _ in range(options.rounds):
+            if os.path.exists(args.database_name):
+                os.remove(args.database_name)
+            start = time.perf_counter()
+            daily = run_daily_process.DailyProcess(args)
+            graph = daily.start_process()
+            outbox_start = time.perf_counter()
+            published = daily.outbox.drain()
+            outbox_seconds = time.perf_counter() - outbox_start
+            daily.close()
+            durations.append(time.perf_counter() - start)
+            if graph.failed or graph.skipped or not published:
+                logger.warning("Daily run did not complete every stage.")
+            for name, timing in graph.timings.items():
+                stage_durations.setdefault(name, []).append(timing['seconds'])
+            stage_durations.setdefault('outbox', []).append(outbox_seconds)
+    result = summarize(durations)
+    result['stages'] = {name: round(statistics.median(values), 3)
+                        for name, values in stage_durations.items()}
+    return result
+
+
+def benchmark_comment_check(options):
+    """ Measures latency of the comment check against fake Graph API. """
+
+    import run_comment_check
+    from db_handler import DatabaseHandler
+    now = datetime.utcnow()
+    # Comments are returned newest first like Graph API does.
+    comments = [{'id': str(i), 'text': text, 'username': 'user' + str(i),
+                 'timestamp': (now - timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S+0000')}
+                for i, text in enumerate(generate_comments(options.post_comments))]
+    graph_api, file_host = create_fake_services(options, comments)
+    durations = []
+    with graph_api, file_host:
+        args = write_configuration(options, graph_api, file_host, "comments")
+        for round_number in range(options.rounds):
+            # Every round checks a new post so that nothing is counted yet.
+            dbh = DatabaseHandler(args)
+            dbh.upsert_to_table({'date': datetime.now().date(),
+                                 'water_amount': 25, 'vote_count': 0})
+            dbh.update_media_id(round_number + 1, datetime.now().date())
+            dbh.cleanup()
+            start = time.perf_counter()
+            run_comment_check.main(args)
+            durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def benchmark_webhook(options):
+    """ Measures acknowledgement latency and ingestion of webhook events. """
+
+    from db_handler import DatabaseHandler
+    from http_client import get_client
+    from webhook_server import WebhookServer, sign_payload
+    app_secret = "benchmark-secret"
+    dbh = DatabaseHandler(argparse.Namespace(database_name="webhook.db"))
+    dbh.upsert_to_table({'date': datetime.now().date(),
+                         'water_amount': 25, 'vote_count': 0})
+    dbh.update_media_id("4000", datetime.now().date())
+    texts = generate_comments(options.post_comments)
+    durations = []
+    with WebhookServer(dbh, app_secret, "token", "127.0.0.1", 0) as server:
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            payload = {'object': 'instagram', 'entry': [{
+                'id': '2000', 'time': int(time.time()),
+                'changes': [{'field': 'comments', 'value': {
+                    'from': {'id': str(i), 'username': 'user' + str(i)},
+                    'media': {'id': '4000'}, 'id': str(i), 'text': text}}]}]}
+            body = json.dumps(payload).encode()
+            request_start = time.perf_counter()
+            get_client().post(server.base_path, data=body, headers={
+                'Content-Type': 'application/json',
+                'X-Hub-Signature-256': sign_payload(body, app_secret)},
+                raise_for_status=True)
+            durations.append(time.perf_counter() - request_start)
+        received = time.perf_counter() - start
+    # Stopping the server waits until queued events are applied.
+    applied = time.perf_counter() - start
+    tally = dbh.get_vote_tally("4000")
+    dbh.cleanup()
+    return {'events': len(texts), 'ack_seconds': summarize(durations),
+            'events_per_second': int(len(texts) / received),
+            'applied_seconds': round(applied, 3), 'tally': tally}
+
+
+def benchmark_upload(options):
+    """ Measures video upload to a slow host alone and hedged with a fast one. """
+
+    from fake_camera import FIXTURE_PATH
+    from fake_file_host import FakeFileHost
+    from video_uploader import VideoUploader
+    graph_api, slow_host = create_fake_services(options)
+    slow_host.latency = options.slow_host_latency
+    fast_host = FakeFileHost(latency=options.latency, error_rate=options.error_rate,
+                             seed=1)
+    result = {'bytes': os.path.getsize(FIXTURE_PATH)}
+    with graph_api, slow_host, fast_host:
+        args = write_configuration(options, graph_api, slow_host, "upload")
+        args.upload_hedge_delay = options.hedge_delay
+        for name, upload_hosts in (('single', None),
+                                   ('hedged', fast_host.base_path)):
+            args.upload_hosts = upload_hosts
+            uploader = VideoUploader(args)
+            durations = []
+            for _ in range(options.rounds):
+                start = time.perf_counter()
+                if not uploader.upload_video(FIXTURE_PATH):
+                    logger.warning("Upload did not succeed.")
+                durations.append(time.perf_counter() - start)
+            result[name] = summarize(durations)
+    return result
+
+
+# Benchmarks by name.
+BENCHMARKS = {'vote_parser': benchmark_vote_parser,
+              'video_trim': benchmark_video_trim,
+              'daily_process': benchmark_daily_process,
+              'comment_check': benchmark_comment_check,
+              'webhook': benchmark_webhook,
+              'upload': benchmark_upload}
+
+
+def main():
+    """ Main entry point of the app """
+
+    p = argparse.ArgumentParser(description="Runs performance benchmarks.")
+    p.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                   help='benchmarks to run: ' + ', '.join(BENCHMARKS))
+    p.add_argument('--comments', type=int, default=1000000,
+                   help='amount of synthetic comments to parse')
+    p.add_argument('--rounds', type=int, default=3,
+                   help='times every benchmark is repeated')
+    p.add_argument('--post_comments', type=int, default=10000,
+                   help='amount of comments served by fake Graph API')
+    p.add_argument('--latency', type=float, default=0.0,
+                   help='seconds fake services wait before responding')
+    p.add_argument('--error_rate', type=float, default=0.0,
+                   help='share of fake service requests that fail')
+    p.add_argument('--container_delay', type=float, default=2.0,
+                   help='seconds fake Graph API takes to process a video')
+    p.add_argument('--slow_host_latency', type=float, default=3.0,
+                   help='seconds the first file host waits in the upload benchmark')
+    p.add_argument('--hedge_delay', type=float, default=0.5,
+                   help='seconds before the upload benchmark uses the second host')
+    p.add_argument('--metrics_path', default=None,
+                   help='file that collected metrics are written to as JSON')
+    options = p.parse_args()
+    unknown = set(options.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        p.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    if options.metrics_path:
+        # Workspace is a temporary directory, so the path is resolved first.
+        options.metrics_path = os.path.abspath(options.metrics_path)
+    prepare_workspace()
+
+    for name in options.benchmarks:
+        logger.info("Running benchmark " + name + ".")
+        result = BENCHMARKS[name](options)
+        logger.info(name + ": " + str(result))
+    if options.metrics_path:
+        from metrics import metrics
+        metrics.export(options.metrics_path, 'json')
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
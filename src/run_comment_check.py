@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 from datetime import datetime, timedelta
-import re
+from itertools import islice
 from parse_config import get_configuration
 from graph_handler import GraphHandler
 from db_handler import DatabaseHandler
+from metrics import instrumented
 from logzero import logger
+import vote_parser
 
 
 def get_media_id(dbh):
@@ -17,42 +19,110 @@ def get_media_id(dbh):
     return media_id
 
 
-def sanitize_comment(comment):
-    """ Removes unwanted characters from a string that could be harmful. """
-
-    unwanted = "\"();:\'"
-    # Replacing unwanted characters with None
-    sanitized = comment.translate({ord(i): None for i in unwanted})
-    return sanitized
-
-
-def parse_comments(comments):
-    """ Parses comments and checks which water amount wins the vote."""
-
-    vote_result = {'water_amount': 0, 'vote_count': 0}
-    votes = dict()
-    # Iterating through every comment
-    for comment in comments:
-        sanitized = sanitize_comment(comment['text'])
-        logger.info("Comment: " + sanitized)
-        match = re.search("[0-9][0-9]?\s?(ml)", sanitized)
-        if match:
-            # Get match
-            result = match.group(0)
-            # Remove whitespace and milliliter characters.
-            amount = str(result.translate({ord(i): None for i in " ml"}))
-            if amount in votes:
-                votes[amount] += 1
-            else:
-                votes[amount] = 1
-    if votes:
-        water_amount = max(votes, key=votes.get)
-        vote_result['water_amount'] = int(water_amount)
-        vote_result['vote_count'] = int(votes[water_amount])
-        logger.info("Voted amount of water is: " + water_amount + " ml.")
-    else:
+def get_account_media_ids(dbh):
+    """ Returns media ids of current day's post on every account. """
+
+    date = datetime.now().date()
+    return list(dbh.get_daily_run(date)['media_ids'].values())
+
+
+def get_voter(comment):
+    """ Returns identifier of the user who wrote a comment. """
+
+    author = comment.get('from') or dict()
+    return str(author.get('id') or comment.get('username') or comment['id'])
+
+
+def iterate_votes(comments):
+    """ Yields (user id, water amount, comment id, timestamp) of every vote.
+
+    Comments without a vote are skipped. Comments are parsed in batches.
+    """
+
+    comments = iter(comments)
+    while True:
+        batch = list(islice(comments, vote_parser.BATCH_SIZE))
+        if not batch:
+            break
+        amounts = vote_parser.parse_votes([comment['text'] for comment in batch])
+        for comment, amount in zip(batch, amounts):
+            if amount is not None:
+                yield (get_voter(comment), amount, comment['id'],
+                       comment['timestamp'])
+
+
+def iterate_new_comments(gh, media_id, cursor, first_page=None):
+    """ Yields comments that are newer than the stored cursor.
+
+    Cursor is advanced to the newest yielded comment. Comments are
+    returned newest first, so paging stops at the first page that
+    reaches already counted comments.
+    """
+
+    last_timestamp = cursor['last_timestamp']
+    boundary_ids = set(cursor['boundary_ids'])
+    for page in gh.iterate_comment_pages(media_id, first_page):
+        new_comments = [comment for comment in page
+                        if comment['timestamp'] > last_timestamp
+                        or (comment['timestamp'] == last_timestamp
+                            and comment['id'] not in boundary_ids)]
+        for comment in new_comments:
+            # Move high-water mark forward.
+            if comment['timestamp'] > cursor['last_timestamp']:
+                cursor['last_timestamp'] = comment['timestamp']
+                cursor['boundary_ids'] = []
+            if comment['timestamp'] == cursor['last_timestamp']:
+                cursor['boundary_ids'].append(comment['id'])
+        yield from new_comments
+        if len(new_comments) < len(page):
+            logger.info("Reached previously counted comments.")
+            break
+
+
+def record_new_votes(dbh, gh, media_id, comment_media_id, first_page=None):
+    """ Records votes of new comments of a post as votes for media_id. """
+
+    cursor = dbh.get_comment_cursor(comment_media_id)
+    logger.info("Parsing comments of " + str(comment_media_id) + " newer than " +
+                (cursor['last_timestamp'] or "the beginning") + ".")
+    # Comments are parsed in batches while next pages are fetched.
+    votes = iterate_votes(iterate_new_comments(gh, comment_media_id, cursor,
+                                               first_page))
+    while True:
+        batch = list(islice(votes, vote_parser.BATCH_SIZE))
+        if not batch:
+            break
+        dbh.record_votes(media_id, batch)
+    # Cursor is stored after the votes, so an interrupted check only
+    # records the same votes again.
+    dbh.set_comment_cursor(comment_media_id, cursor)
+
+
+def update_vote_tally(dbh, gh, media_id, account_media_ids=()):
+    """ Records votes of new comments of the post and returns the result.
+
+    Comments on the same post of other accounts are counted as votes
+    for media_id too. First pages of several posts are fetched with
+    one batch request.
+    """
+
+    media_ids = [str(media_id)]
+    media_ids.extend(str(account_media_id) for account_media_id
+                     in account_media_ids if str(account_media_id) not in media_ids)
+    first_pages = dict()
+    if len(media_ids) > 1:
+        first_pages = gh.get_first_comment_pages(media_ids)
+    for comment_media_id in media_ids:
+        record_new_votes(dbh, gh, media_id, comment_media_id,
+                         first_pages.get(comment_media_id))
+    # Get most voted water amount and vote count.
+    result = dbh.get_vote_tally(media_id)
+    if result is None:
         logger.warning("No votes found.")
-    return vote_result
+        return {'water_amount': 0, 'vote_count': 0}
+    logger.info("Voted amount of water is: " + str(result['water_amount']) +
+                " ml with " + str(result['vote_count']) + " votes.")
+    return result
 
 
 def set_vote_results_to_db(dbh, result):
@@ -60,34 +130,43 @@ def set_vote_results_to_db(dbh, result):
 
     # Get tomorrows date and set it to dictionary.
     result['date'] = datetime.now().date() + timedelta(days=1)
-    logger.info("Inserting vote results into table.")
-    dbh.insert_to_table(result)
+    logger.info("Updating vote results into table.")
+    dbh.upsert_to_table(result)
     dbh.get_all()
 
 
-def main():
-    """ Main entry point of the app """
-    # Get configuration
-    args = get_configuration()
-    # Create Instagram Graph API handler object
-    gh = GraphHandler(args)
-    dbh = DatabaseHandler(args)
+def check_comments(dbh, gh):
+    """ Counts new votes of today's post into tomorrow's water amount. """
+
+    # Make sure that tables exist.
+    dbh.setup_table()
     media_id = get_media_id(dbh)
     if media_id:
-        logger.info("Media id received, getting comments for the post.")
-        comments = gh.get_comments_for_post(media_id)
-        logger.info("Parsing comments.")
-        # Get most voted water amount and vote count.
-        result = parse_comments(comments)
+        logger.info(
+            "Media id received, getting new comments for the post.")
+        result = update_vote_tally(dbh, gh, media_id, get_account_media_ids(dbh))
         # Set result to database for tomorrow's entry.
         set_vote_results_to_db(dbh, result)
     else:
-        logger.info(
-            "Comments cannot be checked so using default value as water amount.")
+        logger.info("Comments cannot be checked so using default value "
+                    "as water amount.")
         # Update database with zeroes.
         set_vote_results_to_db(dbh, {'water_amount': 0, 'vote_count': 0})
 
-    dbh.cleanup()
+
+def main(args=None):
+    """ Main entry point of the app """
+    # Get configuration
+    if args is None:
+        args = get_configuration()
+    with instrumented(args, 'comment_check'):
+        # Create Instagram Graph API handler object
+        gh = GraphHandler(args)
+        dbh = DatabaseHandler(args)
+        try:
+            check_comments(dbh, gh)
+        finally:
+            dbh.cleanup()
 
 
 if __name__ == "__main__":
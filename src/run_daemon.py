@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import signal
+from parse_config import get_configuration
+from db_handler import DatabaseHandler
+from graph_handler import GraphHandler
+from video_uploader import VideoUploader
+from outbox import Outbox
+from run_daily_process import DailyProcess
+from run_comment_check import check_comments
+from scheduler import Scheduler
+from metrics import instrumented
+from logzero import logger
+
+
+def create_webhook_server(args, dbh):
+    """ Returns webhook server if an app secret is configured. """
+
+    if not args.app_secret:
+        return None
+    from webhook_server import WebhookServer
+    return WebhookServer(dbh, args.app_secret, args.webhook_verify_token,
+                         args.webhook_host, args.webhook_port)
+
+
+class Daemon:
+    """ Resident service that runs the daily process and comment checks.
+
+    Configuration is parsed and database and Graph API connections are
+    opened once and kept warm between jobs. Camera and GPIO are only
+    opened while the plant is watered. Videos are posted by an outbox
+    worker thread, which also posts videos that failed earlier.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.dbh = DatabaseHandler(args)
+        self.graph_handler = GraphHandler(args)
+        self.outbox = Outbox(self.dbh, VideoUploader(args), self.graph_handler,
+                             args.outbox_workers)
+        self.daily = DailyProcess(args, self.dbh, self.graph_handler, self.outbox)
+        self.webhook_server = create_webhook_server(args, self.dbh)
+        self.scheduler = Scheduler()
+        self.scheduler.daily('daily_process', args.watering_time,
+                             self.run_daily_process)
+        self.scheduler.every('comment_check', args.comment_check_interval,
+                             self.run_comment_check)
+
+    def run_daily_process(self):
+        with instrumented(self.args, 'daily_process'):
+            self.daily.start_process()
+
+    def run_comment_check(self):
+        with instrumented(self.args, 'comment_check'):
+            check_comments(self.dbh, self.graph_handler)
+
+    def run(self):
+        """ Runs scheduled jobs until stop() is called. """
+
+        if self.webhook_server:
+            self.webhook_server.start()
+        if self.args.dry_run == "False":
+            self.outbox.start()
+        try:
+            self.scheduler.run()
+        finally:
+            if self.webhook_server:
+                self.webhook_server.stop()
+            self.outbox.stop()
+            self.daily.close()
+            self.dbh.cleanup()
+
+    def stop(self):
+        logger.info("Stopping daemon.")
+        self.scheduler.stop()
+
+
+def main(args=None):
+    """ Main entry point of the app """
+
+    # Get configuration
+    if args is None:
+        args = get_configuration()
+    daemon = Daemon(args)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        logger.info("Daemon interrupted.")
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -1,105 +1,262 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+import hashlib
+import os
 import time
 from parse_config import get_configuration
 from video_uploader import VideoUploader
-from pump_controller import PumpController
+from hardware import create_pump_controller
+from pump_dosing import PumpCalibration, PumpDoser
+from video_trimmer import trim_video
+from mp4_container import is_finalized
+from image_store import ImageStore
+from camera_controller import IMAGE_PATH
 from graph_handler import GraphHandler
+from outbox import Outbox
 from db_handler import DatabaseHandler
+from stage_runner import StageGraph, StageFailed
+from metrics import instrumented
 from logzero import logger
 
 
+# Maximum amount of stages that are run at the same time.
+MAX_PARALLEL_STAGES = 4
+# Millilitres given when today's post has no voted water amount.
+DEFAULT_WATER_AMOUNT = 25
+# Shortest recording in seconds, so that a video exists for small doses.
+MIN_RECORDING_SECONDS = 3
+
+
+def file_hash(path):
+    """ Returns SHA-256 hex digest of a file. """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class DailyProcess():
+    """ Waters the plant and adds the video of the watering to the outbox.
+
+    Result of every stage is stored in the daily_runs table, so a rerun
+    of the same day continues from the first unfinished stage. The plant
+    is never watered twice a day and a still valid video is used again.
+    Video is posted by the outbox, so watering does not wait for the
+    network.
+    """
 
-    def __init__(self, args) -> None:
+    def __init__(self, args, dbh=None, graph_handler=None, outbox=None) -> None:
         self.args = args
-        # Initialize helper objects.
-        self.dbh = DatabaseHandler(args)
+        # Initialize helper objects. Resident processes pass their own
+        # handles, which are then left open by close().
+        self.owns_dbh = dbh is None
+        self.dbh = dbh or DatabaseHandler(args)
         self.video_uploader = VideoUploader(args)
-        self.graph_handler = GraphHandler(args)
-        self.pump_controller = PumpController()
+        self.graph_handler = graph_handler or GraphHandler(args)
+        # Camera and GPIO are opened when watering starts.
+        self.pump_controller = create_pump_controller(args)
+        calibration = PumpCalibration(args.pump_flow_rate, args.pump_stall_duty,
+                                      args.pump_duty_cycle, args.pump_ramp_seconds)
+        self.pump_doser = PumpDoser(self.pump_controller, calibration,
+                                    args.max_water_amount)
+        self.image_store = ImageStore(self.dbh, IMAGE_PATH, args.image_format,
+                                      args.image_quality, args.image_retention_days,
+                                      args.thumbnail_retention_days)
+        self.outbox = outbox or Outbox(self.dbh, self.video_uploader,
+                                       self.graph_handler, args.outbox_workers)
+        self.date = None
+        self.run = None
 
     def start_process(self):
+        """ Runs the daily watering and posting stages and returns the graph. """
+
+        self.date = datetime.now().date()
+        self.run = self.dbh.get_daily_run(self.date)
+        # Video paths must not change if the run continues past midnight.
+        self.pump_controller.cam.set_date(self.date)
+        return self.run_common_process()
+
+    def checkpoint(self, **fields):
+        """ Stores results of a stage into today's run. """
+
+        self.dbh.update_daily_run(self.date, **fields)
+        self.run.update(fields)
+
+    def close(self):
+        """ Stops the dosing worker and closes the database if owned. """
+
+        self.pump_doser.close()
+        if self.owns_dbh:
+            self.dbh.cleanup()
+
+    def prepare_database(self, results=None):
+        """ Makes sure that today's post has a database entry. """
+
         # Check if it isn't first post.
         if not self.dbh.is_first_post():
             logger.info("Performing normal daily process.")
-            # Run common process that handles watering and posting.
-            self.run_common_process()
         else:
             logger.info("Performing first posting process.")
             # Create first entry to database.
             self.create_first_entry()
-            self.run_common_process()
-        self.dbh.cleanup()
+        return True
 
     def create_first_entry(self):
         """ Creates first database entry. """
 
         logger.info("Creating database entry for the first post.")
-        # Get current date
-        date = datetime.now().date()
         # Payload contains date, water amount and vote_count.
-        payload = {'date': date, 'water_amount': 25, 'vote_count': 0}
+        payload = {'date': self.date, 'water_amount': DEFAULT_WATER_AMOUNT,
+                   'vote_count': 0}
         # Create table if needed.
         self.dbh.setup_table()
         # Inserting payload to table.
         self.dbh.insert_to_table(payload)
 
+    def build_stage_graph(self):
+        """ Builds the graph of daily stages and their dependencies.
+
+        Still image capture and archiving run while the video is trimmed.
+        """
+
+        graph = StageGraph(max_workers=MAX_PARALLEL_STAGES)
+        graph.add('prepare_database', self.prepare_database)
+        # Watering is never retried so that the plant is not watered twice.
+        # Voted water amount is read from today's database entry.
+        graph.add('water', self.run_watering_process,
+                  depends_on=['prepare_database'])
+        graph.add('capture_image', self.capture_image,
+                  depends_on=['water'], retries=1)
+        # Encoding and storing the image is not waited for by posting.
+        graph.add('archive_image', self.archive_image,
+                  depends_on=['capture_image', 'prepare_database'])
+        if self.args.dry_run == "False":
+            graph.add('trim', self.trim_video, depends_on=['water'])
+            graph.add('enqueue_post', self.enqueue_post,
+                      depends_on=['trim', 'prepare_database'])
+        else:
+            logger.info(
+                "Dry run is selected. Publishing will not be performed.")
+        return graph
+
     def run_common_process(self):
         """ Common process that runs the watering and posting processes. """
 
-        # If watering process succeeded, continue to posting process.
-        if self.run_watering_process():
-            if self.args.dry_run == "False":
-                logger.info("Continuing to uploading process.")
-                self.run_upload_process()
-            else:
-                logger.info(
-                    "Dry run is selected. Publishing will not be performed.")
-        else:
-            logger.error("Error happened while running watering process.")
-
-    def run_upload_process(self):
-        """ Uploads recorded video to File.io and sends it to Instagram. """
-
-        logger.info("Running upload process.")
-        # Get url to uploaded video.
-        video_url = self.video_uploader.upload_video()
-        if video_url:
-            logger.info("Video url is: " + video_url)
-            media_dict = self.graph_handler.start_posting_process(video_url)
-            logger.info(media_dict)
-            if 'id' in media_dict:
-                logger.info("Updating media id to database.")
-                # Update media id to database post entry.
-                self.dbh.update_media_id(
-                    media_dict['id'], datetime.now().date())
-                self.dbh.get_all()
-        else:
-            logger.error("Did not receive video url.")
+        graph = self.build_stage_graph()
+        if not graph.run():
+            logger.error("Daily process did not complete every stage.")
+        return graph
+
+    def capture_image(self, results=None):
+        """ Captures the daily still image of the plant and returns it. """
+
+        if self.image_store.get(self.date):
+            logger.info("Image of today is already archived.")
+            return None
+        return self.pump_controller.cam.capture_image(self.args.image_format,
+                                                      self.args.image_quality)
+
+    def archive_image(self, results):
+        """ Stores captured image into the archive and removes expired ones. """
 
-    def run_watering_process(self):
-        """ Runs plant watering process. """
+        if results['capture_image'] is None:
+            return self.image_store.get(self.date)
+        self.image_store.import_legacy_images()
+        image = self.image_store.save(self.date, results['capture_image'])
+        self.image_store.apply_retention()
+        return image
 
+    def trim_video(self, results=None):
+        """ Trims recorded video to the watering and returns its path. """
+
+        stored_path = self.run['video_path']
+        if stored_path and os.path.exists(stored_path) and \
+                file_hash(stored_path) == self.run['video_hash']:
+            logger.info("Using video of the earlier run " + stored_path + ".")
+            return stored_path
+        cam = self.pump_controller.cam
+        video_path = cam.video_file_path + ".mp4"
+        if not os.path.exists(video_path):
+            raise StageFailed("Video of today's watering is missing.")
+        # Watering is not repeated, so an interrupted recording cannot be
+        # made again either.
+        if not is_finalized(video_path):
+            raise StageFailed("Recording of today's watering was not finished.")
+        if self.args.video_trimming != "off":
+            try:
+                video_path = trim_video(video_path, cam.video_file_path + "_trimmed.mp4",
+                                        cam.motion_file_path, cam.resolution,
+                                        self.args.trim_padding)
+            except Exception as ex:
+                # Untrimmed video is still worth posting.
+                logger.warning("Trimming video failed, using the whole video.")
+                logger.error(ex)
+        video_hash = file_hash(video_path)
+        fields = {'video_path': video_path, 'video_hash': video_hash}
+        # Url of another video must not be posted.
+        if video_hash != self.run['video_hash']:
+            fields.update(video_url=None, url_expires_at=None)
+        self.checkpoint(**fields)
+        return video_path
+
+    def enqueue_post(self, results):
+        """ Adds trimmed video into the outbox to be posted. """
+
+        self.outbox.enqueue(self.date, results['trim'])
+        return True
+
+    def run_watering_process(self, results=None):
+        """ Waters the voted amount while recording and returns the dose. """
+
+        if self.run['watered_at'] is not None:
+            logger.info("Plant was already watered today, skipping watering.")
+            return {'requested_ml': None, 'delivered_ml': self.run['delivered_ml'],
+                    'seconds': 0.0}
         logger.info("Starting watering process.")
-        # Starting pump and recording.
-        self.pump_controller.run_pump_forward()
-        # Waiting for 5 seconds.
-        time.sleep(5)
-        # Stopping pump and recording.
-        self.pump_controller.stop_pump()
+        water_amount = self.dbh.get_water_amount(self.date)
+        # Days without votes store an amount of zero.
+        if not water_amount or water_amount <= 0:
+            water_amount = DEFAULT_WATER_AMOUNT
+        # Watering is stored before the pump starts, so that an interrupted
+        # watering is not repeated either.
+        self.checkpoint(watered_at=time.time())
+        start = time.monotonic()
+        # Starting recording and pumping the voted amount of water.
+        self.pump_controller.cam.start_record()
+        try:
+            dose = self.pump_doser.dose(water_amount).result()
+        finally:
+            # Small doses are recorded for a minimum time.
+            remaining = MIN_RECORDING_SECONDS - (time.monotonic() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+            # Stopping pump and recording.
+            recorded = self.pump_controller.stop_pump()
+        self.checkpoint(delivered_ml=dose['delivered_ml'])
+        if not recorded:
+            raise StageFailed("Recording of the watering failed.")
         logger.info("Watering process completed.")
-        return True
+        return dose
 
 
-def main():
+def main(args=None):
     """ Main entry point of the app """
 
     # Get configuration
-    args = get_configuration()
-    daily = DailyProcess(args)
-    daily.start_process()
+    if args is None:
+        args = get_configuration()
+    with instrumented(args, 'daily_process'):
+        daily = DailyProcess(args)
+        try:
+            daily.start_process()
+            if args.dry_run == "False":
+                # Today's video and earlier posts that failed are posted now.
+                daily.outbox.drain()
+        finally:
+            daily.close()
 
 
 if __name__ == "__main__":
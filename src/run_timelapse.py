@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+from parse_config import get_configuration
+from camera_controller import IMAGE_PATH, VIDEO_PATH
+from timelapse import TimelapseBuilder
+from db_handler import DatabaseHandler
+from video_uploader import VideoUploader
+from graph_handler import GraphHandler
+from outbox import Outbox, TIMELAPSE_PREFIX
+from metrics import instrumented
+from logzero import logger
+
+
+# Directory of the encoded image cache inside the image archive.
+TIMELAPSE_CACHE_PATH = IMAGE_PATH + "timelapse/"
+
+
+def main(args=None):
+    """ Main entry point of the app """
+
+    # Get configuration
+    if args is None:
+        args = get_configuration()
+    with instrumented(args, 'timelapse'):
+        builder = TimelapseBuilder(IMAGE_PATH, TIMELAPSE_CACHE_PATH,
+                                   images_per_second=args.timelapse_speed)
+        # Only images captured since the last run are encoded.
+        builder.update()
+        date = datetime.now().date()
+        video_path = VIDEO_PATH + "timelapse-" + str(date) + ".mp4"
+        images = builder.build(video_path)
+        if not images:
+            return
+        if args.dry_run != "False":
+            logger.info("Dry run is selected. Timelapse will not be published.")
+            return
+        caption = "Growth of the plant in " + str(images) + " days."
+        dbh = DatabaseHandler(args)
+        try:
+            outbox = Outbox(dbh, VideoUploader(args), GraphHandler(args),
+                            args.outbox_workers)
+            # Timelapse counts against the publishing limit like other
+            # posts, and the outbox posts it later if it cannot be posted now.
+            outbox.enqueue(TIMELAPSE_PREFIX + str(date), video_path, caption)
+            outbox.drain()
+        finally:
+            dbh.cleanup()
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import signal
+import threading
+from parse_config import get_configuration
+from db_handler import DatabaseHandler
+from webhook_server import WebhookServer
+from logzero import logger
+
+
+def main(args=None):
+    """ Main entry point of the app """
+
+    # Get configuration
+    if args is None:
+        args = get_configuration()
+    dbh = DatabaseHandler(args)
+    try:
+        server = WebhookServer(dbh, args.app_secret, args.webhook_verify_token,
+                               args.webhook_host, args.webhook_port)
+    except ValueError as ve:
+        logger.error(ve)
+        dbh.cleanup()
+        return
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    with server:
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        logger.info("Stopping webhook server.")
+    dbh.cleanup()
+
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta
+import threading
+from logzero import logger
+from metrics import metrics
+
+
+# Longest time in seconds that the scheduler sleeps at once. Raspberry Pi
+# has no real-time clock, so the wall clock may jump when it is synced
+# and due times are checked again at least this often.
+MAX_SLEEP = 60
+
+
+class Job:
+    """ Scheduled function and the wall clock time of its next run. """
+
+    def __init__(self, name, func, interval=None, at=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.at = at
+        self.next_run = None
+
+    @property
+    def period(self):
+        """ Longest possible time between two runs. """
+
+        if self.interval is not None:
+            return timedelta(seconds=self.interval)
+        return timedelta(days=1)
+
+    def schedule_next(self, now):
+        """ Sets the next run after now. """
+
+        if self.interval is not None:
+            self.next_run = now + timedelta(seconds=self.interval)
+            return
+        next_run = now.replace(hour=self.at.hour, minute=self.at.minute,
+                               second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        self.next_run = next_run
+
+
+class Scheduler:
+    """ Runs jobs at fixed intervals or daily at a time of day.
+
+    Jobs are run one at a time in the thread that calls run(), so they
+    never use the shared handles at the same time. Failing jobs are
+    logged and scheduled again as usual.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.stopping = threading.Event()
+
+    def every(self, name, seconds, func):
+        """ Runs func every given seconds, first time after one interval. """
+
+        if seconds <= 0:
+            raise ValueError("Interval of job " + name + " must be positive.")
+        return self.add(Job(name, func, interval=seconds))
+
+    def daily(self, name, at, func):
+        """ Runs func every day at local time given as HH:MM. """
+
+        try:
+            time_of_day = datetime.strptime(at, '%H:%M').time()
+        except ValueError:
+            raise ValueError("Time of job " + name + " must be HH:MM, not " +
+                             str(at) + ".")
+        return self.add(Job(name, func, at=time_of_day))
+
+    def add(self, job):
+        job.schedule_next(datetime.now())
+        self.jobs.append(job)
+        logger.info("Scheduled " + job.name + " at " + str(job.next_run) + ".")
+        return job
+
+    def run_pending(self):
+        """ Runs jobs that are due and returns seconds until the next one. """
+
+        now = datetime.now()
+        for job in self.jobs:
+            # Clock was turned back, so the run would be late.
+            if job.next_run - now > job.period:
+                job.schedule_next(now)
+        for job in sorted(self.jobs, key=lambda job: job.next_run):
+            if self.stopping.is_set():
+                break
+            if job.next_run > datetime.now():
+                continue
+            logger.info("Running scheduled job " + job.name + ".")
+            try:
+                job.func()
+            except Exception as ex:
+                metrics.increment('job_failures', job=job.name)
+                logger.error("Scheduled job " + job.name + " failed.")
+                logger.exception(ex)
+            job.schedule_next(datetime.now())
+            logger.info("Next " + job.name + " at " + str(job.next_run) + ".")
+        if not self.jobs:
+            return MAX_SLEEP
+        next_run = min(job.next_run for job in self.jobs)
+        return max(0.0, (next_run - datetime.now()).total_seconds())
+
+    def run(self):
+        """ Runs jobs until stop() is called. """
+
+        while not self.stopping.is_set():
+            self.stopping.wait(min(self.run_pending(), MAX_SLEEP))
+
+    def stop(self):
+        """ Stops the scheduler after the running job. """
+
+        self.stopping.set()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
+from logzero import logger
+from metrics import metrics
+
+
+class StageFailed(Exception):
+    """ Raised by a stage to signal that it did not succeed. """
+
+
+class Stage:
+    """ Single step of a stage graph. """
+
+    def __init__(self, name, func, depends_on=(), retries=0, retry_delay=1.0):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+class StageGraph:
+    """ Runs stages concurrently as soon as the stages they depend on succeed.
+
+    Stage functions are called with a dictionary of results of finished
+    stages. A stage fails if it raises an exception or returns False, and
+    it is retried on its own before the stages depending on it are
+    skipped.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = dict()
+        self.results = dict()
+        # Timing information of stages by stage name.
+        self.timings = dict()
+        self.failed = set()
+        self.skipped = set()
+
+    def add(self, name, func, depends_on=(), retries=0, retry_delay=1.0):
+        """ Adds a stage to the graph. """
+
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError("Unknown dependency " + dependency +
+                                 " for stage " + name + ".")
+        self.stages[name] = Stage(name, func, depends_on, retries, retry_delay)
+        return self
+
+    def run(self):
+        """ Runs every stage and returns True if all of them succeeded. """
+
+        start = time.perf_counter()
+        waiting = dict(self.stages)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while waiting or running:
+                for name, stage in list(waiting.items()):
+                    dependencies = set(stage.depends_on)
+                    if dependencies & (self.failed | self.skipped):
+                        logger.warning("Skipping stage " + name +
+                                       " because a dependency failed.")
+                        self.skipped.add(name)
+                        del waiting[name]
+                    elif dependencies.issubset(self.results):
+                        running[executor.submit(self.run_stage, stage)] = name
+                        del waiting[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    succeeded, result = future.result()
+                    if succeeded:
+                        self.results[name] = result
+                    else:
+                        self.failed.add(name)
+        self.timings['total'] = {'seconds': time.perf_counter() - start,
+                                 'attempts': 1}
+        self.log_timings()
+        return not (self.failed or self.skipped)
+
+    def run_stage(self, stage):
+        """ Runs a stage with retries. Returns success flag and result. """
+
+        attempts = 0
+        start = time.perf_counter()
+        while True:
+            attempts += 1
+            logger.info("Starting stage " + stage.name + ".")
+            try:
+                result = stage.func(dict(self.results))
+                succeeded = result is not False
+            except Exception as ex:
+                logger.exception(ex)
+                result, succeeded = None, False
+            if succeeded or attempts > stage.retries:
+                break
+            metrics.increment('stage_retries', stage=stage.name)
+            logger.warning("Stage " + stage.name + " failed, retrying in " +
+                           str(stage.retry_delay) + " seconds.")
+            time.sleep(stage.retry_delay)
+        self.timings[stage.name] = {'seconds': time.perf_counter() - start,
+                                    'attempts': attempts}
+        metrics.observe('stage', self.timings[stage.name]['seconds'],
+                        stage=stage.name)
+        if not succeeded:
+            metrics.increment('stage_failures', stage=stage.name)
+            logger.error("Stage " + stage.name + " failed.")
+        return succeeded, result
+
+    def log_timings(self):
+        """ Logs how long every stage took. """
+
+        for name, timing in self.timings.items():
+            logger.info("Stage " + name + " took " +
+                        "{:.2f}".format(timing['seconds']) + " seconds in " +
+                        str(timing['attempts']) + " attempt(s).")
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+from fractions import Fraction
+import json
+import math
+import os
+from logzero import logger
+from account_registry import write_json_atomic
+from mp4_container import Mp4Muxer
+from image_store import THUMBNAIL_SUFFIX
+from metrics import metrics
+
+
+# File name suffixes of archived images.
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+# Size of the timelapse video.
+TIMELAPSE_RESOLUTION = (1280, 720)
+# Frame rate of the timelapse video. Instagram requires at least 23.
+TIMELAPSE_FRAMERATE = 30
+# Frames that every image is shown for at least. Intra frames of two
+# images are then never next to each other, since the second one would
+# need another idr_pic_id.
+MIN_HOLD_FRAMES = 2
+# Shortest timelapse in seconds accepted by Instagram.
+MIN_TIMELAPSE_SECONDS = 3
+# Constant rate factor of the encoder, lower is better quality.
+TIMELAPSE_CRF = 23
+# Intermediate stream and index of already encoded images.
+SEGMENTS_FILE = "segments.h264"
+INDEX_FILE = "index.json"
+# NAL unit types of supplemental information that is not kept.
+NAL_SEI = 6
+
+
+def image_timestamp(path):
+    """ Returns capture time of an archived image.
+
+    Images are named by their capture date or, in earlier versions, by
+    their capture timestamp. Modification time is used for other names.
+    """
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return float(stem)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(stem, '%Y-%m-%d').timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def iterate_archive(image_dir):
+    """ Yields paths of archived full size images in capture order.
+
+    Images are searched from the archive root and its year and month
+    directories. Thumbnails are skipped.
+    """
+
+    paths = []
+    for directory, subdirectories, names in os.walk(image_dir):
+        # Only dated directories contain archived images.
+        subdirectories[:] = [name for name in subdirectories if name.isdigit()]
+        paths.extend(os.path.join(directory, name) for name in names
+                     if name.lower().endswith(IMAGE_EXTENSIONS) and
+                     not os.path.splitext(name)[0].endswith(THUMBNAIL_SUFFIX))
+    paths.sort(key=image_timestamp)
+    yield from paths
+
+
+class TimelapseBuilder:
+    """ Builds a timelapse video of the image archive incrementally.
+
+    Every image is encoded once into an intra frame followed by P frames
+    that repeat it, which only take a few bytes each. Encoded images are
+    appended to an intermediate H.264 stream in the cache directory, so
+    a new day only encodes the new image. Images are decoded one at a
+    time, so memory usage does not depend on the size of the archive.
+    The video is remuxed from the intermediate stream without encoding.
+    """
+
+    def __init__(self, image_dir, cache_dir, resolution=TIMELAPSE_RESOLUTION,
+                 images_per_second=10, crf=TIMELAPSE_CRF):
+        import av
+        self.av = av
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir
+        self.resolution = tuple(resolution)
+        self.images_per_second = images_per_second
+        # Frames of the constant frame rate that every image is shown for.
+        self.hold_frames = max(MIN_HOLD_FRAMES,
+                               int(round(TIMELAPSE_FRAMERATE / images_per_second)))
+        self.crf = crf
+        self.segments_path = os.path.join(cache_dir, SEGMENTS_FILE)
+        self.index_path = os.path.join(cache_dir, INDEX_FILE)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def settings(self):
+        """ Returns encoder settings that encoded frames depend on. """
+
+        return {'resolution': list(self.resolution), 'crf': self.crf,
+                'framerate': TIMELAPSE_FRAMERATE, 'hold_frames': self.hold_frames}
+
+    def load_index(self):
+        """ Returns index of encoded images or an empty one.
+
+        Index is reset if encoder settings have changed. The intermediate
+        stream is cut to the size recorded in the index, so a frame that
+        was written without updating the index is dropped.
+        """
+
+        index = {'settings': self.settings(), 'size': 0, 'frames': []}
+        try:
+            with open(self.index_path) as index_file:
+                stored = json.load(index_file)
+            if stored.get('settings') == index['settings']:
+                index = stored
+            else:
+                logger.info("Timelapse settings changed, "
+                            "encoding every image again.")
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.warning("Timelapse index is corrupted, "
+                           "encoding every image again.")
+        with open(self.segments_path, 'a+b') as segments:
+            segments.truncate(index['size'])
+        return index
+
+    def update(self):
+        """ Encodes archived images that are newer than the last encoded one.
+
+        Returns the amount of encoded images.
+        """
+
+        index = self.load_index()
+        encoded = {frame['image'] for frame in index['frames']}
+        latest = index['frames'][-1]['timestamp'] if index['frames'] else None
+        added = 0
+        with open(self.segments_path, 'ab') as segments:
+            for path in iterate_archive(self.image_dir):
+                name = os.path.basename(path)
+                timestamp = image_timestamp(path)
+                if name in encoded:
+                    continue
+                if latest is not None and timestamp < latest:
+                    logger.warning("Skipping image " + name +
+                                   " that is older than the timelapse.")
+                    continue
+                try:
+                    data = self.encode_image(path)
+                except Exception as ex:
+                    logger.warning("Could not encode image " + name + ".")
+                    logger.error(ex)
+                    continue
+                segments.write(data)
+                segments.flush()
+                os.fsync(segments.fileno())
+                index['frames'].append({'image': name, 'timestamp': timestamp,
+                                        'offset': index['size'],
+                                        'size': len(data)})
+                index['size'] += len(data)
+                latest = timestamp
+                added += 1
+                # Index is saved after every image so that an interrupted
+                # update does not encode the same images again.
+                write_json_atomic(self.index_path, index)
+        metrics.increment('timelapse_images_encoded', added)
+        logger.info("Encoded " + str(added) + " new images into timelapse of " +
+                    str(len(index['frames'])) + " images.")
+        return added
+
+    def encode_image(self, path, hold_frames=None):
+        """ Returns image encoded as H.264 frames with parameter sets.
+
+        Image is an intra frame that is repeated by P frames until it has
+        been shown for hold_frames frames.
+        """
+
+        hold_frames = hold_frames or self.hold_frames
+        codec = self.av.CodecContext.create('libx264', 'w')
+        codec.width, codec.height = self.resolution
+        codec.pix_fmt = 'yuv420p'
+        codec.time_base = Fraction(1, TIMELAPSE_FRAMERATE)
+        codec.framerate = Fraction(TIMELAPSE_FRAMERATE, 1)
+        codec.gop_size = hold_frames
+        codec.options = {'crf': str(self.crf), 'bf': '0'}
+        with self.av.open(path) as container:
+            image = next(container.decode(video=0))
+            frame = image.reformat(width=self.resolution[0],
+                                   height=self.resolution[1], format='yuv420p')
+        # New frame drops the picture type of the decoded image, which the
+        # encoder would take as a forced intra frame for every repeat.
+        frame = self.av.VideoFrame.from_ndarray(frame.to_ndarray(),
+                                                format='yuv420p')
+        packets = []
+        for index in range(hold_frames):
+            frame.pts = index
+            packets.extend(codec.encode(frame))
+        packets.extend(codec.encode(None))
+        stream = b''.join(bytes(packet) for packet in packets)
+        # Encoder information in SEI units would be repeated for every frame.
+        nals = [nal for nal in stream.split(b'\x00\x00\x01')[1:]
+                if nal and nal[0] & 0x1f != NAL_SEI]
+        return b''.join(b'\x00\x00\x00\x01' + nal.rstrip(b'\x00')
+                        for nal in nals)
+
+    def build(self, output_path):
+        """ Writes the timelapse video and returns amount of images in it.
+
+        Video has a constant frame rate. Images of a timelapse that would
+        be shorter than Instagram's minimum length are encoded again to
+        be shown longer.
+        """
+
+        index = self.load_index()
+        frames = index['frames']
+        if not frames:
+            logger.warning("No images to build a timelapse from.")
+            return 0
+        min_frames = MIN_TIMELAPSE_SECONDS * TIMELAPSE_FRAMERATE
+        hold_frames = max(self.hold_frames, math.ceil(min_frames / len(frames)))
+        paths = dict()
+        if hold_frames > self.hold_frames:
+            paths = {os.path.basename(path): path
+                     for path in iterate_archive(self.image_dir)}
+            if not all(frame['image'] in paths for frame in frames):
+                logger.warning("Images of a short timelapse are missing, "
+                               "timelapse is shorter than Instagram accepts.")
+                paths = dict()
+        with open(self.segments_path, 'rb') as segments, \
+                Mp4Muxer(output_path, framerate=TIMELAPSE_FRAMERATE) as muxer:
+            for frame in frames:
+                if paths:
+                    muxer.write(self.encode_image(paths[frame['image']],
+                                                  hold_frames))
+                    continue
+                segments.seek(frame['offset'])
+                muxer.write(segments.read(frame['size']))
+        logger.info("Built timelapse of " + str(len(frames)) + " images into " +
+                    output_path + ".")
+        return len(frames)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import os
+from fractions import Fraction
+import numpy as np
+from logzero import logger
+from mp4_container import Mp4Muxer, Mp4Reader
+
+
+# Seconds of video kept before and after the detected activity.
+DEFAULT_PADDING = 0.5
+# Instagram does not accept videos shorter than this many seconds.
+MIN_VIDEO_SECONDS = 3
+# Share of the distance from the quiet level to the peak activity level
+# that counts as activity.
+ACTIVITY_THRESHOLD = 0.25
+# Peak activity must be this many times the quiet level, otherwise the
+# whole video is kept since no clear activity was found.
+MIN_ACTIVITY_CONTRAST = 1.5
+# Trimmed video is cut at a sync frame without decoding if frames before
+# the activity make it at most this share longer, otherwise the kept part
+# is encoded again.
+MAX_SYNC_LEAD_SHARE = 0.1
+# Quality of encoded trimmed videos. Lower is better.
+TRIM_CRF = 23
+# Decoded frames are subsampled by this step in both directions before
+# they are compared.
+FRAME_SUBSAMPLE = 4
+# Motion vector record of picamera: x and y vector and sum of absolute
+# differences of a 16x16 macroblock.
+MOTION_DTYPE = np.dtype([('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])
+
+
+def activity_from_motion_vectors(motion_path, resolution):
+    """ Returns mean motion vector length of every frame.
+
+    Motion vectors are written by picamera alongside the H.264 stream
+    when motion_output is given, so they cost nothing to compute.
+    """
+
+    width, height = resolution
+    columns = (width + 15) // 16 + 1
+    rows = (height + 15) // 16
+    data = np.fromfile(motion_path, dtype=MOTION_DTYPE)
+    frames = data.size // (columns * rows)
+    if not frames:
+        return None
+    vectors = data[:frames * columns * rows].reshape(frames, rows * columns)
+    lengths = np.hypot(vectors['x'].astype(np.float32),
+                       vectors['y'].astype(np.float32))
+    return lengths.mean(axis=1)
+
+
+def activity_from_frames(video_path):
+    """ Returns mean absolute difference of every decoded frame to the previous.
+
+    Needs PyAV for decoding. Returns None if it is not installed.
+    """
+
+    try:
+        import av
+    except ImportError:
+        return None
+    activity = []
+    previous = None
+    with av.open(video_path) as container:
+        for frame in container.decode(video=0):
+            luma = frame.to_ndarray(format='gray')[::FRAME_SUBSAMPLE,
+                                                   ::FRAME_SUBSAMPLE]
+            luma = luma.astype(np.int16)
+            activity.append(0.0 if previous is None
+                            else float(np.abs(luma - previous).mean()))
+            previous = luma
+    return np.array(activity, dtype=np.float32)
+
+
+def activity_from_sample_sizes(reader):
+    """ Returns sizes of encoded frames as a rough measure of motion.
+
+    Sync frames are replaced by their neighbours, since their size does
+    not depend on motion.
+    """
+
+    sizes = np.array([size for _, size, _, _ in reader.samples], dtype=np.float32)
+    sync = np.array([is_sync for _, _, _, is_sync in reader.samples], dtype=bool)
+    if sync.all():
+        return sizes
+    delta_indexes = np.flatnonzero(~sync)
+    sizes[sync] = np.interp(np.flatnonzero(sync), delta_indexes,
+                            sizes[delta_indexes])
+    return sizes
+
+
+def find_active_segment(activity, framerate, padding=DEFAULT_PADDING,
+                        min_seconds=MIN_VIDEO_SECONDS):
+    """ Returns first and last frame index of the activity, or None.
+
+    Activity is smoothed over a third of a second and compared against a
+    threshold between its quiet and peak levels. Segment is widened
+    around the activity to at least min_seconds, and None is returned if
+    the whole video is not longer than that.
+    """
+
+    min_frames = int(round(min_seconds * framerate))
+    if activity is None or len(activity) < 2 or len(activity) <= min_frames:
+        return None
+    window = max(1, int(round(framerate / 3)))
+    smoothed = np.convolve(activity, np.ones(window) / window, mode='same')
+    quiet, peak = np.percentile(smoothed, [20, 95])
+    if peak <= quiet * MIN_ACTIVITY_CONTRAST or peak <= 0:
+        return None
+    active = np.flatnonzero(smoothed > quiet + ACTIVITY_THRESHOLD * (peak - quiet))
+    pad = int(round(padding * framerate))
+    first = max(0, int(active[0]) - pad)
+    last = min(len(activity) - 1, int(active[-1]) + pad)
+    missing = min_frames - (last - first + 1)
+    if missing > 0:
+        # Widened evenly on both sides and shifted back inside the video.
+        first = max(0, first - (missing + 1) // 2)
+        last = min(len(activity) - 1, first + min_frames - 1)
+        first = max(0, last - min_frames + 1)
+    return first, last
+
+
+def measure_activity(video_path, reader, motion_path=None, resolution=None):
+    """ Returns activity of every frame and the name of the used method.
+
+    Motion vectors are preferred, then decoded frames and lastly the
+    sizes of encoded frames.
+    """
+
+    if motion_path and resolution and os.path.isfile(motion_path):
+        activity = activity_from_motion_vectors(motion_path, resolution)
+        if activity is not None:
+            return activity, 'motion_vectors'
+    activity = activity_from_frames(video_path)
+    if activity is not None:
+        return activity, 'frame_difference'
+    return activity_from_sample_sizes(reader), 'sample_sizes'
+
+
+def encode_segment(video_path, output_path, first, last, framerate):
+    """ Encodes frames from first to last into output path again.
+
+    Needs PyAV for encoding. Returns False if it is not installed.
+    """
+
+    try:
+        import av
+    except ImportError:
+        return False
+    with av.open(video_path) as container, \
+            Mp4Muxer(output_path, framerate=framerate) as muxer:
+        stream = container.streams.video[0]
+        codec = av.CodecContext.create('libx264', 'w')
+        codec.width = stream.codec_context.width
+        codec.height = stream.codec_context.height
+        codec.pix_fmt = 'yuv420p'
+        rate = Fraction(framerate).limit_denominator(1001)
+        codec.time_base = 1 / rate
+        codec.framerate = rate
+        codec.gop_size = int(round(framerate))
+        codec.options = {'crf': str(TRIM_CRF), 'bf': '0'}
+        for index, frame in enumerate(container.decode(stream)):
+            if index > last:
+                break
+            if index < first:
+                continue
+            # New frame drops the picture type of the decoded frame, which
+            # the encoder would take as a forced intra frame.
+            frame = av.VideoFrame.from_ndarray(frame.to_ndarray(format='yuv420p'),
+                                               format='yuv420p')
+            frame.pts = index - first
+            for packet in codec.encode(frame):
+                muxer.write(bytes(packet))
+        for packet in codec.encode(None):
+            muxer.write(bytes(packet))
+    return True
+
+
+def trim_video(video_path, output_path, motion_path=None, resolution=None,
+               padding=DEFAULT_PADDING):
+    """ Writes the part of the video with activity into output path.
+
+    Trimmed video starts from the sync frame before the activity, so it
+    can be remuxed without decoding. If that sync frame is far before the
+    activity, the activity is encoded again instead. Returns path of the
+    video that should be uploaded, which is the original one if nothing
+    was trimmed.
+    """
+
+    reader = Mp4Reader(video_path)
+    framerate = reader.framerate
+    activity, method = measure_activity(video_path, reader, motion_path,
+                                        resolution)
+    segment = find_active_segment(activity, framerate, padding)
+    if segment is None:
+        logger.info("No clear activity found, video is not trimmed.")
+        return video_path
+    first, last = segment
+    last = min(last, len(reader.samples) - 1)
+    # Start from the closest sync frame so the video can be decoded.
+    sync = max([index for index, sample in enumerate(reader.samples[:first + 1])
+                if sample[3]] or [0])
+    if (first - sync <= MAX_SYNC_LEAD_SHARE * (last - first + 1)
+            or not encode_segment(video_path, output_path, first, last,
+                                  framerate)):
+        first = sync
+        if first == 0 and last == len(reader.samples) - 1:
+            logger.info("Activity covers the whole video, video is not trimmed.")
+            return video_path
+        with Mp4Muxer(output_path, framerate=framerate) as muxer:
+            for frame in reader.iterate_annexb(reader.samples[first:last + 1]):
+                muxer.write(frame)
+    logger.info("Trimmed video to frames " + str(first) + "-" + str(last) +
+                " of " + str(len(reader.samples)) + " using " + method +
+                ", size " + str(os.path.getsize(video_path)) + " -> " +
+                str(os.path.getsize(output_path)) + " bytes.")
+    return output_path
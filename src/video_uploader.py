@@ -1,65 +1,298 @@
 #!/usr/bin/env python3
 
-import requests
+import functools
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from logzero import logger
+from http_client import get_client, HttpConnectionError
+from metrics import metrics
+
+
+# Amount of bytes read from the video file at a time.
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Times a failed file read is retried before giving up.
+CHUNK_READ_RETRIES = 3
+# Times the whole upload is attempted.
+UPLOAD_ATTEMPTS = 3
+# Seconds to wait before the first upload retry. Doubles on every retry.
+UPLOAD_RETRY_DELAY = 2.0
+# Time that uploaded videos can be downloaded.
+LINK_LIFETIME = timedelta(minutes=10)
+
+
+class UploadCancelled(Exception):
+    """ Raised from a request body when its upload is no longer needed. """
+
+
+def parse_upload_hosts(args):
+    """ Returns (base path, api key) pairs of File.io compatible hosts.
+
+    File.io is followed by the hosts of the upload_hosts option, which
+    is a comma separated list of base paths, each optionally followed by
+    a space and an API key of its own.
+    """
+
+    hosts = [(args.file_io_base_path, args.file_io_api_key)]
+    for entry in (getattr(args, 'upload_hosts', None) or "").split(","):
+        fields = entry.split()
+        if fields:
+            hosts.append((fields[0], fields[1] if len(fields) > 1
+                          else args.file_io_api_key))
+    return hosts
+
+
+class MultipartFileBody:
+    """ File-like multipart/form-data request body that streams a file.
+
+    Only a single chunk of the file is held in memory at a time, so
+    memory usage does not depend on the size of the file.
+    """
+
+    def __init__(self, path, file_name, content_type, progress=None,
+                 cancelled=None):
+        self.path = path
+        self.progress = progress
+        # Event that aborts sending the body when set.
+        self.cancelled = cancelled
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        self.preamble = ("--" + boundary + "\r\n"
+                         "Content-Disposition: form-data; name=\"file\"; "
+                         "filename=\"" + file_name + "\"\r\n"
+                         "Content-Type: " + content_type + "\r\n\r\n").encode()
+        self.epilogue = ("\r\n--" + boundary + "--\r\n").encode()
+        self.file_size = os.path.getsize(path)
+        self.file = None
+        self.position = 0
+
+    def __len__(self):
+        return len(self.preamble) + self.file_size + len(self.epilogue)
+
+    def __enter__(self):
+        self.file = open(self.path, 'rb')
+        self.position = 0
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def rewind(self):
+        """ Moves back to the beginning so that the body can be sent again. """
+
+        self.file.seek(0)
+        self.position = 0
+
+    def read(self, size=-1):
+        """ Returns at most size bytes of the body. """
+
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise UploadCancelled("Upload of " + self.path + " was cancelled.")
+        if size is None or size < 0:
+            size = UPLOAD_CHUNK_SIZE
+        preamble_end = len(self.preamble)
+        file_end = preamble_end + self.file_size
+        if self.position < preamble_end:
+            data = self.preamble[self.position:self.position + size]
+        elif self.position < file_end:
+            data = self.read_chunk(min(size, UPLOAD_CHUNK_SIZE,
+                                       file_end - self.position))
+            if self.progress:
+                self.progress(self.position + len(data) - preamble_end,
+                              self.file_size)
+        else:
+            offset = self.position - file_end
+            data = self.epilogue[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def read_chunk(self, size):
+        """ Reads a chunk of the file and retries the read if it fails. """
+
+        offset = self.position - len(self.preamble)
+        for tries_left in reversed(range(CHUNK_READ_RETRIES)):
+            try:
+                self.file.seek(offset)
+                data = self.file.read(size)
+                if len(data) != size:
+                    raise OSError("Video file was truncated during upload.")
+                return data
+            except OSError as oe:
+                if not tries_left:
+                    raise
+                logger.warning(oe)
+                logger.info("Retrying read of chunk at offset " +
+                            str(offset) + ".")
 
 
 class VideoUploader:
+    """ Uploads videos to File.io compatible hosts.
+
+    With several hosts the upload is hedged: if the upload to a host has
+    not finished in upload_hedge_delay seconds or it fails, the video is
+    uploaded to the next host too. Link of the first successful upload
+    is returned and the other uploads are cancelled. Uploads that have
+    already sent the whole video finish in the background and their
+    links are not used.
+    """
 
     def __init__(self, args) -> None:
         self.args = args
+        self.hosts = parse_upload_hosts(args)
+        self.hedge_delay = getattr(args, 'upload_hedge_delay', None)
+        # Latest reported progress by host.
+        self.reported_percent = dict()
+
+    def upload_video(self, file_path=None):
+        """ Streams video file to File.io and returns link to it. """
+
+        upload = self.upload(file_path)
+        return upload['link'] if upload else None
 
-    def upload_video(self):
-        """ Reads video file and posts it. """
+    def upload(self, file_path=None):
+        """ Streams video file to File.io and returns link and its expiry.
+
+        Expiry is returned as a UNIX timestamp. Returns None if the
+        upload failed.
+        """
 
         logger.info("Starting video upload process.")
+        if file_path is None:
+            file_path = 'videos/' + str(datetime.now().date()) + '.mp4'
+        if not os.path.isfile(file_path):
+            logger.error("Video file " + file_path + " not found.")
+            return None
+        if len(self.hosts) == 1:
+            return self.upload_to(self.hosts[0], file_path, threading.Event())
+        return self.upload_hedged(file_path)
+
+    def upload_hedged(self, file_path):
+        """ Uploads to hosts in order until one succeeds and returns it. """
+
+        remaining = list(self.hosts)
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(remaining))
+        futures = dict()
+
+        def start_next():
+            host = remaining.pop(0)
+            futures[executor.submit(self.upload_to, host, file_path,
+                                    cancelled)] = host[0]
+
+        try:
+            start_next()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED,
+                               timeout=self.hedge_delay if remaining else None)
+                if not done:
+                    logger.info("Upload is slow, uploading to " +
+                                remaining[0][0] + " too.")
+                    metrics.increment('upload_hedges')
+                    start_next()
+                    continue
+                for future in done:
+                    url = futures.pop(future)
+                    try:
+                        upload = future.result()
+                    except Exception as ex:
+                        logger.exception(ex)
+                        upload = None
+                    if upload:
+                        metrics.increment('upload_wins', host=urlsplit(url).netloc)
+                        return upload
+                # Failed upload is replaced right away.
+                if remaining:
+                    start_next()
+            logger.error("Video upload failed on every host.")
+            return None
+        finally:
+            # Slower uploads stop at their next chunk.
+            cancelled.set()
+            executor.shutdown(wait=False)
+
+    def upload_to(self, host, file_path, cancelled):
+        """ Streams video file to a host and returns link and its expiry. """
+
+        url, api_key = host
         # Get UTC timestamp 10 minutes ahead of program running time.
-        expiry_date = (datetime.utcnow() + timedelta(minutes=10)
-                       ).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-        url = self.args.file_io_base_path
+        expires_at = datetime.utcnow() + LINK_LIFETIME
+        expiry_date = expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
         # Set headers and payload
         header = {"accept": "application/json",
-                  "Authorization": 'Bearer ' + self.args.file_io_api_key}
+                  "Authorization": 'Bearer ' + api_key}
         payload = {'expires': expiry_date,
                    'maxDownloads': 1,
                    'autoDelete': True}
 
         logger.info("Opening video file.")
-        # Creating empty object to store the video in.
-        video = bytes()
-        file_name = str(datetime.now().date()) + '.mp4'
-        # Read video file
         try:
-            with open('videos/' + file_name, 'rb') as file:
-                logger.info("Reading video into a bytes object.")
-                # Read video bytes into variable.
-                video = file.read()
+            body = MultipartFileBody(file_path, 'plant.mp4', 'video/mp4',
+                                     functools.partial(self.report_progress, url),
+                                     cancelled)
+            with body:
+                with metrics.span('upload', host=urlsplit(url).netloc):
+                    resp = self.send_body(url, header, payload, body, cancelled)
+        except UploadCancelled:
+            logger.info("Upload to " + url + " was cancelled.")
+            return None
         # File wasn't found
         except FileNotFoundError as fnfe:
             logger.error(fnfe)
+            return None
         # Reading error
         except OSError as oe:
             logger.error(oe)
-        # Other errors
-        except Exception as err:
-            logger.exception(err)
-
-        # If video was read, continue.
-        if video:
-            file_payload = {'file': ('plant.mp4', video, 'video/mp4')}
-            # Send request.
-            resp = requests.post(url, headers=header,
-                                 params=payload, files=file_payload)
-
-            if resp.ok:
-                # Read json response
-                resp_data = resp.json()
-                if 'link' in resp_data:
-                    # Returning video link.
-                    return resp_data['link']
-                else:
-                    logger.error("Link not found in response from File.io")
-                    logger.info(resp_data)
+            return None
+
+        if resp is None:
+            logger.error("Video upload to " + url + " failed.")
+        elif resp.ok:
+            # Read json response
+            resp_data = resp.json()
+            if 'link' in resp_data:
+                # Returning video link.
+                return {'link': resp_data['link'],
+                        'expires_at': (expires_at - datetime(1970, 1, 1)
+                                       ).total_seconds()}
             else:
-                logger.error(resp.json())
+                logger.error("Link not found in response from " + url)
+                logger.info(resp_data)
+        else:
+            logger.error(resp.json())
+
+    def send_body(self, url, header, payload, body, cancelled=None):
+        """ Posts streamed body and retries the upload on connection errors. """
+
+        cancelled = cancelled or threading.Event()
+        headers = dict(header, **{'Content-Type': body.content_type})
+        delay = UPLOAD_RETRY_DELAY
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            self.reported_percent[url] = 0
+            body.rewind()
+            logger.info("Uploading " + str(body.file_size) + " bytes to " + url + ".")
+            try:
+                resp = get_client().post(url, endpoint='upload', headers=headers,
+                                         params=payload, data=body)
+                metrics.increment('upload_bytes', len(body))
+                return resp
+            except HttpConnectionError as ce:
+                logger.warning(ce)
+                if attempt == UPLOAD_ATTEMPTS:
+                    return None
+                metrics.increment('upload_retries')
+                logger.info("Retrying upload in " + str(delay) + " seconds.")
+                if cancelled.wait(delay):
+                    raise UploadCancelled("Upload to " + url + " was cancelled.")
+                delay *= 2
+
+    def report_progress(self, url, sent, total):
+        """ Logs upload progress in steps of ten percent. """
+
+        percent = sent * 100 // total if total else 100
+        reported = self.reported_percent.get(url, 0)
+        if percent >= reported + 10 or percent == 100:
+            self.reported_percent[url] = percent
+            logger.info("Uploaded " + str(percent) + "% of video to " + url + ".")
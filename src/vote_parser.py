@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from itertools import islice
+import re
+from metrics import metrics
+
+
+# Characters that are removed from comments before parsing.
+UNWANTED_PATTERN = re.compile("[\"();:\']")
+# Separates comments from each other when a batch is parsed in one pass.
+SEPARATOR = "\x00"
+# Matches a vote like "25ml", "25 mL" or "100 ml" written with any unicode
+# decimal digits. The rest of the comment is consumed so that only the
+# first vote of every comment is counted.
+VOTE_PATTERN = re.compile(
+    r"(?<!\d)(\d{1,3})[^\S\x00]?ml(?![^\W\d_])[^\x00]*", re.IGNORECASE)
+# Amount of comments that are parsed with a single regex pass.
+BATCH_SIZE = 10000
+
+
+def sanitize_comment(comment):
+    """ Removes unwanted characters from a string that could be harmful. """
+
+    return UNWANTED_PATTERN.sub("", comment)
+
+
+def parse_vote(comment):
+    """ Returns the voted water amount of a single comment or None. """
+
+    match = VOTE_PATTERN.search(
+        sanitize_comment(comment.replace(SEPARATOR, " ")))
+    if match:
+        # int() normalizes unicode digits and leading zeros.
+        return int(match.group(1))
+    return None
+
+
+def count_votes(comments, votes=None):
+    """ Counts water amount votes of the given comment texts.
+
+    Comments can be any iterable of strings, e.g. a generator that is
+    still fetching them. Every batch of comments is sanitized and matched
+    in a single pass. Votes are counted into the given dictionary or a new
+    Counter, keyed by the water amount as a string.
+    """
+
+    if votes is None:
+        votes = Counter()
+    comments = iter(comments)
+    while True:
+        batch = list(islice(comments, BATCH_SIZE))
+        if not batch:
+            break
+        metrics.increment('comments_parsed', len(batch))
+        text = sanitize_comment(SEPARATOR.join(batch))
+        if text.count(SEPARATOR) != len(batch) - 1:
+            # A comment contained the separator itself.
+            for amount in map(parse_vote, batch):
+                if amount is not None:
+                    votes[str(amount)] = votes.get(str(amount), 0) + 1
+            continue
+        # Count raw digit strings first and normalize only distinct ones.
+        for digits, count in Counter(VOTE_PATTERN.findall(text)).items():
+            key = str(int(digits))
+            votes[key] = votes.get(key, 0) + count
+    return votes
+
+
+def parse_votes(comments):
+    """ Returns the voted water amount of every comment text or None.
+
+    Comments of the list are sanitized in a single pass, like in
+    count_votes, and the result is in the order of the comments.
+    """
+
+    metrics.increment('comments_parsed', len(comments))
+    pieces = sanitize_comment(SEPARATOR.join(comments)).split(SEPARATOR)
+    if len(pieces) != len(comments):
+        # A comment contained the separator itself.
+        return [parse_vote(comment) for comment in comments]
+    votes = []
+    for piece in pieces:
+        match = VOTE_PATTERN.search(piece)
+        votes.append(int(match.group(1)) if match else None)
+    return votes
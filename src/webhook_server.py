@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import hashlib
+import hmac
+import json
+import queue
+import threading
+from logzero import logger
+from metrics import metrics
+from run_comment_check import iterate_votes
+
+
+# Largest accepted request body in bytes.
+MAX_BODY_SIZE = 1024 * 1024
+# Amount of events waiting to be applied before new ones are refused.
+QUEUE_SIZE = 10000
+# Amount of events applied to the database in one transaction.
+EVENT_BATCH_SIZE = 500
+# Timestamp format of Graph API comments.
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S+0000'
+
+
+def sign_payload(body, app_secret):
+    """ Returns X-Hub-Signature-256 header value of a request body. """
+
+    digest = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+    return "sha256=" + digest
+
+
+def verify_signature(body, signature, app_secret):
+    """ Checks that the body was signed with the app secret. """
+
+    if not signature:
+        return False
+    return hmac.compare_digest(sign_payload(body, app_secret), signature)
+
+
+def skip_malformed(part, data):
+    """ Logs and counts a malformed part of a webhook payload. """
+
+    logger.warning("Skipping malformed webhook " + part + ": " + repr(data)[:200])
+    metrics.increment('webhook_malformed', part=part)
+
+
+def parse_comment_change(change, timestamp):
+    """ Returns (media id, comment) of a comments change or None.
+
+    Raises AttributeError, KeyError, TypeError or ValueError if the
+    change is malformed.
+    """
+
+    if change.get('field') != 'comments':
+        return None
+    value = change['value']
+    author = value.get('from') or dict()
+    text = value.get('text', '')
+    comment_id, media_id = value['id'], value['media']['id']
+    if not isinstance(author, dict) or not isinstance(text, str):
+        raise TypeError("Comment author or text has a wrong type.")
+    if not all(isinstance(item, (str, int)) for item in (comment_id, media_id)):
+        raise TypeError("Comment or media id has a wrong type.")
+    return (str(media_id),
+            {'id': str(comment_id), 'text': text,
+             'timestamp': timestamp.strftime(TIMESTAMP_FORMAT),
+             'username': author.get('username'), 'from': author})
+
+
+def extract_comments(payload):
+    """ Returns (media id, comment) pairs of a comments webhook payload.
+
+    Comments have the same fields as comments fetched from Graph API.
+    Notification time is used as the comment timestamp. Malformed
+    payloads, entries and changes are skipped, so they do not prevent
+    recording the rest of the batch.
+    """
+
+    comments = []
+    if not isinstance(payload, dict):
+        skip_malformed('payload', payload)
+        return comments
+    if payload.get('object') != 'instagram':
+        return comments
+    entries = payload.get('entry', [])
+    if not isinstance(entries, list):
+        skip_malformed('payload', payload)
+        return comments
+    for entry in entries:
+        try:
+            timestamp = datetime.fromtimestamp(entry.get('time', 0), timezone.utc)
+            changes = entry.get('changes', [])
+            if not isinstance(changes, list):
+                raise TypeError("Changes are not a list.")
+        except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+            skip_malformed('entry', entry)
+            continue
+        for change in changes:
+            try:
+                comment = parse_comment_change(change, timestamp)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                skip_malformed('change', change)
+                continue
+            if comment is not None:
+                comments.append(comment)
+    return comments
+
+
+class WebhookServer:
+    """ Receives Instagram comments webhook events.
+
+    Signed events are acknowledged as soon as they are queued, and a
+    worker thread records their votes into the votes ledger in batches.
+    Winning water amount of the current post is updated after every
+    batch, so the result is known without polling comments.
+    """
+
+    name = "Webhook server"
+
+    def __init__(self, dbh, app_secret, verify_token, host="0.0.0.0", port=8080):
+        if not app_secret:
+            raise ValueError("App secret is needed to verify webhook events.")
+        self.dbh = dbh
+        self.app_secret = app_secret
+        self.verify_token = verify_token
+        self.events = queue.Queue(maxsize=QUEUE_SIZE)
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target=self.apply_events,
+                                       name="webhook-worker", daemon=True)
+        self.thread = None
+
+    @property
+    def base_path(self):
+        """ Base url of the server with a trailing slash. """
+
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/"
+
+    def start(self):
+        """ Starts serving requests in a background thread. """
+
+        self.worker.start()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        logger.info(self.name + " listening at " + self.base_path)
+        return self
+
+    def stop(self):
+        """ Stops receiving events and applies the queued ones. """
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.stopping.set()
+        self.worker.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def verify_subscription(self, params):
+        """ Returns the challenge of a valid subscription request or None. """
+
+        if (params.get('hub.mode') == 'subscribe' and self.verify_token and
+                hmac.compare_digest(params.get('hub.verify_token', ''),
+                                    self.verify_token)):
+            logger.info("Webhook subscription verified.")
+            return params.get('hub.challenge', '')
+        logger.warning("Webhook subscription verification failed.")
+        return None
+
+    def receive_event(self, body, signature):
+        """ Queues a signed event and returns the response status. """
+
+        if not verify_signature(body, signature, self.app_secret):
+            logger.warning("Webhook event with invalid signature.")
+            metrics.increment('webhook_events', result='invalid_signature')
+            return 403
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            metrics.increment('webhook_events', result='invalid_payload')
+            return 400
+        try:
+            self.events.put_nowait(payload)
+        except queue.Full:
+            # Instagram retries events that are not acknowledged.
+            logger.warning("Webhook event queue is full.")
+            metrics.increment('webhook_events', result='queue_full')
+            return 503
+        metrics.increment('webhook_events', result='queued')
+        return 200
+
+    def apply_events(self):
+        """ Records votes of queued events until the server is stopped. """
+
+        while not (self.stopping.is_set() and self.events.empty()):
+            try:
+                batch = [self.events.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < EVENT_BATCH_SIZE:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with metrics.span('webhook_batch'):
+                    self.apply_batch(batch)
+            except Exception as ex:
+                logger.warning("Could not apply webhook events.")
+                logger.exception(ex)
+
+    def apply_batch(self, payloads):
+        """ Records votes of a batch of event payloads. """
+
+        comments = dict()
+        for payload in payloads:
+            for media_id, comment in extract_comments(payload):
+                comments.setdefault(media_id, []).append(comment)
+        for media_id, media_comments in comments.items():
+            votes = list(iterate_votes(media_comments))
+            if votes:
+                self.dbh.record_votes(media_id, votes)
+                logger.info("Recorded " + str(len(votes)) +
+                            " votes for media " + media_id + ".")
+        today = datetime.now().date()
+        media_id = self.dbh.get_post_by_date(today)
+        if media_id is not None and str(media_id) in comments:
+            self.update_result(media_id, today + timedelta(days=1))
+
+    def update_result(self, media_id, date):
+        """ Stores winning water amount of the post for the date. """
+
+        result = self.dbh.get_vote_tally(media_id) or \
+            {'water_amount': 0, 'vote_count': 0}
+        result['date'] = date
+        self.dbh.upsert_to_table(result)
+
+    def create_handler(self):
+        """ Creates request handler class bound to this server. """
+
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, so small responses
+            # would otherwise wait for the delayed ACK of the client.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                params = {key: values[-1] for key, values in
+                          parse_qs(urlsplit(self.path).query).items()}
+                challenge = webhook.verify_subscription(params)
+                if challenge is None:
+                    self.send(403, b'')
+                else:
+                    self.send(200, challenge.encode(), "text/plain")
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > MAX_BODY_SIZE:
+                    self.close_connection = True
+                    self.send(413, b'')
+                    return
+                body = self.rfile.read(length)
+                status = webhook.receive_event(
+                    body, self.headers.get('X-Hub-Signature-256'))
+                self.send(status, b'EVENT_RECEIVED' if status == 200 else b'',
+                          "text/plain")
+
+            def send(self, status, body, content_type="text/plain"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(webhook.name + ": " + format % args)
+
+        return Handler
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import pytest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        "src")
+sys.path.insert(0, SRC_PATH)
+
+# Modules resolve their file paths from the working directory when they
+# are imported, so tests run in a workspace of their own.
+WORKSPACE = tempfile.mkdtemp(prefix="plant-test-")
+for directory in ('videos', 'images', 'account_configuration'):
+    os.makedirs(os.path.join(WORKSPACE, directory))
+os.chdir(WORKSPACE)
+
+import account_registry  # noqa: E402
+import graph_throttler  # noqa: E402
+from fake_graph_api import FakeGraphApi  # noqa: E402
+from parse_config import get_configuration  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    """ Keeps quota usage and accounts of one test from affecting the next. """
+
+    graph_throttler._throttler = None
+    account_registry._registries.clear()
+    yield
+    graph_throttler._throttler = None
+    account_registry._registries.clear()
+    config_path = account_registry.ACCOUNT_CONFIG_PATH
+    for name in os.listdir(config_path):
+        os.remove(os.path.join(config_path, name))
+
+
+@pytest.fixture
+def graph_api():
+    with FakeGraphApi() as api:
+        yield api
+
+
+@pytest.fixture
+def make_args(tmp_path):
+    """ Returns a function that writes a configuration and parses it. """
+
+    def make_args(graph_api, file_io_base_path="http://127.0.0.1:9/", **options):
+        settings = {'graph_api_access_token': "token",
+                    'graph_api_version': "v12.0/",
+                    'graph_api_base_path': graph_api.base_path,
+                    'file_io_api_key': "key",
+                    'file_io_base_path': file_io_base_path,
+                    'image_name_prefix': "plant-photo-",
+                    'video_name_prefix': "plant-video-",
+                    'database_name': str(tmp_path / "test.db"),
+                    'dry_run': "False",
+                    'hardware_backend': "fake",
+                    'publish_deadline': "30"}
+        settings.update((key, str(value)) for key, value in options.items())
+        path = tmp_path / "test.ini"
+        path.write_text("".join(key + " = " + value + "\n"
+                                for key, value in settings.items()))
+        return get_configuration(['-c', str(path)])
+
+    return make_args
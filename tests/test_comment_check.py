@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import pytest
+from db_handler import DatabaseHandler
+from fake_graph_api import FakeGraphApi
+from graph_handler import GraphHandler
+from http_client import HttpStatusError
+from run_comment_check import update_vote_tally
+
+
+MEDIA_ID = "5000"
+
+
+class FailingPageGraphApi(FakeGraphApi):
+    """ Fake Graph API that rejects one page of comments while failing is set. """
+
+    def __init__(self, failing_offset, **options):
+        super().__init__(**options)
+        self.failing_offset = failing_offset
+        self.failing = True
+
+    def handle(self, method, parts, params, request=None):
+        if self.failing and params.get('after') == self.failing_offset:
+            return 400, self.error(100, "Invalid cursor")
+        return super().handle(method, parts, params, request)
+
+
+def create_comments(count):
+    """ Returns vote comments of different users, newest first. """
+
+    start = datetime(2026, 10, 18, 12, 0, 0)
+    return [{'id': str(index), 'text': "25ml please",
+             'timestamp': (start - timedelta(seconds=index)).strftime(
+                 '%Y-%m-%dT%H:%M:%S+0000'),
+             'from': {'id': "user" + str(index)}}
+            for index in range(count)]
+
+
+def test_failed_page_does_not_store_cursor(make_args):
+    with FailingPageGraphApi("200", comments=create_comments(500)) as api:
+        args = make_args(api)
+        gh = GraphHandler(args)
+        dbh = DatabaseHandler(args)
+        try:
+            with pytest.raises(HttpStatusError):
+                update_vote_tally(dbh, gh, MEDIA_ID)
+            assert dbh.get_comment_cursor(MEDIA_ID)['last_timestamp'] == ''
+            api.failing = False
+            result = update_vote_tally(dbh, gh, MEDIA_ID)
+            assert result == {'water_amount': 25, 'vote_count': 500}
+        finally:
+            dbh.cleanup()
+
+
+def test_new_comments_are_counted_after_cursor(make_args, graph_api):
+    graph_api.comments = create_comments(150)[50:]
+    args = make_args(graph_api)
+    gh = GraphHandler(args)
+    dbh = DatabaseHandler(args)
+    try:
+        assert update_vote_tally(dbh, gh, MEDIA_ID)['vote_count'] == 100
+        graph_api.comments = create_comments(150)
+        requests_before = len(graph_api.requests)
+        assert update_vote_tally(dbh, gh, MEDIA_ID)['vote_count'] == 150
+        # First page already reaches counted comments, only the
+        # prefetched second page is requested too.
+        assert len(graph_api.requests) - requests_before <= 2
+    finally:
+        dbh.cleanup()
+
+
+def test_comments_of_every_account_are_counted(make_args, graph_api):
+    comments = create_comments(300)
+    graph_api.comments = {MEDIA_ID: comments[:150], "5001": comments[100:]}
+    args = make_args(graph_api)
+    gh = GraphHandler(args)
+    dbh = DatabaseHandler(args)
+    try:
+        result = update_vote_tally(dbh, gh, MEDIA_ID, [MEDIA_ID, "5001"])
+        # Users commenting on both posts are counted once.
+        assert result == {'water_amount': 25, 'vote_count': 300}
+        # First pages of both posts are fetched with one batch request.
+        batches = [params for method, path, params in graph_api.requests
+                   if method == "POST" and not path and 'batch' in params]
+        assert len(batches) == 1
+        assert dbh.get_comment_cursor("5001")['last_timestamp'] != ''
+    finally:
+        dbh.cleanup()
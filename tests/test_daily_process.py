@@ -0,0 +1,24 @@
+import pytest
+from mp4_container import Mp4Muxer
+from run_daily_process import DailyProcess
+from stage_runner import StageFailed
+from test_mp4_container import write_fixture_frames
+
+
+@pytest.fixture
+def daily(make_args, graph_api):
+    daily = DailyProcess(make_args(graph_api))
+    daily.date = "2026-10-18"
+    daily.run = daily.dbh.get_daily_run(daily.date)
+    daily.pump_controller.cam.set_date(daily.date)
+    yield daily
+    daily.close()
+
+
+def test_trim_fails_on_unfinished_recording(daily):
+    muxer = Mp4Muxer(daily.pump_controller.cam.video_file_path + ".mp4")
+    write_fixture_frames(muxer, 30)
+    muxer.file.close()
+    with pytest.raises(StageFailed):
+        daily.trim_video()
+    assert daily.dbh.get_daily_run(daily.date)['video_path'] is None
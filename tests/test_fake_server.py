@@ -0,0 +1,16 @@
+import requests
+from fake_server import FakeServer
+
+
+def test_unknown_path_is_not_found():
+    with FakeServer() as server:
+        resp = requests.get(server.base_path + "missing")
+    assert resp.status_code == 404
+    assert resp.json()['error']['code'] == 404
+
+
+def test_injected_errors_are_returned_first():
+    with FakeServer(error_status=503) as server:
+        server.fail_next(2)
+        statuses = [requests.get(server.base_path).status_code for _ in range(3)]
+    assert statuses == [503, 503, 404]
@@ -0,0 +1,30 @@
+from graph_handler import GraphHandler
+
+
+def count_batches(graph_api):
+    return sum(1 for method, path, params in graph_api.requests
+               if method == "POST" and not path and 'batch' in params)
+
+
+def test_configuration_uses_cached_discovery(make_args, graph_api):
+    gh = GraphHandler(make_args(graph_api))
+    gh.create_configuration_files()
+    account = gh.registry.get_account(graph_api.user_id)
+    assert account['page_id'] == graph_api.page_id
+    assert account['name'] == "plant"
+    graph_api.page_name = "renamed plant"
+    # Discovery of the first run is cached.
+    gh.create_configuration_files()
+    assert count_batches(graph_api) == 1
+    assert gh.registry.get_account(graph_api.user_id)['name'] == "plant"
+    # Explicit configuration discovers accounts again.
+    gh.create_configuration_files(refresh=True)
+    assert count_batches(graph_api) == 2
+    assert gh.registry.get_account(graph_api.user_id)['name'] == "renamed plant"
+
+
+def test_expired_discovery_is_refreshed(make_args, graph_api):
+    gh = GraphHandler(make_args(graph_api, discovery_cache_ttl=0))
+    gh.create_configuration_files()
+    gh.create_configuration_files()
+    assert count_batches(graph_api) == 2
@@ -0,0 +1,55 @@
+import json
+import pytest
+import requests
+from fake_graph_api import FakeGraphApi
+from graph_handler import GraphHandler
+from graph_throttler import (GraphThrottler, PRIORITY_POLL, PRIORITY_PUBLISH,
+                             ThrottledError, parse_business_usage_header,
+                             parse_usage_header)
+
+
+def create_response(status, data, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(data).encode()
+    resp.headers.update(headers or dict())
+    return resp
+
+
+def test_usage_headers_are_parsed():
+    assert parse_usage_header(json.dumps({'call_count': 12, 'total_time': 40,
+                                          'total_cputime': 3})) == 40
+    assert parse_usage_header("not json") is None
+    usage = parse_business_usage_header(json.dumps({'2000': [
+        {'type': 'instagram', 'call_count': 90, 'total_time': 10,
+         'estimated_time_to_regain_access': 2}]}))
+    assert usage == {'2000': (90, 120)}
+
+
+def test_polling_stops_before_quota_runs_out(make_args):
+    with FakeGraphApi(call_limit=10) as graph_api:
+        gh = GraphHandler(make_args(graph_api))
+        # Every call uses a tenth of the quota.
+        for _ in range(8):
+            gh.get_container_status("1")
+        calls = len(graph_api.requests)
+        with pytest.raises(ThrottledError):
+            gh.fetch_comment_page(gh.base_url + "1/comments")
+        assert len(graph_api.requests) == calls
+        # Quota is left for publishing.
+        gh.get_container_status("1")
+        assert len(graph_api.requests) == calls + 1
+
+
+def test_throttling_error_blocks_only_the_account():
+    throttler = GraphThrottler(max_wait=0.5)
+    usage = json.dumps({'2000': [{'type': 'instagram', 'call_count': 100,
+                                  'estimated_time_to_regain_access': 5}]})
+    throttler.update("2000", create_response(
+        400, {'error': {'code': 80002, 'message': "Too many calls"}},
+        {'X-Business-Use-Case-Usage': usage}))
+    for priority in (PRIORITY_POLL, PRIORITY_PUBLISH):
+        with pytest.raises(ThrottledError):
+            throttler.acquire("2000", 'publish', priority)
+    throttler.acquire("3000", 'publish', PRIORITY_PUBLISH)
+    throttler.acquire(None, 'comments', PRIORITY_POLL)
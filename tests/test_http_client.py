@@ -0,0 +1,74 @@
+import pytest
+from fake_server import FakeServer
+from http_client import (HttpClient, HttpConnectionError, HttpStatusError,
+                         get_client)
+from metrics import metrics
+
+
+class EchoServer(FakeServer):
+    """ Fake server that records client ports of requests. """
+
+    name = "Echo server"
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.ports = []
+
+    def handle(self, method, parts, params, request):
+        with self.lock:
+            self.ports.append(request.client_address[1])
+        return 200, {'method': method, 'path': "/".join(parts)}
+
+
+def retry_count():
+    return sum(value for (name, _), value in metrics.counters.items()
+               if name == 'http_retries')
+
+
+def test_connections_are_kept_alive():
+    client = HttpClient()
+    with EchoServer() as server:
+        for index in range(5):
+            resp = client.get(server.base_path + str(index), raise_for_status=True)
+            assert resp.json() == {'method': "GET", 'path': str(index)}
+    client.close()
+    assert len(server.ports) == 5
+    assert len(set(server.ports)) == 1
+
+
+def test_idempotent_request_is_retried():
+    client = HttpClient()
+    retries = retry_count()
+    with EchoServer(error_status=503) as server:
+        server.fail_next(2)
+        resp = client.get(server.base_path, raise_for_status=True)
+    client.close()
+    assert resp.status_code == 200
+    assert retry_count() - retries == 2
+
+
+def test_post_is_not_retried_on_error_status():
+    client = HttpClient()
+    with EchoServer(error_status=503) as server:
+        server.fail_next(1)
+        with pytest.raises(HttpStatusError) as error:
+            client.post(server.base_path, data=b'body', raise_for_status=True)
+        assert error.value.status_code == 503
+        assert server.ports == []
+        # Next request gets a normal response.
+        assert client.post(server.base_path, data=b'body').status_code == 200
+    client.close()
+
+
+def test_unreachable_host_raises_connection_error():
+    client = HttpClient(retries=0)
+    with FakeServer() as server:
+        url = server.base_path
+    with pytest.raises(HttpConnectionError) as error:
+        client.get(url)
+    assert error.value.url == url
+    client.close()
+
+
+def test_client_is_shared():
+    assert get_client() is get_client()
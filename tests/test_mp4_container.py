@@ -0,0 +1,31 @@
+import pytest
+from fake_camera import FIXTURE_PATH
+from mp4_container import Mp4Muxer, Mp4Reader, is_finalized
+
+
+def write_fixture_frames(muxer, count):
+    """ Writes the first frames of the fixture video into a muxer. """
+
+    reader = Mp4Reader(FIXTURE_PATH)
+    for frame in reader.iterate_annexb(reader.samples[:count]):
+        muxer.write(frame)
+
+
+def test_finished_recording_is_read(tmp_path):
+    path = str(tmp_path / "finished.mp4")
+    with Mp4Muxer(path, framerate=30) as muxer:
+        write_fixture_frames(muxer, 30)
+    assert is_finalized(path)
+    assert len(Mp4Reader(path).samples) == 30
+
+
+def test_unfinished_recording_raises(tmp_path):
+    path = str(tmp_path / "unfinished.mp4")
+    muxer = Mp4Muxer(path, framerate=30)
+    write_fixture_frames(muxer, 30)
+    # Process was interrupted before the muxer was closed.
+    muxer.file.flush()
+    with pytest.raises(ValueError):
+        Mp4Reader(path)
+    assert not is_finalized(path)
+    muxer.file.close()
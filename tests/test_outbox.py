@@ -0,0 +1,62 @@
+import json
+import os
+import shutil
+import time
+import pytest
+from account_registry import ACCOUNT_CONFIG_PATH
+from db_handler import DatabaseHandler
+from fake_camera import FIXTURE_PATH
+from fake_file_host import FakeFileHost
+from graph_handler import GraphHandler
+from outbox import Outbox, PUBLISH_LIMIT, TIMELAPSE_PREFIX
+from video_uploader import VideoUploader
+
+
+@pytest.fixture
+def outbox(make_args, graph_api):
+    with FakeFileHost() as file_host:
+        args = make_args(graph_api, file_io_base_path=file_host.base_path)
+        with open(os.path.join(ACCOUNT_CONFIG_PATH, graph_api.user_id + ".json"),
+                  'w') as acc_file:
+            json.dump({'user_id': graph_api.user_id, 'caption': ["Daily watering"],
+                       'hashtags': ["#plant"]}, acc_file)
+        dbh = DatabaseHandler(args)
+        try:
+            yield Outbox(dbh, VideoUploader(args), GraphHandler(args))
+        finally:
+            dbh.cleanup()
+
+
+def copy_video(tmp_path, name):
+    path = str(tmp_path / name)
+    shutil.copyfile(FIXTURE_PATH, path)
+    return path
+
+
+def test_publish_limit_is_counted_per_account(outbox, graph_api, tmp_path):
+    now = time.time()
+    outbox.dbh.record_publications({"other": "1"}, now)
+    for index in range(PUBLISH_LIMIT - 1):
+        outbox.dbh.record_publications({graph_api.user_id: str(index)}, now)
+    assert outbox.dbh.count_published_posts(now - 60) == PUBLISH_LIMIT - 1
+    outbox.enqueue("2026-10-17", copy_video(tmp_path, "first.mp4"))
+    outbox.enqueue("2026-10-18", copy_video(tmp_path, "second.mp4"))
+    # Only one more post fits into the limit of the account.
+    assert outbox.drain() == 1
+    assert outbox.dbh.count_published_posts(now - 60) == PUBLISH_LIMIT
+    assert outbox.dbh.get_due_posts(time.time(), 10)[0]['date'] == "2026-10-18"
+
+
+def test_timelapse_is_posted_through_outbox(outbox, graph_api, tmp_path):
+    outbox.dbh.upsert_to_table({'date': "2026-10-18", 'water_amount': 25,
+                                'vote_count': 1})
+    outbox.enqueue(TIMELAPSE_PREFIX + "2026-10-18",
+                   copy_video(tmp_path, "timelapse.mp4"),
+                   "Growth of the plant in 5 days.")
+    assert outbox.drain() == 1
+    captions = [params['caption'] for method, path, params in graph_api.requests
+                if method == "POST" and path.endswith("/media")]
+    assert captions == ["Growth of the plant in 5 days.\n\n#plant"]
+    assert outbox.dbh.count_published_posts(time.time() - 60) == 1
+    # Timelapse does not replace the media id of the daily post.
+    assert outbox.dbh.get_post_by_date("2026-10-18") is None
@@ -0,0 +1,41 @@
+import time
+from fake_graph_api import FakeGraphApi
+from graph_handler import GraphHandler
+
+
+def create_container(graph_api):
+    """ Creates a media container that starts processing now. """
+
+    creation_id = graph_api.next_id()
+    with graph_api.lock:
+        graph_api.containers[creation_id] = time.monotonic()
+    return creation_id
+
+
+def count_status_polls(graph_api, creation_id):
+    return sum(1 for method, path, _ in graph_api.requests
+               if method == "GET" and path == creation_id)
+
+
+def test_video_is_published_when_container_is_ready(make_args):
+    with FakeGraphApi(container_delay=1.5) as graph_api:
+        gh = GraphHandler(make_args(graph_api))
+        creation_id = create_container(graph_api)
+        start = time.monotonic()
+        result = gh.publish_video(creation_id, graph_api.user_id)
+        elapsed = time.monotonic() - start
+    assert result == {'id': graph_api.published[creation_id]}
+    assert count_status_polls(graph_api, creation_id) >= 2
+    # Polling backs off with jitter, but does not wait fixed minutes.
+    assert 1.5 <= elapsed < 5
+
+
+def test_publishing_stops_at_deadline(make_args):
+    with FakeGraphApi(container_delay=60) as graph_api:
+        gh = GraphHandler(make_args(graph_api, publish_deadline=2))
+        creation_id = create_container(graph_api)
+        start = time.monotonic()
+        assert gh.publish_video(creation_id, graph_api.user_id) is None
+        elapsed = time.monotonic() - start
+    assert elapsed < 4
+    assert creation_id not in graph_api.published
@@ -0,0 +1,57 @@
+import time
+import pytest
+from fake_gpio import FakeGPIO
+from pump_controller import PumpController
+from pump_dosing import PumpCalibration, PumpDoser
+
+
+@pytest.fixture
+def gpio():
+    return FakeGPIO()
+
+
+@pytest.fixture
+def doser(gpio):
+    doser = PumpDoser(PumpController(gpio=gpio),
+                      PumpCalibration(flow_rate=50.0), max_dose=100)
+    yield doser
+    doser.cancel()
+    doser.close()
+
+
+@pytest.mark.parametrize("millilitres", [0.5, 5, 25, 100])
+def test_profile_pumps_requested_volume(millilitres):
+    calibration = PumpCalibration(flow_rate=5.0)
+    steps = calibration.profile(millilitres)
+    assert calibration.volume(steps) == pytest.approx(millilitres)
+    assert all(calibration.stall_duty < duty <= 100 for duty, _ in steps)
+
+
+def test_dose_runs_in_background(doser, gpio):
+    start = time.monotonic()
+    future = doser.dose(10)
+    # Dose takes about 0.4 seconds, caller is not blocked meanwhile.
+    assert time.monotonic() - start < 0.1
+    assert not future.done()
+    result = future.result(timeout=5)
+    assert result['requested_ml'] == 10
+    assert result['delivered_ml'] == pytest.approx(10, rel=0.02)
+    pump_pin = [(at, value) for at, kind, channel, value in gpio.events
+                if kind == 'output' and channel == 7]
+    assert pump_pin[-1][1] is False
+    assert pump_pin[-1][0] - pump_pin[0][0] == pytest.approx(result['seconds'],
+                                                             abs=0.05)
+    assert [value for _, kind, _, value in gpio.events if kind == 'pwm'][-1] == 0
+
+
+def test_cancelled_dose_stops_pump(doser, gpio):
+    future = doser.dose(100)
+    time.sleep(0.3)
+    doser.cancel()
+    result = future.result(timeout=1)
+    assert result['delivered_ml'] < 50
+    assert gpio.pins[7] is False
+
+
+def test_dose_is_limited(doser):
+    assert doser.dose(500).result(timeout=10)['requested_ml'] == 100
@@ -0,0 +1,71 @@
+from datetime import date, timedelta
+import numpy as np
+import pytest
+from mp4_container import Mp4Reader
+from timelapse import MIN_TIMELAPSE_SECONDS, TimelapseBuilder
+
+av = pytest.importorskip("av")
+
+
+def write_images(image_dir, count):
+    """ Writes random daily PNG images into the archive. """
+
+    rng = np.random.default_rng(0)
+    image_dir.mkdir(exist_ok=True)
+    for day in range(count):
+        name = str(date(2026, 1, 1) + timedelta(days=day)) + ".png"
+        pixels = rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)
+        with av.open(str(image_dir / name), 'w') as container:
+            stream = container.add_stream('png')
+            stream.width, stream.height, stream.pix_fmt = 160, 120, 'rgb24'
+            for packet in stream.encode(av.VideoFrame.from_ndarray(pixels,
+                                                                   format='rgb24')):
+                container.mux(packet)
+            for packet in stream.encode(None):
+                container.mux(packet)
+
+
+def build_timelapse(tmp_path, images, images_per_second=10):
+    write_images(tmp_path / "images", images)
+    builder = TimelapseBuilder(str(tmp_path / "images"), str(tmp_path / "cache"),
+                               resolution=(320, 240),
+                               images_per_second=images_per_second)
+    builder.update()
+    output_path = str(tmp_path / "timelapse.mp4")
+    assert builder.build(output_path) == images
+    return output_path
+
+
+def check_video(path):
+    """ Checks frame rate, length and intra frames of a timelapse. """
+
+    reader = Mp4Reader(path)
+    seconds = sum(duration for _, _, duration, _ in reader.samples) / reader.timescale
+    assert reader.framerate >= 23
+    assert seconds >= MIN_TIMELAPSE_SECONDS
+    sync = [is_sync for _, _, _, is_sync in reader.samples]
+    # Intra frames are never next to each other.
+    assert not any(first and second for first, second in zip(sync, sync[1:]))
+    # Repeating frames are much smaller than intra frames.
+    intra_size = min(size for _, size, _, is_sync in reader.samples if is_sync)
+    repeat_size = max(size for _, size, _, is_sync in reader.samples if not is_sync)
+    assert repeat_size * 10 < intra_size
+    with av.open(path) as container:
+        assert sum(1 for _ in container.decode(video=0)) == len(reader.samples)
+    return reader
+
+
+def test_short_timelapse_is_shown_long_enough(tmp_path):
+    reader = check_video(build_timelapse(tmp_path, 5))
+    assert sum(is_sync for _, _, _, is_sync in reader.samples) == 5
+
+
+def test_timelapse_is_remuxed_from_cache(tmp_path):
+    reader = check_video(build_timelapse(tmp_path, 40))
+    # Every image is shown for three frames at ten images per second.
+    assert len(reader.samples) == 120
+
+
+def test_fast_timelapse_keeps_intra_frames_apart(tmp_path):
+    reader = check_video(build_timelapse(tmp_path, 60, images_per_second=30))
+    assert len(reader.samples) == 120
@@ -0,0 +1,21 @@
+import os
+import pytest
+from fake_camera import FIXTURE_PATH
+from mp4_container import Mp4Reader
+from video_trimmer import MIN_VIDEO_SECONDS, trim_video
+
+av = pytest.importorskip("av")
+
+
+def test_bundled_video_is_trimmed(tmp_path):
+    output_path = str(tmp_path / "trimmed.mp4")
+    assert trim_video(FIXTURE_PATH, output_path) == output_path
+    original = Mp4Reader(FIXTURE_PATH)
+    trimmed = Mp4Reader(output_path)
+    assert len(trimmed.samples) < len(original.samples)
+    assert len(trimmed.samples) >= MIN_VIDEO_SECONDS * original.framerate
+    assert os.path.getsize(output_path) < os.path.getsize(FIXTURE_PATH)
+    # Trimmed video starts with an intra frame and decodes completely.
+    assert trimmed.samples[0][3]
+    with av.open(output_path) as container:
+        assert sum(1 for _ in container.decode(video=0)) == len(trimmed.samples)
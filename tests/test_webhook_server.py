@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import json
+import requests
+from db_handler import DatabaseHandler
+from metrics import metrics
+from webhook_server import WebhookServer, sign_payload
+
+
+APP_SECRET = "test-secret"
+MEDIA_ID = "4000"
+
+
+def create_payload(*changes):
+    return {'object': 'instagram',
+            'entry': [{'id': '2000', 'time': 1792300000, 'changes': list(changes)}]}
+
+
+def create_change(index):
+    return {'field': 'comments',
+            'value': {'from': {'id': str(index), 'username': 'user' + str(index)},
+                      'media': {'id': MEDIA_ID}, 'id': str(index), 'text': "25ml"}}
+
+
+def create_server(make_args, graph_api):
+    dbh = DatabaseHandler(make_args(graph_api))
+    today = datetime.now().date()
+    dbh.upsert_to_table({'date': today, 'water_amount': 0, 'vote_count': 0})
+    dbh.update_media_id(MEDIA_ID, today)
+    return WebhookServer(dbh, APP_SECRET, "token", "127.0.0.1", 0)
+
+
+def test_malformed_payloads_are_skipped(make_args, graph_api):
+    server = create_server(make_args, graph_api)
+    try:
+        malformed = metrics.counters.get(('webhook_malformed', (('part', 'change'),)), 0)
+        server.apply_batch([
+            create_payload(create_change(1)),
+            [create_change(2)],
+            create_payload({'field': 'comments', 'value': {'media': {'id': MEDIA_ID},
+                                                           'text': "30ml"}},
+                           create_change(3)),
+            create_payload({'field': 'comments', 'value': "30ml"}),
+            create_payload(create_change(4))])
+        assert server.dbh.get_vote_tally(MEDIA_ID)['vote_count'] == 3
+        assert metrics.counters[('webhook_malformed', (('part', 'change'),))] == \
+            malformed + 2
+    finally:
+        server.server.server_close()
+        server.dbh.cleanup()
+
+
+def test_signed_events_are_recorded_in_batches(make_args, graph_api):
+    server = create_server(make_args, graph_api)
+    try:
+        with server:
+            session = requests.Session()
+            for index in range(20):
+                body = json.dumps(create_payload(create_change(index))).encode()
+                resp = session.post(server.base_path, data=body, headers={
+                    'X-Hub-Signature-256': sign_payload(body, APP_SECRET)})
+                assert resp.status_code == 200
+            resp = session.post(server.base_path, data=b'{}', headers={
+                'X-Hub-Signature-256': sign_payload(b'{}', "wrong-secret")})
+            assert resp.status_code == 403
+        # Stopping the server applies the queued events.
+        assert server.dbh.get_vote_tally(MEDIA_ID) == {'water_amount': 25,
+                                                       'vote_count': 20}
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        assert server.dbh.get_posts_between(tomorrow, tomorrow)[0]['vote_count'] == 20
+    finally:
+        server.dbh.cleanup()